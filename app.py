@@ -1,54 +1,331 @@
 import os
+import sqlite3
 import uuid
 import mimetypes
-import base64
 import json
-from flask import Flask, render_template, request, jsonify, send_from_directory, redirect, url_for, session
-from google import genai
-from google.genai import types
-from dotenv import load_dotenv
+import threading
+import time
+from contextlib import closing
+from flask import Flask, Request, Response, g, has_request_context, render_template, request, jsonify, send_file, redirect, url_for, session, stream_with_context
 from functools import wraps
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.middleware.proxy_fix import ProxyFix
+from faceswap import core, metrics
+from faceswap.admission import AdmissionController, Overloaded, RetryPolicy, parse_deadlines
+from faceswap.batch import Batch, BatchRegistry
+from faceswap.core import IMAGE_SIZES, MODEL, PROMPT_VERSION, chunk_part, init_once
+from faceswap.gallery import TemplateIndex
+from faceswap.gemini_client import GeminiClientManager
+from faceswap.history import HistoryStore
+from faceswap.image_io import get_mime_type
+from faceswap.ingest import Ingestor, Rejected, accept
+from faceswap.jobs import CLIENT, DEADLINE, DONE, RUNNING, SPECULATION, Cancelled, Job, JobQueue, checkpoint, current_job
+from faceswap.face_crop import FaceCropper
+from faceswap.preprocess import ASPECT_RATIOS, Preprocessor
+from faceswap.result_cache import ResultCache, cache_key, file_digest
+from faceswap.scheduler import SPECULATIVE, FairScheduler, FifoScheduler
+from faceswap.similar import NearDuplicates, dhash, file_dhash
+from faceswap.speculation import ADOPTED, Speculator
+from faceswap.static_files import ImmutableFiles
+from faceswap.storage import StorageManager
+from faceswap.template_import import DUPLICATE, IMPORTED, TemplateImporter
 
-load_dotenv()
+init_once()
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "faceswap-secret-key-2024")
 
+# Number of reverse proxies in front of the app whose X-Forwarded-For we trust
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+if app.config['TRUSTED_PROXIES']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'])
+
 # Folders
 BASE_DIR = os.path.dirname(__file__)
 app.config['UPLOAD_FOLDER'] = os.path.join(BASE_DIR, 'static', 'generated')
 app.config['TEMPLATES_FOLDER'] = os.path.join(BASE_DIR, 'static', 'templates_gallery')
 app.config['USER_UPLOADS'] = os.path.join(BASE_DIR, 'static', 'user_uploads')
 
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-os.makedirs(app.config['TEMPLATES_FOLDER'], exist_ok=True)
-os.makedirs(app.config['USER_UPLOADS'], exist_ok=True)
+init_once(app.config['UPLOAD_FOLDER'], app.config['TEMPLATES_FOLDER'], app.config['USER_UPLOADS'])
 
-# Admin credentials
-ADMIN_USER = "admin"
-ADMIN_PASS = "2"
+# Template gallery index and thumbnails
+app.config['THUMBNAILS_FOLDER'] = os.path.join(BASE_DIR, 'cache', 'thumbs')
+app.config['GALLERY_PAGE_SIZE'] = int(os.environ.get('GALLERY_PAGE_SIZE', 24))
+template_index = TemplateIndex(
+    app.config['TEMPLATES_FOLDER'],
+    app.config['THUMBNAILS_FOLDER'],
+    '/templates/thumbs'
+)
+
+# Long-lived caching and AVIF/WebP siblings for UUID-named images
+app.config['VARIANTS_FOLDER'] = os.path.join(BASE_DIR, 'cache', 'variants')
+app.config['IMAGE_VARIANTS'] = os.environ.get('IMAGE_VARIANTS', 'webp').split(',')
+
+
+def record_access(folder_key, path):
+    """on_access hook: a generated image that is still being viewed stays"""
+    if folder_key == 'generated':
+        storage.touch(path)
+
+
+immutable_files = ImmutableFiles(
+    app.config['VARIANTS_FOLDER'],
+    formats=app.config['IMAGE_VARIANTS'],
+    on_access=record_access
+)
+
+
+# Every swap request and how it ended, for per-browser history, lookups of
+# generated files and per-template stats; HISTORY_DB and HISTORY_MAX_AGE
+# (seconds, 0 = forever) configure it (see faceswap/history.py)
+app.config['HISTORY_PAGE_SIZE'] = int(os.environ.get('HISTORY_PAGE_SIZE', 20))
+history = HistoryStore.from_env(os.path.join(BASE_DIR, 'cache', 'history.sqlite3'))
+
+
+# Retention for generated images and uploads; limits come from
+# GENERATED_MAX_*, UPLOADS_MAX_* and STORAGE_* (see faceswap/storage.py)
+def record_sweep(report):
+    for name, folder in report['folders'].items():
+        metrics.STORAGE_BYTES.labels(name).set(folder['bytes'] - folder['reclaim_bytes'])
+        for reason, counts in folder['by_reason'].items():
+            metrics.STORAGE_RECLAIMED_BYTES.labels(name, reason).inc(counts['bytes'])
+    # Expired history rows go with each sweep
+    history.prune()
+
+
+def forget_generated(name):
+    """on_delete hook for generated images: drop derived files and history links"""
+    immutable_files.discard_variants('generated', name)
+    history.discard_output(name)
+
+
+storage = StorageManager.from_env(
+    app.config['UPLOAD_FOLDER'],
+    app.config['USER_UPLOADS'],
+    os.path.join(BASE_DIR, 'cache'),
+    on_delete_generated=forget_generated,
+    on_sweep=record_sweep
+)
+
+# Uploads are hashed and checked while the body streams in; limits come from
+# UPLOAD_MAX_BYTES, UPLOAD_MAX_PIXELS and UPLOAD_MIN_SIDE (see faceswap/ingest.py)
+ingestor = Ingestor.from_env(
+    app.config['USER_UPLOADS'],
+    on_reject=lambda reason: metrics.UPLOADS_REJECTED.labels(reason).inc()
+)
+# Room for the other form fields; a body declared larger is refused unread
+app.config['MAX_CONTENT_LENGTH'] = ingestor.max_bytes + 64 * 1024
+
+
+class IngestRequest(Request):
+    """Streams uploaded files through the ingestor instead of a spooled temp file
+
+    Bulk template imports are written to disk unchecked and vetted later by
+    the importer, under its own, larger limits.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint == 'admin_import':
+            return template_importer.open_part()
+        return ingestor.open(content_length)
+
+    @property
+    def max_content_length(self):
+        if self.endpoint == 'admin_import':
+            return template_importer.max_bytes
+        return super().max_content_length
+
+    @property
+    def max_form_parts(self):
+        if self.endpoint == 'admin_import':
+            return template_importer.max_files + 16
+        return super().max_form_parts
+
+
+app.request_class = IngestRequest
+
+
+@app.errorhandler(Rejected)
+def upload_rejected(error):
+    return jsonify({'error': str(error), 'reason': error.reason}), error.status
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def body_too_large(error):
+    if request.endpoint == 'admin_import':
+        return upload_rejected(template_importer.too_large())
+    return upload_rejected(ingestor.too_large())
+
+# Normalized model inputs (resized, re-encoded template variants)
+app.config['INPUT_CACHE'] = os.path.join(BASE_DIR, 'cache', 'inputs')
+app.config['PREPROCESS_INPUTS'] = os.environ.get('PREPROCESS_INPUTS', '1') != '0'
+app.config['PREPROCESS_FORMAT'] = os.environ.get('PREPROCESS_FORMAT', 'jpeg')
+# FACE_CROP=1 sends only the face region of user photos (needs OpenCV,
+# loaded on the first photo; see faceswap/face_crop.py)
+preprocessor = Preprocessor(
+    app.config['INPUT_CACHE'],
+    fmt=app.config['PREPROCESS_FORMAT'],
+    enabled=app.config['PREPROCESS_INPUTS'],
+    face_cropper=FaceCropper.from_env()
+)
+
+# Bulk template imports (ZIP or many files) stage here, then render across a
+# process pool; IMPORT_MAX_BYTES, IMPORT_MAX_FILES and IMPORT_WORKERS tune them
+app.config['IMPORT_STAGING'] = os.path.join(BASE_DIR, 'cache', 'imports')
+template_importer = TemplateImporter.from_env(template_index, app.config['IMPORT_STAGING'], preprocessor)
 
-# Image size mappings
-IMAGE_SIZES = {
-    "x1": "1K",
-    "1k": "1K",
-    "2k": "2K",
-    "4k": "4K"
-}
+# Background generation workers
+app.config['SWAP_WORKERS'] = int(os.environ.get('SWAP_WORKERS', 4))
+app.config['JOB_TTL'] = int(os.environ.get('JOB_TTL', 3600))
+app.config['SSE_KEEPALIVE'] = int(os.environ.get('SSE_KEEPALIVE', 15))
 
-# Aspect ratios
-ASPECT_RATIOS = ["1:1", "16:9", "9:16", "4:3", "3:4", "3:2", "2:3"]
+# Per-size deadlines ("1K=120,2K=180,4K=480", queueing included) and how
+# long a job may go without anyone polling or streaming it (0 = forever)
+app.config['SWAP_DEADLINES'] = parse_deadlines(os.environ.get('SWAP_DEADLINES', ''))
+app.config['ABANDON_AFTER'] = int(os.environ.get('ABANDON_AFTER', 30))
 
-# Face swap prompt template
-FACE_SWAP_PROMPT = """Make the person's face from picture number 1 replace the face in picture number 2. 
-You can change the clothes but only one thing: don't change the hairstyle or anything about the character from picture number 1.
-Keep the same face of the person from picture one, don't change anything about their skin or face.
-Change the position of the person to make the picture look natural and well composed.
 
-Picture 1 is the user's face photo.
-Picture 2 is the template/background image.
+# Queued swaps run in per-size lanes sharing the workers by weight, with
+# clients taking turns in each lane; SWAP_LANE_WEIGHTS, SWAP_LANE_SHARES and
+# SWAP_LANE_SECONDS tune it (see faceswap/scheduler.py). 'fifo' turns it off.
+app.config['SWAP_SCHEDULER'] = os.environ.get('SWAP_SCHEDULER', 'fair')
+
+
+def build_scheduler(workers):
+    """Scheduler for a swap queue running `workers` jobs at once"""
+    if app.config['SWAP_SCHEDULER'] == 'fifo':
+        return FifoScheduler(workers)
+    return FairScheduler.from_env(workers)
+
+
+def update_queue_metrics(queued, running):
+    metrics.QUEUE_DEPTH.set(queued)
+    metrics.JOBS_RUNNING.set(running)
+
+
+def count_cancelled(job):
+    """on_cancel hook: count the job by reason and the last stage it reached"""
+    reached = 'queued'
+    for event in job.events:
+        if event['event'] == 'stage':
+            reached = event['stage']
+        elif event.get('status') == RUNNING:
+            reached = RUNNING
+    metrics.CANCELLED.labels(job.cancel_reason, reached).inc()
+
+
+swap_jobs = JobQueue(
+    workers=app.config['SWAP_WORKERS'],
+    ttl=app.config['JOB_TTL'],
+    on_change=update_queue_metrics,
+    abandon_after=app.config['ABANDON_AFTER'],
+    on_cancel=count_cancelled,
+    scheduler=build_scheduler(app.config['SWAP_WORKERS'])
+)
+
+# One photo against many templates
+app.config['BATCH_CONCURRENCY'] = int(os.environ.get('BATCH_CONCURRENCY', 3))
+app.config['BATCH_MAX_ITEMS'] = int(os.environ.get('BATCH_MAX_ITEMS', 20))
+swap_batches = BatchRegistry(ttl=app.config['JOB_TTL'])
+
+# Admission control: pace model calls to the API quota, limit each client,
+# shed load once the queue is full and retry transient upstream errors.
+# Limits are per process, so divide the quota by the number of workers.
+app.config['MODEL_RATE'] = float(os.environ.get('MODEL_RATE', 1.0))
+app.config['MODEL_BURST'] = int(os.environ.get('MODEL_BURST', 5))
+app.config['CLIENT_RATE'] = float(os.environ.get('CLIENT_RATE', 0.2))
+app.config['CLIENT_BURST'] = int(os.environ.get('CLIENT_BURST', 5))
+app.config['MAX_QUEUE'] = int(os.environ.get('MAX_QUEUE', 32))
+app.config['RETRY_ATTEMPTS'] = int(os.environ.get('RETRY_ATTEMPTS', 4))
+app.config['RETRY_DEADLINE'] = float(os.environ.get('RETRY_DEADLINE', 90))
+
+
+def build_admission(queue):
+    """Admission controller configured from app.config, gating `queue`"""
+    return AdmissionController(
+        rate=app.config['MODEL_RATE'],
+        burst=app.config['MODEL_BURST'],
+        client_rate=app.config['CLIENT_RATE'],
+        client_burst=app.config['CLIENT_BURST'],
+        max_queue=app.config['MAX_QUEUE'],
+        queue_length=lambda: queue.stats()['queued'],
+        retry=RetryPolicy(attempts=app.config['RETRY_ATTEMPTS'], deadline=app.config['RETRY_DEADLINE']),
+        on_shed=lambda reason: metrics.SHED.labels(reason).inc()
+    )
+
+
+admission = build_admission(swap_jobs)
+
+# Every open event stream holds a server thread until its job finishes, so
+# past MAX_EVENT_STREAMS (0 = no limit) they are refused with a 503 and the
+# page polls instead. By default that is one per job the queue admits;
+# gunicorn.conf.py gives the server that many threads and then some.
+app.config['MAX_EVENT_STREAMS'] = int(os.environ.get(
+    'MAX_EVENT_STREAMS', app.config['SWAP_WORKERS'] + (app.config['MAX_QUEUE'] or 32)))
+event_streams = threading.BoundedSemaphore(app.config['MAX_EVENT_STREAMS'] or 1)
+
+# Opt-in speculative generations: with a photo and a template chosen, the
+# page starts the likely swap at low priority and /swap adopts it if the
+# settings still match (see faceswap/speculation.py). A session may waste
+# SPECULATION_BUDGET of them per SPECULATION_WINDOW seconds, each lapses
+# SPECULATION_TTL seconds after it was last posted, and none start while
+# SPECULATION_MAX_QUEUE jobs are waiting.
+app.config['SPECULATION'] = os.environ.get('SPECULATION', '0') != '0'
+app.config['SPECULATION_BUDGET'] = int(os.environ.get('SPECULATION_BUDGET', 3))
+app.config['SPECULATION_WINDOW'] = int(os.environ.get('SPECULATION_WINDOW', 3600))
+app.config['SPECULATION_TTL'] = int(os.environ.get('SPECULATION_TTL', 120))
+app.config['SPECULATION_MAX_QUEUE'] = int(os.environ.get('SPECULATION_MAX_QUEUE', app.config['SWAP_WORKERS']))
+
+
+def count_speculation(speculation):
+    """on_finish hook: count how a speculation ended and an adopted one's head start"""
+    metrics.SPECULATIONS.labels(speculation.outcome).inc()
+    if speculation.outcome == ADOPTED:
+        metrics.SPECULATION_SAVED_SECONDS.observe(speculation.head_start())
+
+
+def build_speculator(queue):
+    """Speculator configured from app.config, cancelling unused jobs in `queue`"""
+    return Speculator(
+        budget=app.config['SPECULATION_BUDGET'],
+        window=app.config['SPECULATION_WINDOW'],
+        ttl=app.config['SPECULATION_TTL'],
+        cancel=lambda job: queue.cancel(job, SPECULATION),
+        on_finish=count_speculation
+    )
+
+
+speculator = build_speculator(swap_jobs)
+
+# Shared Gemini client, created once per process on first use
+gemini = GeminiClientManager.from_env()
+if os.environ.get('GEMINI_WARMUP') and os.environ.get("GEMINI_API_KEY"):
+    gemini.warm_up(MODEL)
+
+# Optional bearer token required to scrape /metrics
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')
+
+# Admin credentials
+ADMIN_USER = "admin"
+ADMIN_PASS = "2"
+
+# Generated results keyed by request content
+app.config['RESULT_CACHE_MAX_BYTES'] = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+app.config['RESULT_CACHE_MAX_AGE'] = int(os.environ.get('RESULT_CACHE_MAX_AGE', 7 * 24 * 3600))
+result_cache = ResultCache(
+    app.config['UPLOAD_FOLDER'],
+    max_bytes=app.config['RESULT_CACHE_MAX_BYTES'],
+    max_age=app.config['RESULT_CACHE_MAX_AGE']
+)
 
-Create the final image with the face from picture 1 placed onto picture 2's scene/pose."""
+# Re-compressed or resized copies of a photo miss the exact-content cache;
+# NEAR_DUPLICATES decides what a perceptually close earlier generation does:
+# 'offer' lists it next to the new job, 'serve' answers with it, 'off'
+app.config['NEAR_DUPLICATES'] = os.environ.get('NEAR_DUPLICATES', 'offer')
+near_duplicates = NearDuplicates(
+    max_entries=int(os.environ.get('NEAR_DUPLICATE_ENTRIES', 200_000)),
+    photo_radius=int(os.environ.get('NEAR_DUPLICATE_RADIUS', 6))
+)
 
 
 def admin_required(f):
@@ -60,112 +337,487 @@ def admin_required(f):
     return decorated_function
 
 
-def load_image_as_base64(file_path):
-    """Load image file and return base64 encoded data"""
-    with open(file_path, "rb") as f:
-        return base64.b64encode(f.read()).decode('utf-8')
+def report(event, **data):
+    """Publish a progress event to the swap job running this generation, if any"""
+    job = current_job()
+    if job is not None:
+        job.emit(event, **data)
 
 
-def get_mime_type(file_path):
-    """Get MIME type from file path"""
-    mime_type, _ = mimetypes.guess_type(file_path)
-    return mime_type or 'image/png'
+def timing_sink():
+    """List collecting stage timings for the current job or request, if any"""
+    job = current_job()
+    if job is not None:
+        return job.timings
+    if has_request_context():
+        return g.setdefault('server_timing', [])
+    return None
 
 
-def generate_face_swap(user_image_path, template_image_path, image_size="2K", aspect_ratio=None):
-    """Generate face swap using Gemini API"""
-    client = genai.Client(
-        api_key=os.environ.get("GEMINI_API_KEY"),
-    )
+def load_inputs(user_image_path, template_image_path, image_size, aspect_ratio=None, timings=None):
+    """Both model inputs as (user data, user mime, template data, template mime)
 
-    # Load both images
-    user_image_data = load_image_as_base64(user_image_path)
-    template_image_data = load_image_as_base64(template_image_path)
-    
-    user_mime = get_mime_type(user_image_path)
-    template_mime = get_mime_type(template_image_path)
-
-    model = "gemini-3-pro-image-preview"
-    
-    # Build prompt with aspect ratio if specified
-    prompt = FACE_SWAP_PROMPT
-    if aspect_ratio:
-        prompt += f"\n\nGenerate the output image with aspect ratio {aspect_ratio}."
-
-    contents = [
-        types.Content(
-            role="user",
-            parts=[
-                types.Part.from_text(text="Picture 1 (User's face):"),
-                types.Part.from_bytes(data=base64.b64decode(user_image_data), mime_type=user_mime),
-                types.Part.from_text(text="Picture 2 (Template/Background):"),
-                types.Part.from_bytes(data=base64.b64decode(template_image_data), mime_type=template_mime),
-                types.Part.from_text(text=prompt),
-            ],
-        ),
-    ]
-    
-    generate_content_config = types.GenerateContentConfig(
-        response_modalities=["IMAGE", "TEXT"],
-        image_config=types.ImageConfig(
-            image_size=image_size,
-        ),
+    Images are downsampled for the requested output size, and the template
+    is the variant pre-framed for the requested aspect ratio.
+    """
+    with metrics.stage('preprocess', image_size, timings):
+        user_image_data, user_mime, user_bytes = preprocessor.user_image(
+            user_image_path, image_size, get_mime_type(user_image_path)
+        )
+        template_image_data, template_mime, template_bytes = preprocessor.template_image(
+            template_image_path, image_size, get_mime_type(template_image_path), aspect_ratio
+        )
+    metrics.BYTES.labels('model_in').inc(len(user_image_data) + len(template_image_data))
+    app.logger.info(
+        "Model inputs (%s): user %d -> %d bytes, template %d -> %d bytes",
+        image_size, user_bytes, len(user_image_data), template_bytes, len(template_image_data)
     )
+    report('stage', stage='preprocessed', bytes_in=user_bytes + template_bytes,
+           bytes_out=len(user_image_data) + len(template_image_data))
+    return user_image_data, user_mime, template_image_data, template_mime
+
+
+def build_request(inputs, image_size, aspect_ratio=None):
+    """Prompt contents and generation config for one face swap"""
+    return core.build_request(inputs, image_size, aspect_ratio, gemini.request_options())
+
+
+def save_generated(inline_data, image_size, timings=None):
+    """Write one generated image to the results folder and return its file name"""
+    file_id = str(uuid.uuid4())
+    data_buffer = inline_data.data
+    file_extension = mimetypes.guess_extension(inline_data.mime_type) or '.png'
+    file_name = f"{file_id}{file_extension}"
+    file_path = os.path.join(app.config['UPLOAD_FOLDER'], file_name)
+    
+    with metrics.stage('write_output', image_size, timings):
+        with open(file_path, "wb") as f:
+            f.write(data_buffer)
+    metrics.BYTES.labels('model_out').inc(len(data_buffer))
+    
+    report('image', url=f'/static/generated/{file_name}')
+    immutable_files.schedule_variants('generated', file_path)
+    return file_name
+
+
+def discard_generated(files):
+    """Delete the images a cancelled generation had already written"""
+    for file_name in files:
+        try:
+            os.remove(os.path.join(app.config['UPLOAD_FOLDER'], file_name))
+        except OSError:
+            pass
+        immutable_files.discard_variants('generated', file_name)
+    del files[:]
+
+
+def report_retry(attempt, delay, error):
+    """on_retry hook for admission.call(): log, count and tell the client"""
+    metrics.RETRIES.labels(type(error).__name__).inc()
+    app.logger.warning("Model call failed (%s), retry %d in %.1fs", error, attempt, delay)
+    report('stage', stage='retrying', attempt=attempt, delay_ms=int(delay * 1000))
+
+
+def generate_face_swap(user_image_path, template_image_path, image_size="2K", aspect_ratio=None):
+    """Generate face swap using Gemini API
+
+    In a swap job the upstream request gets the job's remaining time, and a
+    cancelled or overdue job stops at the next chunk, deleting partial output.
+    """
+    timings = timing_sink()
+    generation_started = time.perf_counter()
+    client = gemini.get()
+    job = current_job()
+
+    inputs = load_inputs(user_image_path, template_image_path, image_size, aspect_ratio, timings)
+    with metrics.stage('build_request', image_size, timings):
+        contents, generate_content_config = build_request(inputs, image_size, aspect_ratio)
+    del inputs
 
     generated_files = []
     text_response = ""
+    request_sent = None
 
-    for chunk in client.models.generate_content_stream(
-        model=model,
-        contents=contents,
-        config=generate_content_config,
-    ):
-        if (
-            chunk.candidates is None
-            or chunk.candidates[0].content is None
-            or chunk.candidates[0].content.parts is None
-        ):
-            continue
-        
-        part = chunk.candidates[0].content.parts[0]
-        if part.inline_data and part.inline_data.data:
-            file_id = str(uuid.uuid4())
-            inline_data = part.inline_data
-            data_buffer = inline_data.data
-            file_extension = mimetypes.guess_extension(inline_data.mime_type) or '.png'
-            file_name = f"{file_id}{file_extension}"
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], file_name)
-            
-            with open(file_path, "wb") as f:
-                f.write(data_buffer)
-            
-            generated_files.append(file_name)
-        elif hasattr(part, 'text') and part.text:
-            text_response += part.text
+    def stream_attempt():
+        nonlocal text_response, request_sent
+        checkpoint()
+        text_response = ""
+        first_chunk = True
+        generate_content_config.http_options = gemini.request_options(job.remaining() if job else None)
+
+        report('stage', stage='request_sent')
+        started = time.perf_counter()
+        request_sent = request_sent or started
+        with metrics.stage('model_stream', image_size, timings):
+            stream = client.models.generate_content_stream(
+                model=MODEL,
+                contents=contents,
+                config=generate_content_config,
+            )
+            # Leaving early closes the generator, and with it the upstream response
+            with closing(stream):
+                for chunk in stream:
+                    checkpoint()
+                    if first_chunk:
+                        first_chunk = False
+                        elapsed = time.perf_counter() - started
+                        metrics.observe('first_chunk', elapsed, image_size, timings)
+                        report('stage', stage='first_chunk', elapsed_ms=int(elapsed * 1000))
+                    
+                    part = chunk_part(chunk)
+                    if part is None:
+                        continue
+                    if part.inline_data and part.inline_data.data:
+                        generated_files.append(save_generated(part.inline_data, image_size, timings))
+                    elif hasattr(part, 'text') and part.text:
+                        text_response += part.text
+                        report('text', text=part.text)
+
+    # Only retry while nothing has been delivered, so users never get duplicate images
+    try:
+        admission.call(
+            stream_attempt,
+            deadline=job.deadline if job else None,
+            retryable=lambda error: not generated_files and not (job and job.cancelled()),
+            on_retry=report_retry
+        )
+    except Exception as e:
+        # A read timeout from our own deadline counts as the deadline too
+        reason = e.reason if isinstance(e, Cancelled) else job and job.cancelled()
+        if not reason:
+            raise
+        discard_generated(generated_files)
+        if request_sent is not None:
+            metrics.CANCELLED_MODEL_SECONDS.labels(reason).inc(time.perf_counter() - request_sent)
+        if isinstance(e, Cancelled):
+            raise
+        raise Cancelled(reason) from e
 
+    metrics.GENERATION_SECONDS.labels(image_size, os.path.basename(template_image_path)).observe(
+        time.perf_counter() - generation_started
+    )
     return generated_files, text_response
 
 
-def get_templates():
-    """Get all template images from gallery"""
-    templates = []
-    folder = app.config['TEMPLATES_FOLDER']
-    if os.path.exists(folder):
-        for filename in os.listdir(folder):
-            if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
-                templates.append({
-                    'filename': filename,
-                    'path': f'/static/templates_gallery/{filename}'
-                })
-    return templates
+def get_templates(offset=0, limit=None):
+    """Get template images from the gallery index, newest first"""
+    entries = template_index.entries()
+    if limit is not None:
+        entries = entries[offset:offset + limit]
+    return [template_index.public(e) for e in entries]
+
+
+def swap_key(user_digest, template_path, image_size, aspect_ratio):
+    """Result cache key for one generation request"""
+    return cache_key(user_digest, file_digest(template_path), image_size, aspect_ratio, PROMPT_VERSION)
+
+
+def swap_signature(photo_hash, template_path, image_size, aspect_ratio):
+    """Perceptual identity of a generation request in near_duplicates"""
+    return photo_hash, file_dhash(template_path), (image_size, aspect_ratio or '', PROMPT_VERSION)
+
+
+def near_duplicate(signature):
+    """(photo distance, result) of the closest earlier generation still cached, or None"""
+    serve = app.config['NEAR_DUPLICATES'] == 'serve'
+    for distance, key in near_duplicates.find(*signature):
+        result = result_cache.get(key, count=serve)
+        if result is not None:
+            return distance, result
+    return None
+
+
+def run_swap(key, user_path, template_path, image_size, aspect_ratio=None):
+    """Generate one face swap, sharing the result with identical requests"""
+    with storage.pinned(user_path):
+        while True:
+            try:
+                return result_cache.get_or_compute(
+                    key,
+                    generate_face_swap,
+                    user_path,
+                    template_path,
+                    image_size=image_size,
+                    aspect_ratio=aspect_ratio
+                )
+            except Cancelled:
+                # Give up only if this job was cancelled, not the one whose result we shared
+                checkpoint()
+
+
+def client_id():
+    """Key for per-client rate limits: the caller's address"""
+    return request.remote_addr or 'unknown'
+
+
+def overloaded_response(error, status=429):
+    """Shed a request, telling the client when it is worth trying again"""
+    return jsonify({'error': str(error), 'retry_after': error.retry_after}), status, {
+        'Retry-After': str(error.retry_after)
+    }
+
+
+def swap_images(result):
+    """Public URLs and text for a (files, text) generation result"""
+    files, text = result
+    return {
+        'images': [f'/static/generated/{f}' for f in files],
+        'text': text
+    }
+
+
+def template_upload_result(entry):
+    """(JSON body, status) answering a single template upload, from its import report entry"""
+    if entry['status'] not in (IMPORTED, DUPLICATE):
+        return {'error': f"Could not process the template: {entry.get('error')}"}, 500
+    filename = entry.get('existing') or entry['filename']
+    return {
+        'success': True,
+        'filename': filename,
+        'path': f'/static/templates_gallery/{filename}',
+        'duplicate': entry['status'] == DUPLICATE
+    }, 200
+
+
+def adopt_speculation(queue, job, size):
+    """Hand a claimed speculative job over to the /swap request for `size`
+
+    It moves to that size's lane and gets the deadline a fresh swap would
+    have, counted from now rather than from when the speculation began.
+    """
+    job.reset_deadline(app.config['SWAP_DEADLINES'].get(size))
+    queue.promote(job, size)
+
+
+def speculation_refusal(speculator, queue, session_id, key):
+    """Why not to start a speculative generation of `key` now, or None"""
+    if result_cache.get(key, count=False) is not None:
+        return 'cached'
+    if not speculator.allowed(session_id):
+        return 'budget'
+    if queue.stats()['queued'] >= app.config['SPECULATION_MAX_QUEUE']:
+        return 'busy'
+    return None
+
+
+def refuse_speculation(speculator, session_id, reason):
+    """Body for a speculation not started; the session's other one is of no use either"""
+    speculator.drop(session_id)
+    speculator.refused(reason)
+    metrics.SPECULATIONS.labels(reason).inc()
+    return {'speculating': False, 'reason': reason}
+
+
+def history_id(sess):
+    """This browser's key in the generation history, assigned on its first swap"""
+    if 'history_id' not in sess:
+        sess['history_id'] = uuid.uuid4().hex
+    return sess['history_id']
+
+
+def record_history(session_id, user_digest, template_path, image_size, aspect_ratio, key, job=None, result=None):
+    """Add a swap request to the history: served from `result`, or run by `job`
+
+    A history that cannot be written (e.g. a locked database) is logged and
+    never fails the swap itself.
+    """
+    try:
+        history.record(
+            session_id, user_digest, os.path.basename(template_path), file_digest(template_path),
+            image_size, aspect_ratio, PROMPT_VERSION, key,
+            job_id=job.id if job else None, files=result[0] if result else None
+        )
+    except sqlite3.Error:
+        app.logger.exception("Could not record swap in the history")
+        return
+    if job is not None:
+        job.add_done_callback(record_outcome)
+
+
+def record_outcome(job):
+    """Done callback of a swap job: store how it ended in the history"""
+    history.finish(
+        job.id,
+        job.status,
+        files=job.result[0] if job.result else (),
+        seconds=job.finished_at - job.started_at if job.started_at else None,
+        timings=job.timings,
+        error=job.error
+    )
+
+
+def history_item(row):
+    """Public view of a history row"""
+    return {
+        'id': row['id'],
+        'status': row['status'],
+        'created': row['created'],
+        'finished': row['finished'],
+        'template_id': row['template'],
+        'image_size': row['image_size'],
+        'aspect_ratio': row['aspect_ratio'],
+        'seconds': row['seconds'],
+        'timings': row['timings'],
+        'error': row['error'],
+        'images': [f'/static/generated/{name}' for name in row['files']],
+    }
+
+
+def history_page(session_id, cursor, limit):
+    """Body of a history page, or None for a malformed cursor"""
+    if cursor and not cursor.isdigit():
+        return None
+    limit = min(100, max(1, limit or app.config['HISTORY_PAGE_SIZE']))
+    items, next_cursor = history.page(session_id, cursor or None, limit)
+    return {'items': [history_item(row) for row in items], 'next_cursor': next_cursor}
+
+
+def upload_path(upload):
+    """Content-addressed path for an accepted upload, with the extension of its sniffed type"""
+    ext = mimetypes.guess_extension(upload.mime_type) or ''
+    return os.path.join(app.config['USER_UPLOADS'], upload.digest + ext)
+
+
+def save_user_photo(upload):
+    """Store an accepted upload under its content hash and return its path
+
+    A photo identical to an earlier upload reuses that file, and the staged
+    copy is dropped when the request closes.
+    """
+    user_path = upload_path(upload)
+    if not storage.reuse(user_path):
+        upload.commit(user_path)
+        storage.touch(user_path)
+    return user_path
+
+
+def event_stream(log, since, final_event):
+    """Server-Sent Events response replaying `log` from index `since`
+
+    Once the log's owner has finished, `final_event()` supplies the payload
+    of a closing 'result' event. Past MAX_EVENT_STREAMS open streams it is
+    a 503 instead.
+    """
+    limited = bool(app.config['MAX_EVENT_STREAMS'])
+    if limited and not event_streams.acquire(blocking=False):
+        return jsonify({'error': 'Too many open event streams, poll the job instead', 'retry_after': 2}), 503, {
+            'Retry-After': '2'
+        }
+
+    def stream():
+        index = since
+        yield 'retry: 2000\n\n'
+        # Closed when a write to a dead client fails, which lets the job be abandoned
+        with log.watching():
+            while True:
+                events = log.wait_events(index, timeout=app.config['SSE_KEEPALIVE'])
+                if not events:
+                    if log.finished:
+                        break
+                    # Comments keep proxies from timing out and surface dead clients
+                    yield ': keepalive\n\n'
+                    continue
+                for event in events:
+                    index += 1
+                    yield f"id: {index}\nevent: {event['event']}\ndata: {json.dumps(event)}\n\n"
+        yield f"event: result\ndata: {json.dumps(final_event())}\n\n"
+
+    response = Response(stream_with_context(stream()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    if limited:
+        # Runs however the response ends, even if the stream was never started
+        response.call_on_close(event_streams.release)
+    return response
+
+
+def job_payload(job):
+    """Serialize a swap job for the polling endpoints"""
+    payload = job.to_dict()
+    payload['position'] = swap_jobs.position(job)
+    payload['estimated_wait'] = round(swap_jobs.estimated_wait(job), 1)
+    payload['status_url'] = url_for('job_status', job_id=job.id)
+    payload['result_url'] = url_for('job_result', job_id=job.id)
+    payload['events_url'] = url_for('job_events', job_id=job.id)
+    return payload
+
+
+def result_payload(job):
+    """Response body for a finished swap job"""
+    if job.status == 'failed':
+        if isinstance(job.exception, Overloaded):
+            return {'error': job.error, 'retry_after': job.exception.retry_after}
+        if isinstance(job.exception, Cancelled):
+            return {'error': job.error, 'cancelled': job.exception.reason}
+        return {'error': job.error}
+    return dict(success=True, **swap_images(job.result))
+
+
+def batch_payload(batch):
+    """Serialize a batch for its polling and streaming endpoints"""
+    payload = batch.to_dict()
+    payload['status_url'] = url_for('batch_status', batch_id=batch.id)
+    payload['events_url'] = url_for('batch_events', batch_id=batch.id)
+    return payload
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def add_server_timing(response):
+    timings = list(g.get('server_timing', []))
+    if 'request_started' in g:
+        timings.append(('app', time.perf_counter() - g.request_started))
+    if timings:
+        response.headers['Server-Timing'] = metrics.server_timing(timings)
+    return response
 
 
 # ============ USER ROUTES ============
 
 @app.route('/')
 def index():
-    templates = get_templates()
-    return render_template('index.html', templates=templates, aspect_ratios=ASPECT_RATIOS)
+    page_size = app.config['GALLERY_PAGE_SIZE']
+    templates = get_templates(0, page_size)
+    return render_template(
+        'index.html',
+        templates=templates,
+        total_templates=len(template_index.entries()),
+        page_size=page_size,
+        aspect_ratios=ASPECT_RATIOS,
+        speculation=app.config['SPECULATION']
+    )
+
+
+@app.route('/templates')
+def list_templates():
+    """Paginated gallery for lazy loading"""
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = min(100, max(1, request.args.get('limit', app.config['GALLERY_PAGE_SIZE'], type=int)))
+    entries, total = template_index.page(offset, limit)
+    next_offset = offset + len(entries)
+    return jsonify({
+        'templates': [template_index.public(e) for e in entries],
+        'total': total,
+        'offset': offset,
+        'next_offset': next_offset if next_offset < total else None
+    })
+
+
+@app.route('/templates/thumbs/<name>')
+def template_thumbnail(name):
+    thumb = template_index.thumbnail(name)
+    if thumb is None:
+        return jsonify({'error': 'Thumbnail not found'}), 404
+    path, mime_type = thumb
+    # Names embed the template's content hash, so they never change
+    response = send_file(path, mimetype=mime_type, max_age=365 * 24 * 3600)
+    response.cache_control.immutable = True
+    return response
 
 
 @app.route('/swap', methods=['POST'])
@@ -187,11 +839,6 @@ def swap():
     if not os.environ.get("GEMINI_API_KEY"):
         return jsonify({'error': 'GEMINI_API_KEY not configured'}), 500
     
-    # Save user photo
-    user_filename = f"{uuid.uuid4()}_{user_photo.filename}"
-    user_path = os.path.join(app.config['USER_UPLOADS'], user_filename)
-    user_photo.save(user_path)
-    
     # Get template path
     template_path = os.path.join(app.config['TEMPLATES_FOLDER'], template_id)
     if not os.path.exists(template_path):
@@ -200,20 +847,295 @@ def swap():
     # Map image size
     size = IMAGE_SIZES.get(image_size, "2K")
     
+    # Serve repeated requests straight from the result cache; the photo was
+    # hashed as it streamed in
+    upload = accept(user_photo)
+    timings = timing_sink()
+    with metrics.stage('hash', size, timings):
+        key = swap_key(upload.digest, template_path, size, aspect_ratio)
+        cached = result_cache.get(key)
+    session_id = history_id(session)
+    
+    # A speculative generation of exactly this request already has a head
+    # start; it was admitted when it began
+    speculation = speculator.claim(session_id, key)
+    if speculation is not None:
+        job = speculation.job
+        adopt_speculation(swap_jobs, job, size)
+        record_history(session_id, upload.digest, template_path, size, aspect_ratio, key, job=job)
+        if job.status == DONE:
+            return jsonify(dict(success=True, speculated=True, **swap_images(job.result)))
+        payload = dict(job_payload(job), speculated=True)
+        return jsonify(payload), 202, {'Location': payload['status_url']}
+    
+    if cached:
+        record_history(session_id, upload.digest, template_path, size, aspect_ratio, key, result=cached)
+        return jsonify(dict(success=True, cached=True, **swap_images(cached)))
+    
+    # Then from an earlier generation for a near-identical photo, unless the
+    # client asks for a fresh one
+    signature = similar = None
+    if app.config['NEAR_DUPLICATES'] != 'off':
+        with metrics.stage('phash', size, timings):
+            signature = swap_signature(dhash(upload.path), template_path, size, aspect_ratio)
+            similar = near_duplicate(signature)
+        if similar and app.config['NEAR_DUPLICATES'] == 'serve' and not request.form.get('fresh'):
+            distance, result = similar
+            record_history(session_id, upload.digest, template_path, size, aspect_ratio, key, result=result)
+            return jsonify(dict(success=True, cached=True, near_duplicate=distance, **swap_images(result)))
+    
     try:
-        files, text = generate_face_swap(
-            user_path, 
-            template_path, 
-            image_size=size,
-            aspect_ratio=aspect_ratio if aspect_ratio else None
-        )
-        return jsonify({
-            'success': True,
-            'images': [f'/static/generated/{f}' for f in files],
-            'text': text
-        })
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        admission.admit(client_id())
+    except Overloaded as e:
+        return overloaded_response(e)
+    
+    # Save user photo
+    with metrics.stage('save_upload', size, timings):
+        user_path = save_user_photo(upload)
+    metrics.BYTES.labels('upload').inc(upload.size)
+    
+    job = swap_jobs.enqueue(Job(
+        run_swap,
+        (key, user_path, template_path, size, aspect_ratio if aspect_ratio else None),
+        {},
+        timeout=app.config['SWAP_DEADLINES'].get(size),
+        lane=size,
+        client=client_id()
+    ))
+    record_history(session_id, upload.digest, template_path, size, aspect_ratio, key, job=job)
+    if signature is not None:
+        near_duplicates.add(*signature, key)
+    payload = job_payload(job)
+    if similar:
+        distance, result = similar
+        payload['similar'] = dict(distance=distance, **swap_images(result))
+    return jsonify(payload), 202, {'Location': payload['status_url']}
+
+
+@app.route('/swap/speculate', methods=['POST', 'DELETE'])
+def speculate():
+    """Start the swap the user is likely to ask for next, at low priority
+
+    Takes the same fields as /swap, which adopts the job if it is then
+    asked for with the same photo, template, size and ratio. Posting again
+    keeps it alive or, with other settings, replaces it; DELETE drops it.
+    """
+    if not app.config['SPECULATION']:
+        return jsonify({'error': 'Speculation is disabled'}), 404
+    session_id = history_id(session)
+    if request.method == 'DELETE':
+        return jsonify({'dropped': speculator.drop(session_id)})
+    
+    user_photo = request.files.get('user_photo')
+    template_id = request.form.get('template_id')
+    aspect_ratio = request.form.get('aspect_ratio', '')
+    if not user_photo or not user_photo.filename or not template_id:
+        return jsonify({'error': 'Please select a photo and a template'}), 400
+    if not os.environ.get("GEMINI_API_KEY"):
+        return jsonify({'error': 'GEMINI_API_KEY not configured'}), 500
+    template_path = os.path.join(app.config['TEMPLATES_FOLDER'], template_id)
+    if not os.path.exists(template_path):
+        return jsonify({'error': 'Template not found'}), 404
+    size = IMAGE_SIZES.get(request.form.get('image_size', 'x1'), "2K")
+    
+    upload = accept(user_photo)
+    key = swap_key(upload.digest, template_path, size, aspect_ratio)
+    live = speculator.current(session_id, key)
+    if live is not None:
+        return jsonify(dict(speculating=True, **live.to_dict()))
+    
+    reason = speculation_refusal(speculator, swap_jobs, session_id, key)
+    if reason is None:
+        try:
+            admission.admit(client_id())
+        except Overloaded:
+            reason = 'quota'
+    if reason is not None:
+        return jsonify(refuse_speculation(speculator, session_id, reason))
+    
+    user_path = save_user_photo(upload)
+    metrics.BYTES.labels('upload').inc(upload.size)
+    job = Job(
+        run_swap,
+        (key, user_path, template_path, size, aspect_ratio if aspect_ratio else None),
+        {},
+        timeout=app.config['SWAP_DEADLINES'].get(size),
+        lane=SPECULATIVE,
+        client=client_id()
+    )
+    speculation = speculator.start(session_id, key, job)
+    swap_jobs.enqueue(job)
+    return jsonify(dict(speculating=True, **speculation.to_dict())), 202
+
+
+@app.route('/history')
+def swap_history():
+    """This browser's generations, newest first, a page at a time
+
+    Pass the `next_cursor` of one page as `cursor` to get the next.
+    """
+    if 'history_id' not in session:
+        return jsonify({'items': [], 'next_cursor': None})
+    payload = history_page(session['history_id'], request.args.get('cursor'), request.args.get('limit', type=int))
+    if payload is None:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    return jsonify(payload)
+
+
+@app.route('/swap/batch', methods=['POST'])
+def swap_batch():
+    """Try one photo on several templates (and optionally sizes/aspect ratios)"""
+    if 'user_photo' not in request.files:
+        return jsonify({'error': 'Please upload your photo'}), 400
+    
+    user_photo = request.files['user_photo']
+    template_ids = request.form.getlist('template_id')
+    if not template_ids:
+        template_ids = [t for t in request.form.get('template_ids', '').split(',') if t]
+    image_sizes = request.form.getlist('image_size') or ['x1']
+    aspect_ratios = request.form.getlist('aspect_ratio') or ['']
+    
+    if not user_photo.filename:
+        return jsonify({'error': 'Please select a photo'}), 400
+    
+    if not template_ids:
+        return jsonify({'error': 'Please select at least one template'}), 400
+    
+    upload = accept(user_photo)
+    
+    if not os.environ.get("GEMINI_API_KEY"):
+        return jsonify({'error': 'GEMINI_API_KEY not configured'}), 500
+    
+    combos = []
+    for template_id in dict.fromkeys(template_ids):
+        for image_size in dict.fromkeys(image_sizes):
+            for aspect_ratio in dict.fromkeys(aspect_ratios):
+                combos.append((template_id, image_size, aspect_ratio))
+    if len(combos) > app.config['BATCH_MAX_ITEMS']:
+        return jsonify({'error': f"At most {app.config['BATCH_MAX_ITEMS']} generations per batch"}), 400
+    
+    # A batch is one submission; BATCH_CONCURRENCY already caps its share of the queue
+    try:
+        admission.admit(client_id())
+    except Overloaded as e:
+        return overloaded_response(e)
+    
+    user_path = None
+    photo_hash = dhash(upload.path) if app.config['NEAR_DUPLICATES'] != 'off' else None
+    
+    batch = Batch(swap_jobs, concurrency=app.config['BATCH_CONCURRENCY'], describe=swap_images, client=client_id())
+    for template_id, image_size, aspect_ratio in combos:
+        meta = {'template_id': template_id, 'image_size': image_size, 'aspect_ratio': aspect_ratio}
+        template_path = os.path.join(app.config['TEMPLATES_FOLDER'], template_id)
+        if not os.path.exists(template_path):
+            batch.add_error('Template not found', meta=meta)
+            continue
+        
+        size = IMAGE_SIZES.get(image_size, "2K")
+        key = swap_key(upload.digest, template_path, size, aspect_ratio)
+        cached = result_cache.get(key)
+        if cached:
+            batch.add_result(cached, meta=dict(meta, cached=True))
+            continue
+        if photo_hash is not None:
+            signature = swap_signature(photo_hash, template_path, size, aspect_ratio)
+            similar = near_duplicate(signature)
+            if similar and app.config['NEAR_DUPLICATES'] == 'serve' and not request.form.get('fresh'):
+                batch.add_result(similar[1], meta=dict(meta, cached=True, near_duplicate=similar[0]))
+                continue
+            if similar:
+                meta['similar'] = dict(distance=similar[0], **swap_images(similar[1]))
+            near_duplicates.add(*signature, key)
+        
+        # The photo is stored (and later preprocessed) once for the whole batch
+        if user_path is None:
+            user_path = save_user_photo(upload)
+        batch.add(run_swap, key, user_path, template_path, size, aspect_ratio or None,
+                  meta=meta, timeout=app.config['SWAP_DEADLINES'].get(size), lane=size)
+    
+    swap_batches.add(batch)
+    batch.start()
+    payload = batch_payload(batch)
+    return jsonify(payload), 200 if batch.finished else 202, {'Location': payload['status_url']}
+
+
+@app.route('/batches/<batch_id>')
+def batch_status(batch_id):
+    batch = swap_batches.get(batch_id)
+    if batch is None:
+        return jsonify({'error': 'Batch not found'}), 404
+    batch.touch()
+    return jsonify(batch_payload(batch))
+
+
+@app.route('/batches/<batch_id>/events')
+def batch_events(batch_id):
+    """Server-Sent Events stream of per-item results as they complete"""
+    batch = swap_batches.get(batch_id)
+    if batch is None:
+        return jsonify({'error': 'Batch not found'}), 404
+    since = request.headers.get('Last-Event-ID', 0, type=int)
+    return event_stream(batch, since, lambda: batch_payload(batch))
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = swap_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    job.touch()
+    return jsonify(job_payload(job))
+
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """Cancel a queued or running swap job, e.g. because the user left the page"""
+    job = swap_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if not swap_jobs.cancel(job, CLIENT):
+        return jsonify({'error': 'Job already finished or cancelled'}), 409
+    return jsonify(job_payload(job)), 200 if job.finished else 202
+
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    job = swap_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    job.touch()
+    if not job.finished:
+        return jsonify(job_payload(job)), 202
+    
+    # Echo the generation's own stage timings to the client
+    timing_sink().extend(job.timings)
+    if isinstance(job.exception, Overloaded):
+        return overloaded_response(job.exception, 503)
+    if isinstance(job.exception, Cancelled):
+        return jsonify(result_payload(job)), 504 if job.exception.reason == DEADLINE else 410
+    return jsonify(result_payload(job)), 500 if job.status == 'failed' else 200
+
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Server-Sent Events stream of a swap job's progress, ending with its result"""
+    job = swap_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    # EventSource resends the last id it saw when it reconnects
+    since = request.headers.get('Last-Event-ID', 0, type=int)
+    return event_stream(job, since, lambda: result_payload(job))
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    token = app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return jsonify({'error': 'Unauthorized'}), 401
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
 
 
 # ============ ADMIN ROUTES ============
@@ -246,6 +1168,42 @@ def admin_dashboard():
     return render_template('admin.html', templates=templates)
 
 
+@app.route('/admin/stats')
+@admin_required
+def admin_stats():
+    return jsonify({
+        'jobs': swap_jobs.stats(),
+        'result_cache': result_cache.stats(),
+        'gemini': gemini.stats(),
+        'preprocess': preprocessor.stats(),
+        'admission': admission.stats(),
+        'storage': storage.stats(),
+        'uploads': ingestor.stats(),
+        'imports': template_importer.stats(),
+        'near_duplicates': near_duplicates.stats(),
+        'history': history.stats(),
+        'speculation': speculator.stats()
+    })
+
+
+@app.route('/admin/history/templates')
+@admin_required
+def admin_history_templates():
+    """Generations per template by outcome, optionally over the last `days`"""
+    days = request.args.get('days', type=float)
+    return jsonify({'templates': history.template_stats(time.time() - days * 86400 if days else None)})
+
+
+@app.route('/admin/history/files/<filename>')
+@admin_required
+def admin_history_file(filename):
+    """The swap requests that produced or were served a generated image"""
+    generations = history.lookup(filename)
+    if not generations:
+        return jsonify({'error': 'No history for this file'}), 404
+    return jsonify({'generations': generations})
+
+
 @app.route('/admin/upload', methods=['POST'])
 @admin_required
 def admin_upload():
@@ -256,16 +1214,35 @@ def admin_upload():
     if not file.filename:
         return jsonify({'error': 'No file selected'}), 400
     
-    # Save template
-    filename = f"{uuid.uuid4()}_{file.filename}"
-    filepath = os.path.join(app.config['TEMPLATES_FOLDER'], filename)
-    file.save(filepath)
+    upload = accept(file)
     
+    # Rendered in the import pool, not on a thread of this process
+    body, status = template_upload_result(template_importer.add(file.filename, upload))
+    return jsonify(body), status
+
+
+@app.route('/admin/import', methods=['POST'])
+@admin_required
+def admin_import():
+    """Start importing every image in the uploaded ZIP archives and image files"""
+    parts = [(file.filename, file.stream) for _, file in request.files.items(multi=True) if file.filename]
+    if not parts:
+        return jsonify({'error': 'No file provided'}), 400
+
+    job = template_importer.start(parts)
     return jsonify({
-        'success': True,
-        'filename': filename,
-        'path': f'/static/templates_gallery/{filename}'
-    })
+        'import_id': job.id,
+        'status_url': url_for('admin_import_status', import_id=job.id)
+    }), 202
+
+
+@app.route('/admin/import/<import_id>')
+@admin_required
+def admin_import_status(import_id):
+    job = template_importer.get(import_id)
+    if job is None:
+        return jsonify({'error': 'Import not found'}), 404
+    return jsonify(job.report())
 
 
 @app.route('/admin/delete/<filename>', methods=['DELETE'])
@@ -273,7 +1250,10 @@ def admin_upload():
 def admin_delete(filename):
     filepath = os.path.join(app.config['TEMPLATES_FOLDER'], filename)
     if os.path.exists(filepath):
+        digest = file_digest(filepath)
         os.remove(filepath)
+        template_index.discard(digest)
+        preprocessor.discard_template_variants(digest)
         return jsonify({'success': True})
     return jsonify({'error': 'File not found'}), 404
 
@@ -282,12 +1262,12 @@ def admin_delete(filename):
 
 @app.route('/static/generated/<filename>')
 def serve_generated(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return immutable_files.send(app.config['UPLOAD_FOLDER'], 'generated', filename)
 
 
 @app.route('/static/templates_gallery/<filename>')
 def serve_template(filename):
-    return send_from_directory(app.config['TEMPLATES_FOLDER'], filename)
+    return immutable_files.send(app.config['TEMPLATES_FOLDER'], 'templates_gallery', filename)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,891 @@
+"""Async (ASGI) variant of app.py
+
+    uvicorn asgi_app:app --workers 1 --proxy-headers
+
+Serves the same routes as app.py with Quart. Generations run as coroutines
+on the event loop through the SDK's async streaming API, so a waiting
+generation (or an open SSE stream) costs a task instead of a thread and one
+process can hold hundreds of them. Preprocessing, hashing and file writes
+run in worker threads. Configuration, prompt, templates and the on-disk
+caches are shared with app.py.
+"""
+import asyncio
+import json
+import os
+import time
+from datetime import datetime, timezone
+from functools import wraps
+
+from quart import Quart, Request, Response, abort, g, has_request_context, jsonify, redirect, render_template, request, send_file, session, stream_with_context, url_for
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from app import app as flask_app
+from app import (
+    ADMIN_PASS,
+    ADMIN_USER,
+    ASPECT_RATIOS,
+    IMAGE_SIZES,
+    MODEL,
+    adopt_speculation,
+    build_admission,
+    build_scheduler,
+    build_speculator,
+    build_request,
+    chunk_part,
+    count_cancelled,
+    discard_generated,
+    gemini,
+    get_templates,
+    history,
+    history_id,
+    history_page,
+    immutable_files,
+    ingestor,
+    load_inputs,
+    near_duplicate,
+    near_duplicates,
+    preprocessor,
+    record_history,
+    refuse_speculation,
+    report,
+    report_retry,
+    result_cache,
+    result_payload,
+    speculation_refusal,
+    save_generated,
+    storage,
+    swap_images,
+    swap_key,
+    swap_signature,
+    template_importer,
+    template_index,
+    template_upload_result,
+    update_queue_metrics,
+    upload_path,
+)
+from faceswap import metrics
+from faceswap.admission import Overloaded
+from faceswap.batch import Batch, BatchRegistry
+from faceswap.ingest import Rejected, accept
+from faceswap.jobs import CLIENT, DEADLINE, DONE, AsyncJobQueue, Cancelled, Job, checkpoint, current_job
+from faceswap.result_cache import file_digest
+from faceswap.scheduler import SPECULATIVE
+from faceswap.similar import dhash
+
+app = Quart(__name__)
+app.secret_key = flask_app.secret_key
+for key, value in flask_app.config.items():
+    app.config.setdefault(key, value)
+# Quart has its own default; the upload limit decides instead
+app.config['MAX_CONTENT_LENGTH'] = flask_app.config['MAX_CONTENT_LENGTH']
+
+IMPORT_PATH = '/admin/import'
+
+
+class IngestRequest(Request):
+    """Streams uploaded files through the ingestor instead of a spooled temp file
+
+    Bulk template imports are written to disk unchecked and vetted later by
+    the importer, under its own, larger limits.
+    """
+
+    def __init__(self, method, scheme, path, *args, **kwargs):
+        if path == IMPORT_PATH:
+            # The body limit is fixed when the request is created, before routing
+            kwargs['max_content_length'] = template_importer.max_bytes
+            kwargs['body_timeout'] = None
+        super().__init__(method, scheme, path, *args, **kwargs)
+        if path == IMPORT_PATH:
+            self.max_form_parts = template_importer.max_files + 16
+
+    def make_form_data_parser(self):
+        if self.path == IMPORT_PATH:
+            def stream_factory(total_content_length, content_type, filename, content_length):
+                return template_importer.open_part()
+        else:
+            def stream_factory(total_content_length, content_type, filename, content_length):
+                return ingestor.open(content_length)
+        return self.form_data_parser_class(
+            stream_factory=stream_factory,
+            max_content_length=self.max_content_length,
+            max_form_memory_size=self.max_form_memory_size,
+            max_form_parts=self.max_form_parts,
+            cls=self.parameter_storage_class,
+        )
+
+
+app.request_class = IngestRequest
+
+
+@app.errorhandler(Rejected)
+async def upload_rejected(error):
+    return jsonify({'error': str(error), 'reason': error.reason}), error.status
+
+
+@app.errorhandler(RequestEntityTooLarge)
+async def body_too_large(error):
+    if request.path == IMPORT_PATH:
+        return await upload_rejected(template_importer.too_large())
+    return await upload_rejected(ingestor.too_large())
+
+# Generations in flight per process; they wait on the network, not on threads
+app.config['ASYNC_CONCURRENCY'] = int(os.environ.get('ASYNC_CONCURRENCY', 256))
+swap_jobs = AsyncJobQueue(
+    workers=app.config['ASYNC_CONCURRENCY'],
+    ttl=app.config['JOB_TTL'],
+    on_change=update_queue_metrics,
+    abandon_after=app.config['ABANDON_AFTER'],
+    on_cancel=count_cancelled,
+    scheduler=build_scheduler(app.config['ASYNC_CONCURRENCY'])
+)
+swap_batches = BatchRegistry(ttl=app.config['JOB_TTL'])
+admission = build_admission(swap_jobs)
+speculator = build_speculator(swap_jobs)
+
+
+def admin_required(f):
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        if not session.get('admin_logged_in'):
+            return redirect(url_for('admin_login'))
+        return await f(*args, **kwargs)
+    return decorated_function
+
+
+def timing_sink():
+    """List collecting stage timings for the current job or request, if any"""
+    job = current_job()
+    if job is not None:
+        return job.timings
+    if has_request_context():
+        return g.setdefault('server_timing', [])
+    return None
+
+
+async def generate_face_swap(user_image_path, template_image_path, image_size="2K", aspect_ratio=None):
+    """Generate face swap using the Gemini async streaming API
+
+    Cancelling the job cancels this coroutine wherever it is waiting, which
+    closes the upstream response; partial output is deleted.
+    """
+    timings = timing_sink()
+    generation_started = time.perf_counter()
+    client = gemini.get()
+    job = current_job()
+
+    generated_files = []
+    text_response = ""
+    request_sent = None
+    contents = generate_content_config = None
+
+    async def stream_attempt():
+        nonlocal text_response, request_sent
+        checkpoint()
+        text_response = ""
+        first_chunk = True
+        generate_content_config.http_options = gemini.request_options(job.remaining() if job else None)
+
+        report('stage', stage='request_sent')
+        started = time.perf_counter()
+        request_sent = request_sent or started
+        with metrics.stage('model_stream', image_size, timings):
+            stream = await client.aio.models.generate_content_stream(
+                model=MODEL,
+                contents=contents,
+                config=generate_content_config,
+            )
+            # Close the upstream response now rather than whenever the generator is collected
+            try:
+                async for chunk in stream:
+                    checkpoint()
+                    if first_chunk:
+                        first_chunk = False
+                        elapsed = time.perf_counter() - started
+                        metrics.observe('first_chunk', elapsed, image_size, timings)
+                        report('stage', stage='first_chunk', elapsed_ms=int(elapsed * 1000))
+
+                    part = chunk_part(chunk)
+                    if part is None:
+                        continue
+                    if part.inline_data and part.inline_data.data:
+                        generated_files.append(
+                            await asyncio.to_thread(save_generated, part.inline_data, image_size, timings)
+                        )
+                    elif hasattr(part, 'text') and part.text:
+                        text_response += part.text
+                        report('text', text=part.text)
+            finally:
+                await stream.aclose()
+
+    try:
+        inputs = await asyncio.to_thread(
+            load_inputs, user_image_path, template_image_path, image_size, aspect_ratio, timings
+        )
+        with metrics.stage('build_request', image_size, timings):
+            contents, generate_content_config = build_request(inputs, image_size, aspect_ratio)
+
+        # Only retry while nothing has been delivered, so users never get duplicate images
+        await admission.acall(
+            stream_attempt,
+            deadline=job.deadline if job else None,
+            retryable=lambda error: not generated_files and not (job and job.cancelled()),
+            on_retry=report_retry
+        )
+    except (Exception, asyncio.CancelledError) as e:
+        # Task cancellation from the queue, or a read timeout from our own deadline
+        reason = e.reason if isinstance(e, Cancelled) else job and job.cancelled()
+        if not reason:
+            raise
+        discard_generated(generated_files)
+        if request_sent is not None:
+            metrics.CANCELLED_MODEL_SECONDS.labels(reason).inc(time.perf_counter() - request_sent)
+        if isinstance(e, Cancelled):
+            raise
+        # Raised as Cancelled so jobs sharing this result do not take it for their own cancellation
+        raise Cancelled(reason) from e
+
+    metrics.GENERATION_SECONDS.labels(image_size, os.path.basename(template_image_path)).observe(
+        time.perf_counter() - generation_started
+    )
+    return generated_files, text_response
+
+
+async def run_swap(key, user_path, template_path, image_size, aspect_ratio=None):
+    """Generate one face swap, sharing the result with identical requests"""
+    with storage.pinned(user_path):
+        while True:
+            try:
+                return await result_cache.get_or_compute_async(
+                    key,
+                    generate_face_swap,
+                    user_path,
+                    template_path,
+                    image_size=image_size,
+                    aspect_ratio=aspect_ratio
+                )
+            except Cancelled:
+                # Give up only if this job was cancelled, not the one whose result we shared
+                checkpoint()
+
+
+async def save_user_photo(upload):
+    """Store an accepted upload under its content hash and return its path
+
+    A photo identical to an earlier upload reuses that file.
+    """
+    user_path = upload_path(upload)
+    if not await asyncio.to_thread(storage.reuse, user_path):
+        upload.commit(user_path)
+        storage.touch(user_path)
+    return user_path
+
+
+def client_id():
+    """Key for per-client rate limits: the caller's address"""
+    return request.remote_addr or 'unknown'
+
+
+def overloaded_response(error, status=429):
+    """Shed a request, telling the client when it is worth trying again"""
+    return jsonify({'error': str(error), 'retry_after': error.retry_after}), status, {
+        'Retry-After': str(error.retry_after)
+    }
+
+
+def event_stream(log, since, final_event):
+    """Server-Sent Events response replaying `log` from index `since`
+
+    Once the log's owner has finished, `final_event()` supplies the payload
+    of a closing 'result' event.
+    """
+    @stream_with_context
+    async def stream():
+        index = since
+        yield 'retry: 2000\n\n'
+        # Closed when the client disconnects, which lets the job be abandoned
+        with log.watching():
+            while True:
+                events = await log.wait_events_async(index, timeout=app.config['SSE_KEEPALIVE'])
+                if not events:
+                    if log.finished:
+                        break
+                    # Comments keep proxies from timing out and surface dead clients
+                    yield ': keepalive\n\n'
+                    continue
+                for event in events:
+                    index += 1
+                    yield f"id: {index}\nevent: {event['event']}\ndata: {json.dumps(event)}\n\n"
+        yield f"event: result\ndata: {json.dumps(final_event())}\n\n"
+
+    response = Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    response.timeout = None
+    return response
+
+
+def job_payload(job):
+    """Serialize a swap job for the polling endpoints"""
+    payload = job.to_dict()
+    payload['position'] = swap_jobs.position(job)
+    payload['estimated_wait'] = round(swap_jobs.estimated_wait(job), 1)
+    payload['status_url'] = url_for('job_status', job_id=job.id)
+    payload['result_url'] = url_for('job_result', job_id=job.id)
+    payload['events_url'] = url_for('job_events', job_id=job.id)
+    return payload
+
+
+def batch_payload(batch):
+    """Serialize a batch for its polling and streaming endpoints"""
+    payload = batch.to_dict()
+    payload['status_url'] = url_for('batch_status', batch_id=batch.id)
+    payload['events_url'] = url_for('batch_events', batch_id=batch.id)
+    return payload
+
+
+async def send_immutable(folder, folder_key, filename):
+    """ImmutableFiles.send for Quart"""
+    resolved = await asyncio.to_thread(
+        immutable_files.resolve, folder, folder_key, filename, request.accept_mimetypes
+    )
+    if resolved is None:
+        abort(404)
+    path, serve_path, mimetype = resolved
+    etag = await asyncio.to_thread(file_digest, serve_path)
+
+    response = await send_file(
+        serve_path,
+        mimetype=mimetype,
+        add_etags=False,
+        last_modified=datetime.fromtimestamp(os.path.getmtime(path), timezone.utc),
+    )
+    response.set_etag(etag[:32])
+    response.cache_control.max_age = immutable_files.max_age
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    if immutable_files.formats:
+        response.vary.add('Accept')
+    return await response.make_conditional(
+        request, accept_ranges=True, complete_length=os.path.getsize(serve_path)
+    )
+
+
+@app.before_request
+async def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+async def add_server_timing(response):
+    timings = list(g.get('server_timing', []))
+    if 'request_started' in g:
+        timings.append(('app', time.perf_counter() - g.request_started))
+    if timings:
+        response.headers['Server-Timing'] = metrics.server_timing(timings)
+    return response
+
+
+# ============ USER ROUTES ============
+
+@app.route('/')
+async def index():
+    page_size = app.config['GALLERY_PAGE_SIZE']
+    templates = await asyncio.to_thread(get_templates, 0, page_size)
+    return await render_template(
+        'index.html',
+        templates=templates,
+        total_templates=len(template_index.entries()),
+        page_size=page_size,
+        aspect_ratios=ASPECT_RATIOS,
+        speculation=app.config['SPECULATION']
+    )
+
+
+@app.route('/templates')
+async def list_templates():
+    """Paginated gallery for lazy loading"""
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = min(100, max(1, request.args.get('limit', app.config['GALLERY_PAGE_SIZE'], type=int)))
+    entries, total = await asyncio.to_thread(template_index.page, offset, limit)
+    next_offset = offset + len(entries)
+    return jsonify({
+        'templates': [template_index.public(e) for e in entries],
+        'total': total,
+        'offset': offset,
+        'next_offset': next_offset if next_offset < total else None
+    })
+
+
+@app.route('/templates/thumbs/<name>')
+async def template_thumbnail(name):
+    thumb = await asyncio.to_thread(template_index.thumbnail, name)
+    if thumb is None:
+        return jsonify({'error': 'Thumbnail not found'}), 404
+    path, mime_type = thumb
+    # Names embed the template's content hash, so they never change
+    response = await send_file(path, mimetype=mime_type, cache_timeout=365 * 24 * 3600)
+    response.cache_control.immutable = True
+    return response
+
+
+@app.route('/swap', methods=['POST'])
+async def swap():
+    files = await request.files
+    form = await request.form
+    if 'user_photo' not in files:
+        return jsonify({'error': 'Please upload your photo'}), 400
+
+    user_photo = files['user_photo']
+    template_id = form.get('template_id')
+    image_size = form.get('image_size', 'x1')
+    aspect_ratio = form.get('aspect_ratio', '')
+
+    if not user_photo.filename:
+        return jsonify({'error': 'Please select a photo'}), 400
+
+    if not template_id:
+        return jsonify({'error': 'Please select a template'}), 400
+
+    if not os.environ.get("GEMINI_API_KEY"):
+        return jsonify({'error': 'GEMINI_API_KEY not configured'}), 500
+
+    # Get template path
+    template_path = os.path.join(app.config['TEMPLATES_FOLDER'], template_id)
+    if not os.path.exists(template_path):
+        return jsonify({'error': 'Template not found'}), 404
+
+    # Map image size
+    size = IMAGE_SIZES.get(image_size, "2K")
+
+    # Serve repeated requests straight from the result cache; the photo was
+    # hashed as it streamed in
+    upload = accept(user_photo)
+    timings = timing_sink()
+    with metrics.stage('hash', size, timings):
+        key = swap_key(upload.digest, template_path, size, aspect_ratio)
+        cached = result_cache.get(key)
+    session_id = history_id(session)
+
+    # A speculative generation of exactly this request already has a head
+    # start; it was admitted when it began
+    speculation = speculator.claim(session_id, key)
+    if speculation is not None:
+        job = speculation.job
+        adopt_speculation(swap_jobs, job, size)
+        await asyncio.to_thread(record_history, session_id, upload.digest, template_path, size, aspect_ratio,
+                                key, job=job)
+        if job.status == DONE:
+            return jsonify(dict(success=True, speculated=True, **swap_images(job.result)))
+        payload = dict(job_payload(job), speculated=True)
+        return jsonify(payload), 202, {'Location': payload['status_url']}
+
+    if cached:
+        await asyncio.to_thread(record_history, session_id, upload.digest, template_path, size, aspect_ratio,
+                                key, result=cached)
+        return jsonify(dict(success=True, cached=True, **swap_images(cached)))
+
+    # Then from an earlier generation for a near-identical photo, unless the
+    # client asks for a fresh one
+    signature = similar = None
+    if app.config['NEAR_DUPLICATES'] != 'off':
+        with metrics.stage('phash', size, timings):
+            signature = await asyncio.to_thread(
+                lambda: swap_signature(dhash(upload.path), template_path, size, aspect_ratio))
+            similar = near_duplicate(signature)
+        if similar and app.config['NEAR_DUPLICATES'] == 'serve' and not form.get('fresh'):
+            distance, result = similar
+            await asyncio.to_thread(record_history, session_id, upload.digest, template_path, size, aspect_ratio,
+                                    key, result=result)
+            return jsonify(dict(success=True, cached=True, near_duplicate=distance, **swap_images(result)))
+
+    try:
+        admission.admit(client_id())
+    except Overloaded as e:
+        return overloaded_response(e)
+
+    # Save user photo
+    with metrics.stage('save_upload', size, timings):
+        user_path = await save_user_photo(upload)
+    metrics.BYTES.labels('upload').inc(upload.size)
+
+    job = swap_jobs.enqueue(Job(
+        run_swap,
+        (key, user_path, template_path, size, aspect_ratio if aspect_ratio else None),
+        {},
+        timeout=app.config['SWAP_DEADLINES'].get(size),
+        lane=size,
+        client=client_id()
+    ))
+    await asyncio.to_thread(record_history, session_id, upload.digest, template_path, size, aspect_ratio, key, job=job)
+    if signature is not None:
+        near_duplicates.add(*signature, key)
+    payload = job_payload(job)
+    if similar:
+        distance, result = similar
+        payload['similar'] = dict(distance=distance, **swap_images(result))
+    return jsonify(payload), 202, {'Location': payload['status_url']}
+
+
+@app.route('/swap/speculate', methods=['POST', 'DELETE'])
+async def speculate():
+    """Start the swap the user is likely to ask for next, at low priority; see app.speculate"""
+    if not app.config['SPECULATION']:
+        return jsonify({'error': 'Speculation is disabled'}), 404
+    session_id = history_id(session)
+    if request.method == 'DELETE':
+        return jsonify({'dropped': speculator.drop(session_id)})
+
+    files = await request.files
+    form = await request.form
+    user_photo = files.get('user_photo')
+    template_id = form.get('template_id')
+    aspect_ratio = form.get('aspect_ratio', '')
+    if not user_photo or not user_photo.filename or not template_id:
+        return jsonify({'error': 'Please select a photo and a template'}), 400
+    if not os.environ.get("GEMINI_API_KEY"):
+        return jsonify({'error': 'GEMINI_API_KEY not configured'}), 500
+    template_path = os.path.join(app.config['TEMPLATES_FOLDER'], template_id)
+    if not os.path.exists(template_path):
+        return jsonify({'error': 'Template not found'}), 404
+    size = IMAGE_SIZES.get(form.get('image_size', 'x1'), "2K")
+
+    upload = accept(user_photo)
+    key = swap_key(upload.digest, template_path, size, aspect_ratio)
+    live = speculator.current(session_id, key)
+    if live is not None:
+        return jsonify(dict(speculating=True, **live.to_dict()))
+
+    reason = speculation_refusal(speculator, swap_jobs, session_id, key)
+    if reason is None:
+        try:
+            admission.admit(client_id())
+        except Overloaded:
+            reason = 'quota'
+    if reason is not None:
+        return jsonify(refuse_speculation(speculator, session_id, reason))
+
+    user_path = await save_user_photo(upload)
+    metrics.BYTES.labels('upload').inc(upload.size)
+    job = Job(
+        run_swap,
+        (key, user_path, template_path, size, aspect_ratio if aspect_ratio else None),
+        {},
+        timeout=app.config['SWAP_DEADLINES'].get(size),
+        lane=SPECULATIVE,
+        client=client_id()
+    )
+    speculation = speculator.start(session_id, key, job)
+    swap_jobs.enqueue(job)
+    return jsonify(dict(speculating=True, **speculation.to_dict())), 202
+
+
+@app.route('/history')
+async def swap_history():
+    """This browser's generations, newest first, a page at a time"""
+    if 'history_id' not in session:
+        return jsonify({'items': [], 'next_cursor': None})
+    payload = await asyncio.to_thread(
+        history_page, session['history_id'], request.args.get('cursor'), request.args.get('limit', type=int))
+    if payload is None:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    return jsonify(payload)
+
+
+@app.route('/swap/batch', methods=['POST'])
+async def swap_batch():
+    """Try one photo on several templates (and optionally sizes/aspect ratios)"""
+    files = await request.files
+    form = await request.form
+    if 'user_photo' not in files:
+        return jsonify({'error': 'Please upload your photo'}), 400
+
+    user_photo = files['user_photo']
+    template_ids = form.getlist('template_id')
+    if not template_ids:
+        template_ids = [t for t in form.get('template_ids', '').split(',') if t]
+    image_sizes = form.getlist('image_size') or ['x1']
+    aspect_ratios = form.getlist('aspect_ratio') or ['']
+
+    if not user_photo.filename:
+        return jsonify({'error': 'Please select a photo'}), 400
+
+    if not template_ids:
+        return jsonify({'error': 'Please select at least one template'}), 400
+
+    upload = accept(user_photo)
+
+    if not os.environ.get("GEMINI_API_KEY"):
+        return jsonify({'error': 'GEMINI_API_KEY not configured'}), 500
+
+    combos = []
+    for template_id in dict.fromkeys(template_ids):
+        for image_size in dict.fromkeys(image_sizes):
+            for aspect_ratio in dict.fromkeys(aspect_ratios):
+                combos.append((template_id, image_size, aspect_ratio))
+    if len(combos) > app.config['BATCH_MAX_ITEMS']:
+        return jsonify({'error': f"At most {app.config['BATCH_MAX_ITEMS']} generations per batch"}), 400
+
+    # A batch is one submission; BATCH_CONCURRENCY already caps its share of the queue
+    try:
+        admission.admit(client_id())
+    except Overloaded as e:
+        return overloaded_response(e)
+
+    user_path = None
+    photo_hash = None
+    if app.config['NEAR_DUPLICATES'] != 'off':
+        photo_hash = await asyncio.to_thread(dhash, upload.path)
+
+    batch = Batch(swap_jobs, concurrency=app.config['BATCH_CONCURRENCY'], describe=swap_images, client=client_id())
+    for template_id, image_size, aspect_ratio in combos:
+        meta = {'template_id': template_id, 'image_size': image_size, 'aspect_ratio': aspect_ratio}
+        template_path = os.path.join(app.config['TEMPLATES_FOLDER'], template_id)
+        if not os.path.exists(template_path):
+            batch.add_error('Template not found', meta=meta)
+            continue
+
+        size = IMAGE_SIZES.get(image_size, "2K")
+        key = swap_key(upload.digest, template_path, size, aspect_ratio)
+        cached = result_cache.get(key)
+        if cached:
+            batch.add_result(cached, meta=dict(meta, cached=True))
+            continue
+        if photo_hash is not None:
+            signature = await asyncio.to_thread(swap_signature, photo_hash, template_path, size, aspect_ratio)
+            similar = near_duplicate(signature)
+            if similar and app.config['NEAR_DUPLICATES'] == 'serve' and not form.get('fresh'):
+                batch.add_result(similar[1], meta=dict(meta, cached=True, near_duplicate=similar[0]))
+                continue
+            if similar:
+                meta['similar'] = dict(distance=similar[0], **swap_images(similar[1]))
+            near_duplicates.add(*signature, key)
+
+        # The photo is stored (and later preprocessed) once for the whole batch
+        if user_path is None:
+            user_path = await save_user_photo(upload)
+        batch.add(run_swap, key, user_path, template_path, size, aspect_ratio or None,
+                  meta=meta, timeout=app.config['SWAP_DEADLINES'].get(size), lane=size)
+
+    swap_batches.add(batch)
+    batch.start()
+    payload = batch_payload(batch)
+    return jsonify(payload), 200 if batch.finished else 202, {'Location': payload['status_url']}
+
+
+@app.route('/batches/<batch_id>')
+async def batch_status(batch_id):
+    batch = swap_batches.get(batch_id)
+    if batch is None:
+        return jsonify({'error': 'Batch not found'}), 404
+    batch.touch()
+    return jsonify(batch_payload(batch))
+
+
+@app.route('/batches/<batch_id>/events')
+async def batch_events(batch_id):
+    """Server-Sent Events stream of per-item results as they complete"""
+    batch = swap_batches.get(batch_id)
+    if batch is None:
+        return jsonify({'error': 'Batch not found'}), 404
+    since = request.headers.get('Last-Event-ID', 0, type=int)
+    return event_stream(batch, since, lambda: batch_payload(batch))
+
+
+@app.route('/jobs/<job_id>')
+async def job_status(job_id):
+    job = swap_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    job.touch()
+    return jsonify(job_payload(job))
+
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+async def cancel_job(job_id):
+    """Cancel a queued or running swap job, e.g. because the user left the page"""
+    job = swap_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if not swap_jobs.cancel(job, CLIENT):
+        return jsonify({'error': 'Job already finished or cancelled'}), 409
+    return jsonify(job_payload(job)), 200 if job.finished else 202
+
+
+@app.route('/jobs/<job_id>/result')
+async def job_result(job_id):
+    job = swap_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    job.touch()
+    if not job.finished:
+        return jsonify(job_payload(job)), 202
+
+    # Echo the generation's own stage timings to the client
+    timing_sink().extend(job.timings)
+    if isinstance(job.exception, Overloaded):
+        return overloaded_response(job.exception, 503)
+    if isinstance(job.exception, Cancelled):
+        return jsonify(result_payload(job)), 504 if job.exception.reason == DEADLINE else 410
+    return jsonify(result_payload(job)), 500 if job.status == 'failed' else 200
+
+
+@app.route('/jobs/<job_id>/events')
+async def job_events(job_id):
+    """Server-Sent Events stream of a swap job's progress, ending with its result"""
+    job = swap_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    # EventSource resends the last id it saw when it reconnects
+    since = request.headers.get('Last-Event-ID', 0, type=int)
+    return event_stream(job, since, lambda: result_payload(job))
+
+
+@app.route('/metrics')
+async def prometheus_metrics():
+    token = app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return jsonify({'error': 'Unauthorized'}), 401
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+
+# ============ ADMIN ROUTES ============
+
+@app.route('/admin/login', methods=['GET', 'POST'])
+async def admin_login():
+    if request.method == 'POST':
+        form = await request.form
+        username = form.get('username')
+        password = form.get('password')
+
+        if username == ADMIN_USER and password == ADMIN_PASS:
+            session['admin_logged_in'] = True
+            return redirect(url_for('admin_dashboard'))
+        else:
+            return await render_template('admin_login.html', error='Invalid credentials')
+
+    return await render_template('admin_login.html')
+
+
+@app.route('/admin/logout')
+async def admin_logout():
+    session.pop('admin_logged_in', None)
+    return redirect(url_for('admin_login'))
+
+
+@app.route('/admin')
+@admin_required
+async def admin_dashboard():
+    templates = await asyncio.to_thread(get_templates)
+    return await render_template('admin.html', templates=templates)
+
+
+@app.route('/admin/stats')
+@admin_required
+async def admin_stats():
+    return jsonify({
+        'jobs': swap_jobs.stats(),
+        'result_cache': result_cache.stats(),
+        'gemini': gemini.stats(),
+        'preprocess': preprocessor.stats(),
+        'admission': admission.stats(),
+        'storage': storage.stats(),
+        'uploads': ingestor.stats(),
+        'imports': template_importer.stats(),
+        'near_duplicates': near_duplicates.stats(),
+        'history': await asyncio.to_thread(history.stats),
+        'speculation': speculator.stats()
+    })
+
+
+@app.route('/admin/history/templates')
+@admin_required
+async def admin_history_templates():
+    days = request.args.get('days', type=float)
+    stats = await asyncio.to_thread(history.template_stats, time.time() - days * 86400 if days else None)
+    return jsonify({'templates': stats})
+
+
+@app.route('/admin/history/files/<filename>')
+@admin_required
+async def admin_history_file(filename):
+    generations = await asyncio.to_thread(history.lookup, filename)
+    if not generations:
+        return jsonify({'error': 'No history for this file'}), 404
+    return jsonify({'generations': generations})
+
+
+@app.route('/admin/upload', methods=['POST'])
+@admin_required
+async def admin_upload():
+    files = await request.files
+    if 'template' not in files:
+        return jsonify({'error': 'No file provided'}), 400
+
+    file = files['template']
+    if not file.filename:
+        return jsonify({'error': 'No file selected'}), 400
+
+    upload = accept(file)
+
+    # Rendered in the import pool, not on a thread of this process
+    entry = await asyncio.to_thread(template_importer.add, file.filename, upload)
+    body, status = template_upload_result(entry)
+    return jsonify(body), status
+
+
+@app.route(IMPORT_PATH, methods=['POST'])
+@admin_required
+async def admin_import():
+    """Start importing every image in the uploaded ZIP archives and image files"""
+    files = await request.files
+    parts = [(file.filename, file.stream) for _, file in files.items(multi=True) if file.filename]
+    if not parts:
+        return jsonify({'error': 'No file provided'}), 400
+
+    job = template_importer.start(parts)
+    return jsonify({
+        'import_id': job.id,
+        'status_url': url_for('admin_import_status', import_id=job.id)
+    }), 202
+
+
+@app.route('/admin/import/<import_id>')
+@admin_required
+async def admin_import_status(import_id):
+    job = template_importer.get(import_id)
+    if job is None:
+        return jsonify({'error': 'Import not found'}), 404
+    return jsonify(job.report())
+
+
+@app.route('/admin/delete/<filename>', methods=['DELETE'])
+@admin_required
+async def admin_delete(filename):
+    filepath = os.path.join(app.config['TEMPLATES_FOLDER'], filename)
+    if os.path.exists(filepath):
+        digest = file_digest(filepath)
+        os.remove(filepath)
+        await asyncio.to_thread(template_index.discard, digest)
+        preprocessor.discard_template_variants(digest)
+        return jsonify({'success': True})
+    return jsonify({'error': 'File not found'}), 404
+
+
+# ============ STATIC FILES ============
+
+@app.route('/static/generated/<filename>')
+async def serve_generated(filename):
+    return await send_immutable(app.config['UPLOAD_FOLDER'], 'generated', filename)
+
+
+@app.route('/static/templates_gallery/<filename>')
+async def serve_template(filename):
+    return await send_immutable(app.config['TEMPLATES_FOLDER'], 'templates_gallery', filename)
+
+
+if __name__ == '__main__':
+    app.run(debug=True, port=5000)
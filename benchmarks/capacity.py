@@ -0,0 +1,69 @@
+"""Concurrent-generation capacity of the Flask app against its ASGI variant
+
+Runs benchmarks.loadtest against both servers at rising concurrency, every
+client submitting at once and following its job over SSE as the web page
+does. The fake model is slow and the images small, so the numbers show what
+holding N generations open costs rather than CPU work. The Flask app gets
+SWAP_WORKERS equal to the concurrency level, its best case.
+
+    python -m benchmarks.capacity --levels 50,100,200,400 --latency 10 --json capacity.json
+"""
+import argparse
+import json
+import sys
+
+from benchmarks import loadtest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--levels', default='25,50,100,200')
+    parser.add_argument('--targets', default='app,asgi')
+    parser.add_argument('--latency', type=float, default=5.0)
+    parser.add_argument('--jitter', type=float, default=0.5)
+    parser.add_argument('--output-kb', type=float, default=64)
+    parser.add_argument('--photo-px', type=int, default=320)
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    rows = []
+    for target in args.targets.split(','):
+        for level in [int(n) for n in args.levels.split(',')]:
+            argv = [
+                target, '--requests', str(level), '--concurrency', str(level), '--workers', str(level),
+                '--follow', 'sse', '--calibrate', '0',
+                '--latency', str(args.latency), '--jitter', str(args.jitter),
+                '--output-kb', str(args.output_kb), '--photo-px', str(args.photo_px),
+                '--template-px', str(args.photo_px), '--timeout', str(args.timeout),
+            ]
+            print(f'{target} @ {level} concurrent...', file=sys.stderr, flush=True)
+            result = loadtest.run(loadtest.build_parser().parse_args(argv), argv)
+            rows.append({
+                'target': target,
+                'concurrency': level,
+                'completed': result['outcomes'].get('ok', 0) + result['outcomes'].get('cached', 0),
+                'error_rate': result['error_rate'],
+                'p50_ms': result['p50_ms'],
+                'p99_ms': result['p99_ms'],
+                'rps': result['rps'],
+                'peak_threads': result['server']['peak_threads'],
+                'cpu_seconds': result['server']['cpu_seconds'],
+                'rss_idle_mb': result['server']['rss_idle_mb'],
+                'peak_rss_mb': result['peak_rss_mb'],
+            })
+
+    print(f"{'target':<7}{'conc':>6}{'done':>6}{'err':>7}{'p50 ms':>10}{'p99 ms':>10}{'rps':>8}"
+          f"{'threads':>9}{'cpu s':>8}{'idle MB':>9}{'peak MB':>9}{'MB/conc':>9}")
+    for r in rows:
+        per_request = (r['peak_rss_mb'] - r['rss_idle_mb']) / r['concurrency']
+        print(f"{r['target']:<7}{r['concurrency']:>6}{r['completed']:>6}{r['error_rate']:>7}"
+              f"{r['p50_ms']!s:>10}{r['p99_ms']!s:>10}{r['rps']!s:>8}{r['peak_threads']:>9}{r['cpu_seconds']:>8}"
+              f"{r['rss_idle_mb']:>9}{r['peak_rss_mb']:>9}{per_request:>9.2f}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'options': vars(args), 'revision': loadtest.git_revision(), 'results': rows}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""Request bytes (and optionally model latency) saved by cropping to the face
+
+Normalizes every photo in the given folders for each output size twice,
+whole and through faceswap.face_crop.FaceCropper, and reports the bytes
+and pixels each version would send, whether a face was found and what
+detection cost. The detector's one-off load time is reported separately.
+
+    python -m benchmarks.face_crop                        # static/user_uploads
+    python -m benchmarks.face_crop photos/ --sizes 1K,2K --margin 0.6 --json crop.json
+
+--live also sends both versions of each photo to the real model with the
+first gallery template and times the generations. It needs GEMINI_API_KEY
+and spends quota (photos x sizes x 2 x --repeat generations).
+"""
+import argparse
+import io
+import json
+import os
+import statistics
+import sys
+import time
+
+from PIL import Image
+
+from faceswap.face_crop import FaceCropper
+from faceswap.preprocess import normalize_image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+def find_photos(folders):
+    photos = []
+    for folder in folders:
+        for name in sorted(os.listdir(folder)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                photos.append(os.path.join(folder, name))
+    return photos
+
+
+def time_generation(inputs, image_size, repeat):
+    """Median seconds for the model to finish one swap of `inputs`"""
+    import app
+
+    contents, config = app.build_request(inputs, image_size)
+    client = app.gemini.get()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in client.models.generate_content_stream(model=app.MODEL, contents=contents, config=config):
+            pass
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def measure(path, image_size, cropper, live, template, repeat):
+    from faceswap.preprocess import MAX_INPUT_EDGE
+
+    max_edge = MAX_INPUT_EDGE[image_size]
+    original = os.path.getsize(path)
+    whole, mime_type = normalize_image(path, max_edge)
+    start = time.perf_counter()
+    cropped, _ = normalize_image(path, max_edge, crop=cropper.crop)
+    crop_seconds = time.perf_counter() - start
+    whole_px = Image.open(io.BytesIO(whole)).size
+    cropped_px = Image.open(io.BytesIO(cropped)).size
+
+    row = {
+        'photo': os.path.basename(path)[:48],
+        'image_size': image_size,
+        'original_bytes': original,
+        'whole_bytes': len(whole),
+        'cropped_bytes': len(cropped),
+        'whole_px': list(whole_px),
+        'cropped_px': list(cropped_px),
+        'face_found': cropped != whole,
+        'normalize_crop_ms': round(crop_seconds * 1000, 1),
+    }
+    if live:
+        row['whole_s'] = round(time_generation((whole, mime_type) + template, image_size, repeat), 2)
+        row['cropped_s'] = round(time_generation((cropped, mime_type) + template, image_size, repeat), 2)
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('folders', nargs='*', default=[os.path.join(ROOT, 'static', 'user_uploads')])
+    parser.add_argument('--sizes', default='1K,2K')
+    parser.add_argument('--margin', type=float, default=0.6)
+    parser.add_argument('--live', action='store_true', help='also time real generations (spends quota)')
+    parser.add_argument('--repeat', type=int, default=1, help='generations per version with --live')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    photos = find_photos(args.folders)
+    if not photos:
+        parser.exit(1, f"No photos found in {', '.join(args.folders)}\n")
+
+    cropper = FaceCropper(margin=args.margin)
+    start = time.perf_counter()
+    if not cropper.warm_up():
+        parser.exit(1, "OpenCV is not available; see faceswap/face_crop.py\n")
+    load_ms = (time.perf_counter() - start) * 1000
+
+    template = None
+    if args.live:
+        sys.path.insert(0, ROOT)
+        import app
+
+        template_path = find_photos([app.app.config['TEMPLATES_FOLDER']])[0]
+        template = app.preprocessor.template_image(template_path, '2K')[:2]
+
+    rows = []
+    for path in photos:
+        for image_size in args.sizes.split(','):
+            rows.append(measure(path, image_size, cropper, args.live, template, args.repeat))
+
+    print(f"detector load: {load_ms:.0f} ms")
+    print(f"{'photo':<50}{'size':>5}{'face':>6}{'whole KB':>10}{'crop KB':>9}{'saved':>7}{'crop px':>11}{'ms':>7}"
+          + (f"{'whole s':>9}{'crop s':>8}" if args.live else ''))
+    for r in rows:
+        saved = 1 - r['cropped_bytes'] / r['whole_bytes']
+        line = (f"{r['photo']:<50}{r['image_size']:>5}{'yes' if r['face_found'] else 'no':>6}"
+                f"{r['whole_bytes'] / 1024:>10.0f}{r['cropped_bytes'] / 1024:>9.0f}{saved:>7.0%}"
+                f"{'x'.join(map(str, r['cropped_px'])):>11}{r['normalize_crop_ms']:>7}")
+        if args.live:
+            line += f"{r['whole_s']:>9}{r['cropped_s']:>8}"
+        print(line)
+
+    whole = sum(r['whole_bytes'] for r in rows)
+    cropped = sum(r['cropped_bytes'] for r in rows)
+    found = sum(r['face_found'] for r in rows)
+    print(f"\n{found}/{len(rows)} with a face; request bytes {whole / 1024:.0f} KB -> {cropped / 1024:.0f} KB "
+          f"({1 - cropped / whole:.0%} less)")
+    if args.live:
+        print(f"median generation {statistics.median(r['whole_s'] for r in rows)} s whole, "
+              f"{statistics.median(r['cropped_s'] for r in rows)} s cropped")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'options': vars(args), 'detector_load_ms': round(load_ms, 1), 'results': rows,
+                       'stats': cropper.stats()}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""Local stand-in for google.genai.Client used by the benchmarks"""
+import asyncio
+import io
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+
+def _chunk(part):
+    return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+
+def noise_jpeg(target_bytes, quality=90):
+    """A real JPEG of random noise, roughly `target_bytes` long"""
+    from PIL import Image
+
+    # Noise barely compresses, so bytes scale with pixel count
+    side = 64
+    probe = io.BytesIO()
+    Image.frombytes('RGB', (side, side), os.urandom(side * side * 3)).save(probe, 'JPEG', quality=quality)
+    side = max(16, int(side * (target_bytes / probe.tell()) ** 0.5))
+    out = io.BytesIO()
+    Image.frombytes('RGB', (side, side), os.urandom(side * side * 3)).save(out, 'JPEG', quality=quality)
+    return out.getvalue()
+
+
+def fake_error(code=503):
+    """An error shaped like the ones the SDK raises for a failed API call"""
+    from google.genai import errors
+    body = {'error': {'code': code, 'message': 'Injected by fake_gemini', 'status': 'UNAVAILABLE'}}
+    if code >= 500:
+        return errors.ServerError(code, body)
+    return errors.ClientError(code, body)
+
+
+class FakeModels:
+    def __init__(self, image_bytes, mime_type='image/png'):
+        self.image_bytes = image_bytes
+        self.mime_type = mime_type
+        self._random = random.Random(FakeClient.seed)
+        self._lock = threading.Lock()
+
+    def _roll(self):
+        with self._lock:
+            FakeClient.calls += 1
+            delay = max(0.0, FakeClient.latency + self._random.uniform(-FakeClient.jitter, FakeClient.jitter))
+            failed = self._random.random() < FakeClient.error_rate
+        return delay, failed
+
+    def _image_chunk(self):
+        return _chunk(SimpleNamespace(
+            inline_data=SimpleNamespace(data=self.image_bytes, mime_type=self.mime_type),
+            text=None,
+        ))
+
+    def generate_content_stream(self, model, contents, config):
+        delay, failed = self._roll()
+        time.sleep(delay)
+        if failed:
+            raise fake_error(FakeClient.error_code)
+        for _ in range(FakeClient.text_chunks):
+            yield _chunk(SimpleNamespace(inline_data=None, text="Here is your image."))
+            time.sleep(FakeClient.chunk_interval)
+        yield self._image_chunk()
+
+    def get(self, model):
+        return SimpleNamespace(name=model)
+
+
+class FakeAsyncModels(FakeModels):
+    """client.aio.models: same behaviour, sleeping on the event loop"""
+
+    async def generate_content_stream(self, model, contents, config):
+        delay, failed = self._roll()
+        await asyncio.sleep(delay)
+        if failed:
+            raise fake_error(FakeClient.error_code)
+        return self._stream()
+
+    async def _stream(self):
+        for _ in range(FakeClient.text_chunks):
+            yield _chunk(SimpleNamespace(inline_data=None, text="Here is your image."))
+            await asyncio.sleep(FakeClient.chunk_interval)
+        yield self._image_chunk()
+
+    async def get(self, model):
+        return SimpleNamespace(name=model)
+
+
+class FakeClient:
+    """Drop-in for genai.Client that streams one image of a fixed size
+
+    Time to first chunk is `latency` +/- `jitter` seconds, followed by
+    `text_chunks` text parts `chunk_interval` apart and then the image.
+    A fraction `error_rate` of calls raise an SDK error instead.
+    """
+
+    image_size = 8 * 1024 * 1024
+    image_format = None
+    latency = 0.0
+    jitter = 0.0
+    error_rate = 0.0
+    error_code = 503
+    text_chunks = 1
+    chunk_interval = 0.0
+    seed = None
+    calls = 0
+
+    _payload = None
+
+    def __init__(self, *args, **kwargs):
+        self.models = FakeModels(*self.payload())
+        self.aio = SimpleNamespace(models=FakeAsyncModels(*self.payload()))
+
+    @classmethod
+    def payload(cls):
+        """Image bytes shared by every client, generated once per configuration"""
+        key = (cls.image_size, cls.image_format)
+        if cls._payload is None or cls._payload[0] != key:
+            if cls.image_format == 'jpeg':
+                cls._payload = (key, noise_jpeg(cls.image_size), 'image/jpeg')
+            else:
+                cls._payload = (key, os.urandom(cls.image_size), 'image/png')
+        return cls._payload[1:]
+
+
+def install(image_size=None, **options):
+    """Replace genai.Client process-wide so no request leaves the machine
+
+    Keyword options override the FakeClient class attributes of the same name.
+    """
+    from google import genai
+    if image_size is not None:
+        FakeClient.image_size = image_size
+    for name, value in options.items():
+        if not hasattr(FakeClient, name) or name.startswith('_'):
+            raise TypeError(f'Unknown fake_gemini option: {name}')
+        setattr(FakeClient, name, value)
+    genai.Client = FakeClient
+    return FakeClient
@@ -0,0 +1,492 @@
+"""Load test of the Flask app or the Netlify function against a fake Gemini
+
+Drives POST /swap on the Flask app (`app`) or its ASGI variant (`asgi`),
+following each job to its result, or the Netlify `handler`, at a fixed
+concurrency and reports latency percentiles,
+throughput, error rate, peak RSS and heap bytes per request. Nothing
+leaves the machine: genai.Client is replaced by benchmarks.fake_gemini.
+
+    python -m benchmarks.loadtest app --requests 200 --concurrency 16 --latency 2 --jitter 0.5
+    python -m benchmarks.loadtest asgi --requests 200 --concurrency 200 --follow sse
+    python -m benchmarks.loadtest netlify --requests 50 --concurrency 4 --json after.json --compare before.json
+
+The app runs in a subprocess (threaded werkzeug for `app`, uvicorn for
+`asgi`) inside a scratch directory, so uploads and results never touch the
+checkout. Admission limits are lifted unless --admission is given.
+"""
+import argparse
+import base64
+import importlib.util
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Numbers compared by --compare, and whether bigger is better
+COMPARED = {
+    'p50_ms': False,
+    'p95_ms': False,
+    'p99_ms': False,
+    'rps': True,
+    'error_rate': False,
+    'peak_rss_mb': False,
+    'heap_peak_per_request_mb': False,
+}
+
+
+def max_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 2)
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], cwd=ROOT, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_photo(px, quality=90):
+    from PIL import Image
+    img = Image.effect_noise((px, px * 3 // 4), 64).convert('RGB')
+    out = io.BytesIO()
+    img.save(out, 'JPEG', quality=quality)
+    return out.getvalue()
+
+
+class Photos:
+    """Distinct but valid JPEGs, so every request misses the result cache
+
+    Bytes after the JPEG end-of-image marker are ignored by decoders but
+    change the content hash. A `repeat` fraction of requests reuse one photo.
+    """
+
+    def __init__(self, px, repeat=0.0):
+        self.base = make_photo(px)
+        self.repeat = repeat
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def next(self):
+        with self._lock:
+            self._count += 1
+            n = self._count
+        if self.repeat and (n * self.repeat) % 1 < self.repeat:
+            return self.base
+        return self.base + n.to_bytes(8, 'big')
+
+
+def prepare_workdir(template_px):
+    """Scratch tree that imports the real code but keeps its own static/ and cache/"""
+    workdir = tempfile.mkdtemp(prefix='faceswap-bench-')
+    for name in ('app.py', 'asgi_app.py', 'faceswap', 'templates'):
+        os.symlink(os.path.join(ROOT, name), os.path.join(workdir, name))
+    os.makedirs(os.path.join(workdir, 'netlify', 'functions'))
+    os.symlink(os.path.join(ROOT, 'netlify', 'functions', 'generate.py'),
+               os.path.join(workdir, 'netlify', 'functions', 'generate.py'))
+    gallery = os.path.join(workdir, 'static', 'templates_gallery')
+    os.makedirs(gallery)
+    with open(os.path.join(gallery, 'bench.jpg'), 'wb') as f:
+        f.write(make_photo(template_px))
+    return workdir
+
+
+def install_fake(args):
+    sys.path.insert(0, ROOT)
+    from benchmarks import fake_gemini
+    os.environ.setdefault('GEMINI_API_KEY', 'bench')
+    return fake_gemini.install(
+        image_size=int(args.output_kb * 1024),
+        image_format='jpeg',
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        chunk_interval=args.chunk_interval,
+        seed=args.seed,
+    )
+
+
+# ============ APP SERVER (subprocess) ============
+
+class ServerProbe:
+    """Benchmark-only endpoints added to the app under test"""
+
+    def __init__(self, module, fake):
+        self.module = module
+        self.fake = fake
+        self.rss_idle = max_rss_mb()
+        self.peak_threads = threading.active_count()
+        threading.Thread(target=self._sample_threads, daemon=True).start()
+
+    def _sample_threads(self):
+        while True:
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            time.sleep(0.05)
+
+    def trace(self, action):
+        # Serial calibration requests bracket themselves with start/stop
+        if action == 'start':
+            tracemalloc.start()
+            tracemalloc.reset_peak()
+            return {'tracing': True}
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {'heap_peak_bytes': peak}
+
+    def stats(self):
+        return {
+            'rss_idle_mb': self.rss_idle,
+            'peak_rss_mb': max_rss_mb(),
+            'peak_threads': self.peak_threads,
+            'cpu_seconds': round(sum(resource.getrusage(resource.RUSAGE_SELF)[:2]), 2),
+            'fake_calls': self.fake.calls,
+            'jobs': self.module.swap_jobs.stats(),
+            'result_cache': self.module.result_cache.stats(),
+            'gemini': self.module.gemini.stats(),
+        }
+
+
+def serve(args):
+    """Run the app on an ephemeral port and print the port for the driver"""
+    import logging
+    import socket
+
+    fake = install_fake(args)
+    os.chdir(args.serve)
+    sys.path.insert(0, args.serve)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    if args.target == 'asgi':
+        import asgi_app as module
+        import uvicorn
+        from quart import jsonify, request
+        probe = ServerProbe(module, fake)
+
+        async def trace():
+            return jsonify(probe.trace(request.args.get('action')))
+
+        async def stats():
+            return jsonify(probe.stats())
+
+        module.app.add_url_rule('/__bench__/trace', 'bench_trace', trace)
+        module.app.add_url_rule('/__bench__/stats', 'bench_stats', stats)
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        print(sock.getsockname()[1], flush=True)
+        config = uvicorn.Config(module.app, log_level='warning', backlog=4096)
+        uvicorn.Server(config).run(sockets=[sock])
+        return
+
+    import app as module
+    from flask import jsonify, request
+    from werkzeug.serving import make_server
+    probe = ServerProbe(module, fake)
+    module.app.add_url_rule('/__bench__/trace', 'bench_trace',
+                            lambda: jsonify(probe.trace(request.args.get('action'))))
+    module.app.add_url_rule('/__bench__/stats', 'bench_stats', lambda: jsonify(probe.stats()))
+    server = make_server('127.0.0.1', 0, module.app, threaded=True)
+    server.socket.listen(4096)
+    print(server.server_port, flush=True)
+    server.serve_forever()
+
+
+def follow_poll(client, response, args, deadline):
+    """Poll a 202 job until it finishes and return the final response"""
+    url = response.json()['result_url']
+    while True:
+        response = client.get(url)
+        if response.status_code != 202:
+            return response
+        if time.monotonic() > deadline:
+            raise TimeoutError('Job did not finish in time')
+        time.sleep(args.poll_interval)
+
+
+def follow_sse(client, response, args, deadline):
+    """Follow a 202 job over its event stream, as the web page does
+
+    Returns the 'result' event payload and an HTTP-like status for it.
+    """
+    with client.stream('GET', response.json()['events_url']) as stream:
+        event = None
+        for line in stream.iter_lines():
+            if line.startswith('event: '):
+                event = line[7:]
+            elif line.startswith('data: ') and event == 'result':
+                payload = json.loads(line[6:])
+                return payload, 200 if payload.get('success') else 500
+            if time.monotonic() > deadline:
+                raise TimeoutError('Job did not finish in time')
+    raise ConnectionError('Event stream ended without a result')
+
+
+def swap_once(client, photos, args):
+    """One end-to-end swap; returns (seconds, outcome, bytes received)"""
+    start = time.monotonic()
+    deadline = start + args.timeout
+    response = client.post('/swap', files={'user_photo': ('bench.jpg', photos.next(), 'image/jpeg')},
+                           data={'template_id': 'bench.jpg', 'image_size': args.image_size})
+    status = response.status_code
+    outcome = 'cached' if status == 200 else 'ok'
+    payload = response.json() if status == 200 else None
+    if status == 202:
+        if args.follow == 'sse':
+            payload, status = follow_sse(client, response, args, deadline)
+        else:
+            response = follow_poll(client, response, args, deadline)
+            status = response.status_code
+            payload = response.json() if status == 200 else None
+    received = 0
+    if status == 200:
+        for url in payload.get('images', []):
+            received += len(client.get(url).content)
+    else:
+        outcome = f'http_{status}'
+    return time.monotonic() - start, outcome, received
+
+
+def run_server(args):
+    """Benchmark the Flask (app) or Quart (asgi) application over HTTP"""
+    import httpx
+
+    workdir = prepare_workdir(args.template_px)
+    env = dict(os.environ, SWAP_WORKERS=str(args.workers), ASYNC_CONCURRENCY=str(args.workers),
+               PYTHONDONTWRITEBYTECODE='1')
+    if not args.admission:
+        # Every benchmark client shares one address, so lift the limits unless they are under test
+        env.update(CLIENT_RATE='0', MODEL_RATE='0', MAX_QUEUE='0')
+    cmd = [sys.executable, '-m', 'benchmarks.loadtest', args.target, '--serve', workdir] + passthrough(args)
+    server = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.PIPE, text=True)
+    try:
+        port = int(server.stdout.readline())
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        with httpx.Client(base_url=f'http://127.0.0.1:{port}', limits=limits, timeout=args.timeout) as client:
+            photos = Photos(args.photo_px, args.repeat)
+
+            # Serial requests under tracemalloc: peak Python heap of one swap
+            peaks = []
+            for _ in range(args.calibrate):
+                client.get('/__bench__/trace', params={'action': 'start'})
+                swap_once(client, photos, args)
+                peaks.append(client.get('/__bench__/trace', params={'action': 'stop'}).json()['heap_peak_bytes'])
+
+            samples = drive(lambda: swap_once(client, photos, args), args)
+            server_stats = client.get('/__bench__/stats').json()
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return summarize(args, samples, peaks, server_stats)
+
+
+# ============ NETLIFY FUNCTION ============
+
+def run_netlify(args):
+    """Call the handler in this process; the parent runs us as a fresh child"""
+    fake = install_fake(args)
+    workdir = prepare_workdir(args.template_px)
+    os.chdir(workdir)
+    path = os.path.join(workdir, 'netlify', 'functions', 'generate.py')
+    spec = importlib.util.spec_from_file_location('bench_generate', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    rss_idle = max_rss_mb()
+
+    photos = Photos(args.photo_px, args.repeat)
+
+    def invoke():
+        body = json.dumps({
+            'user_photo': base64.b64encode(photos.next()).decode('ascii'),
+            'template_id': 'bench.jpg',
+            'image_size': args.image_size,
+        })
+        start = time.monotonic()
+        response = module.handler({'httpMethod': 'POST', 'body': body}, None)
+        elapsed = time.monotonic() - start
+        if response['statusCode'] != 200:
+            return elapsed, f"http_{response['statusCode']}", 0
+        return elapsed, 'ok', len(response['body'])
+
+    peaks = []
+    for _ in range(args.calibrate):
+        tracemalloc.start()
+        invoke()
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    samples = drive(invoke, args)
+    shutil.rmtree(workdir, ignore_errors=True)
+    return summarize(args, samples, peaks, {
+        'rss_idle_mb': rss_idle,
+        'peak_rss_mb': max_rss_mb(),
+        'fake_calls': fake.calls,
+        'gemini': module.gemini.stats(),
+    })
+
+
+# ============ DRIVER ============
+
+def drive(request_once, args):
+    """Run `args.requests` calls of `request_once` at `args.concurrency`"""
+    def timed():
+        try:
+            return request_once()
+        except Exception as e:
+            return None, type(e).__name__, 0
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda _: timed(), range(args.requests)))
+    return {'wall_seconds': time.monotonic() - start, 'results': results}
+
+
+def summarize(args, samples, peaks, server_stats):
+    results = samples['results']
+    latencies = [r[0] * 1000 for r in results if r[0] is not None and r[1] in ('ok', 'cached')]
+    outcomes = {}
+    for _, outcome, _ in results:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    failed = sum(n for outcome, n in outcomes.items() if outcome not in ('ok', 'cached'))
+    heap_peak = sorted(peaks)[len(peaks) // 2] if peaks else None
+    payload = args.photo_bytes + int(args.output_kb * 1024)
+
+    def ms(value):
+        return None if value is None else round(value, 1)
+
+    return {
+        'target': args.target,
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'options': {k: v for k, v in vars(args).items() if k not in ('serve', 'child', 'json', 'compare')},
+        'requests': len(results),
+        'outcomes': outcomes,
+        'error_rate': round(failed / len(results), 4) if results else 0,
+        'wall_seconds': round(samples['wall_seconds'], 3),
+        'rps': round(len(latencies) / samples['wall_seconds'], 2) if samples['wall_seconds'] else None,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'max_ms': ms(max(latencies) if latencies else None),
+        'bytes_received': sum(r[2] for r in results),
+        'heap_peak_per_request_mb': None if heap_peak is None else round(heap_peak / 1024 / 1024, 2),
+        # Heap peak over the request's own payload: roughly how many copies are live at once
+        'payload_copies': None if heap_peak is None else round(heap_peak / payload, 2),
+        'peak_rss_mb': server_stats.get('peak_rss_mb'),
+        'server': server_stats,
+    }
+
+
+def report(result, baseline=None):
+    print(f"{result['target']} @ {result['revision']}: {result['requests']} requests, "
+          f"concurrency {result['options']['concurrency']}, outcomes {result['outcomes']}")
+    for key, higher_is_better in COMPARED.items():
+        line = f'  {key:<26}{result[key]!s:>12}'
+        if baseline and baseline.get(key) not in (None, 0) and result[key] is not None:
+            change = (result[key] - baseline[key]) / baseline[key] * 100
+            better = change > 0 if higher_is_better else change < 0
+            line += f'  (was {baseline[key]}, {change:+.1f}%{"" if abs(change) < 1 else " better" if better else " worse"})'
+        print(line)
+
+
+def passthrough(args):
+    """Fake-client options forwarded to the server or child process"""
+    out = []
+    for name in ('latency', 'jitter', 'error_rate', 'chunk_interval', 'output_kb', 'template_px', 'seed'):
+        value = getattr(args, name)
+        if value is not None:
+            out += ['--' + name.replace('_', '-'), str(value)]
+    return out
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('target', choices=('app', 'asgi', 'netlify'))
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=4,
+                        help='SWAP_WORKERS for app, ASYNC_CONCURRENCY for asgi')
+    parser.add_argument('--follow', choices=('poll', 'sse'), default='poll',
+                        help='how clients wait for a queued job')
+    parser.add_argument('--admission', action='store_true', help='keep the admission limits on')
+    parser.add_argument('--latency', type=float, default=1.0, help='fake time to first chunk, seconds')
+    parser.add_argument('--jitter', type=float, default=0.25, help='+/- seconds added to the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of fake calls that fail')
+    parser.add_argument('--chunk-interval', type=float, default=0.0, help='seconds between streamed chunks')
+    parser.add_argument('--output-kb', type=float, default=1024, help='size of the fake generated image')
+    parser.add_argument('--photo-px', type=int, default=1600, help='width of the uploaded noise photo')
+    parser.add_argument('--template-px', type=int, default=1600, help='width of the noise template')
+    parser.add_argument('--image-size', default='x1', help='x1, 2k or 4k, as the form sends it')
+    parser.add_argument('--repeat', type=float, default=0.0, help='fraction of requests reusing one photo')
+    parser.add_argument('--calibrate', type=int, default=3, help='serial requests measured with tracemalloc')
+    parser.add_argument('--poll-interval', type=float, default=0.05)
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--compare', help='earlier --json output to compare against')
+    parser.add_argument('--serve', help=argparse.SUPPRESS)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    return parser
+
+
+def run(args, argv):
+    """Result dict for parsed `args`; `argv` re-launches the Netlify child"""
+    args.photo_bytes = len(make_photo(args.photo_px))
+    if args.target != 'netlify':
+        return run_server(args)
+    # Fresh interpreter so RSS reflects only the function
+    out = subprocess.check_output([sys.executable, '-m', 'benchmarks.loadtest'] + argv + ['--child'], cwd=ROOT,
+                                  text=True, env=dict(os.environ, PYTHONDONTWRITEBYTECODE='1'))
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    args = build_parser().parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+    if args.child:
+        args.photo_bytes = len(make_photo(args.photo_px))
+        print(json.dumps(run_netlify(args)))
+        return
+
+    result = run(args, sys.argv[1:])
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(result, baseline)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""Build time and query latency of the near-duplicate photo index
+
+Fills faceswap.similar.HammingIndex with random 64-bit hashes at each size,
+then times radius queries: half are stored hashes with a few bits flipped
+(the re-compressed selfie), half are unrelated (the usual miss). A linear
+scan over the same hashes is timed on a sample of queries as the baseline,
+and its answers check that the index misses nothing. A last section times
+dhash() on synthetic photos and shows how far re-encoding moves the hash.
+
+    python -m benchmarks.near_duplicates --sizes 10000,100000,500000 --radius 6
+    python -m benchmarks.near_duplicates --json near_duplicates.json
+"""
+import argparse
+import io
+import json
+import random
+import resource
+import statistics
+import time
+
+from faceswap.similar import HASH_BITS, HammingIndex, dhash, hamming
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def flip(value, bits, rng):
+    for bit in rng.sample(range(HASH_BITS), bits):
+        value ^= 1 << bit
+    return value
+
+
+def bench_index(size, radius, queries, scan_queries, rng):
+    hashes = [rng.getrandbits(HASH_BITS) for _ in range(size)]
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    index = HammingIndex()
+    for i, value in enumerate(hashes):
+        index.add(value, i)
+    build = time.perf_counter() - start
+    rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+
+    probes = []
+    for n in range(queries):
+        if n % 2:
+            probes.append(rng.getrandbits(HASH_BITS))
+        else:
+            probes.append(flip(hashes[rng.randrange(size)], rng.randint(0, radius), rng))
+
+    latencies = []
+    found = 0
+    for probe in probes:
+        start = time.perf_counter()
+        matches = index.search(probe, radius)
+        latencies.append(time.perf_counter() - start)
+        found += bool(matches)
+
+    scan = []
+    missed = 0
+    for probe in probes[:scan_queries]:
+        start = time.perf_counter()
+        expected = sorted(i for i, value in enumerate(hashes) if hamming(value, probe) <= radius)
+        scan.append(time.perf_counter() - start)
+        missed += len(set(expected) - {i for _, i in index.search(probe, radius)})
+
+    return {
+        'entries': size,
+        'radius': radius,
+        'build_s': round(build, 3),
+        'build_us_per_entry': round(build / size * 1e6, 2),
+        'rss_growth_mb': round(rss_growth / 1024, 1),
+        'query_p50_us': round(percentile(latencies, 50) * 1e6, 1),
+        'query_p99_us': round(percentile(latencies, 99) * 1e6, 1),
+        'query_mean_us': round(statistics.mean(latencies) * 1e6, 1),
+        'hit_rate': round(found / len(probes), 3),
+        'scan_p50_ms': round(percentile(scan, 50) * 1e3, 2) if scan else None,
+        'missed_vs_scan': missed,
+    }
+
+
+def synthetic_photo(seed, size):
+    from PIL import Image, ImageDraw, ImageFilter
+
+    rng = random.Random(seed)
+    width, height = size
+    image = Image.new('RGB', size, tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.ellipse((x, y, x + rng.randrange(width // 20, width // 2), y + rng.randrange(height // 20, height // 2)),
+                     fill=tuple(rng.randrange(256) for _ in range(3)))
+    return image.filter(ImageFilter.GaussianBlur(4))
+
+
+def encode(image, fmt='JPEG', **options):
+    out = io.BytesIO()
+    image.save(out, fmt, **options)
+    return out.getvalue()
+
+
+def bench_hashing(photos, size):
+    """dhash() cost and the distance each kind of re-encoding introduces"""
+    edits = {
+        'jpeg q55': lambda image: encode(image, quality=55),
+        'half size': lambda image: encode(image.resize((image.width // 2, image.height // 2)), quality=85),
+        'png': lambda image: encode(image, 'PNG'),
+        'crop 2%': lambda image: encode(image.crop((image.width // 100, image.height // 100,
+                                                    image.width * 99 // 100, image.height * 99 // 100)), quality=85),
+    }
+    timings = []
+    distances = {name: [] for name in edits}
+    hashes = []
+    for seed in range(photos):
+        image = synthetic_photo(seed, size)
+        original = encode(image, quality=92)
+        start = time.perf_counter()
+        value = dhash(original)
+        timings.append(time.perf_counter() - start)
+        hashes.append(value)
+        for name, edit in edits.items():
+            distances[name].append(hamming(value, dhash(edit(image))))
+    unrelated = [hamming(a, b) for i, a in enumerate(hashes) for b in hashes[i + 1:]]
+    return {
+        'photo_px': list(size),
+        'dhash_ms_p50': round(percentile(timings, 50) * 1e3, 2),
+        'max_distance': {name: max(values) for name, values in distances.items()},
+        'unrelated_min_distance': min(unrelated) if unrelated else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='10000,100000,500000')
+    parser.add_argument('--radius', type=int, default=6)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--scan-queries', type=int, default=20, help='queries also answered by a linear scan')
+    parser.add_argument('--photos', type=int, default=12, help='synthetic photos for the hashing section, 0 to skip')
+    parser.add_argument('--photo-px', default='1200x1600')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    rows = [bench_index(int(size), args.radius, args.queries, args.scan_queries, rng)
+            for size in args.sizes.split(',')]
+
+    print(f"{'entries':>9}{'build s':>9}{'us/add':>8}{'RSS MB':>8}{'p50 us':>9}{'p99 us':>9}"
+          f"{'hits':>7}{'scan ms':>9}{'missed':>8}")
+    for r in rows:
+        print(f"{r['entries']:>9}{r['build_s']:>9}{r['build_us_per_entry']:>8}{r['rss_growth_mb']:>8}"
+              f"{r['query_p50_us']:>9}{r['query_p99_us']:>9}{r['hit_rate']:>7}{r['scan_p50_ms']!s:>9}"
+              f"{r['missed_vs_scan']:>8}")
+
+    hashing = None
+    if args.photos:
+        width, height = (int(n) for n in args.photo_px.split('x'))
+        hashing = bench_hashing(args.photos, (width, height))
+        edits = ', '.join(f"{name} {distance}" for name, distance in hashing['max_distance'].items())
+        print(f"\ndhash of a {args.photo_px} JPEG: {hashing['dhash_ms_p50']} ms (p50)")
+        print(f"max bits moved by re-encoding: {edits}")
+        print(f"closest unrelated photos: {hashing['unrelated_min_distance']} bits apart")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'options': vars(args), 'index': rows, 'hashing': hashing}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
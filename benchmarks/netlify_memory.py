@@ -0,0 +1,112 @@
+"""Peak memory per request of the Netlify generate function
+
+Runs the handler from two git revisions (default: the baseline commit and
+the working tree) in fresh subprocesses against a fake Gemini client, and
+reports Python heap peak (tracemalloc) and peak RSS for one request.
+
+    python -m benchmarks.netlify_memory --input-mb 12 --output-mb 8
+    python -m benchmarks.netlify_memory --before HEAD~1 --json results.json
+"""
+import argparse
+import base64
+import importlib.util
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FUNCTION = 'netlify/functions/generate.py'
+
+
+def load_source(rev):
+    if rev == 'WORKTREE':
+        with open(os.path.join(ROOT, FUNCTION)) as f:
+            return f.read()
+    return subprocess.check_output(['git', 'show', f'{rev}:{FUNCTION}'], cwd=ROOT, text=True)
+
+
+def run_once(rev, input_mb, output_mb):
+    """Execute one request in this process and return its memory figures"""
+    sys.path.insert(0, ROOT)
+    from benchmarks import fake_gemini
+    fake_gemini.install(image_size=int(output_mb * 1024 * 1024))
+
+    workdir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(workdir, 'static', 'templates_gallery'))
+    with open(os.path.join(workdir, 'static', 'templates_gallery', 'tpl.jpg'), 'wb') as f:
+        f.write(os.urandom(int(input_mb * 1024 * 1024)))
+    os.chdir(workdir)
+
+    # Write the function where its relative import of the repo root still works
+    path = os.path.join(ROOT, 'netlify', 'functions', f'_bench_{os.getpid()}.py')
+    with open(path, 'w') as f:
+        f.write(load_source(rev))
+    try:
+        spec = importlib.util.spec_from_file_location('bench_generate', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        os.remove(path)
+
+    photo = base64.b64encode(os.urandom(int(input_mb * 1024 * 1024))).decode('ascii')
+    event = {
+        'httpMethod': 'POST',
+        'isBase64Encoded': True,
+        'body': base64.b64encode(json.dumps({'user_photo': photo, 'template_id': 'tpl.jpg'}).encode()),
+    }
+    del photo
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    response = module.handler(event, None)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return {
+        'rev': rev,
+        'status': response['statusCode'],
+        'response_bytes': len(response['body']),
+        'heap_peak_mb': round(peak / 1024 / 1024, 2),
+        'rss_growth_mb': round((rss_after - rss_before) / 1024, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--before', default=None, help='git revision to compare against (default: root commit)')
+    parser.add_argument('--after', default='WORKTREE')
+    parser.add_argument('--input-mb', type=float, default=12)
+    parser.add_argument('--output-mb', type=float, default=8)
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_once(args.child, args.input_mb, args.output_mb)))
+        return
+
+    before = args.before or subprocess.check_output(
+        ['git', 'rev-list', '--max-parents=0', 'HEAD'], cwd=ROOT, text=True).split()[0]
+    results = []
+    for rev in (before, args.after):
+        out = subprocess.check_output([
+            sys.executable, '-m', 'benchmarks.netlify_memory', '--child', rev,
+            '--input-mb', str(args.input_mb), '--output-mb', str(args.output_mb),
+        ], cwd=ROOT, text=True)
+        results.append(json.loads(out.strip().splitlines()[-1]))
+
+    for r in results:
+        print(f"{r['rev'][:12]:>12}  status={r['status']}  heap peak {r['heap_peak_mb']:>8} MB  "
+              f"RSS growth {r['rss_growth_mb']:>8} MB")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'input_mb': args.input_mb, 'output_mb': args.output_mb, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
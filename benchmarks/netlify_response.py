@@ -0,0 +1,146 @@
+"""Response size and serialization time of the Netlify generate function
+
+Runs the handler from two git revisions (default: HEAD and the working
+tree) in fresh subprocesses against a fake Gemini client that returns a
+JPEG of each output size, and reports the response body size, the
+`serialize`, `store` and `preview` stages from its Server-Timing header, the whole
+handler time and how long a client takes to parse the body.
+
+    python -m benchmarks.netlify_response
+    python -m benchmarks.netlify_response --sizes 2K=6,4K=20 --runs 5 --json response.json
+
+Generated images go to a scratch object store, never the checkout.
+"""
+import argparse
+import base64
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.netlify_memory import load_source
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Typical generated image sizes in MB; Gemini returns 2K and 4K outputs of several MB
+DEFAULT_SIZES = '1K=1.5,2K=5,4K=16'
+
+
+def parse_sizes(value):
+    sizes = {}
+    for item in value.split(','):
+        name, _, mb = item.partition('=')
+        sizes[name.strip().upper()] = float(mb)
+    return sizes
+
+
+def stage_ms(header, name):
+    """Total milliseconds of stage `name` in a Server-Timing header"""
+    total = 0.0
+    for entry in header.split(','):
+        stage, _, duration = entry.strip().partition(';dur=')
+        if stage == name:
+            total += float(duration)
+    return round(total, 1)
+
+
+def run_child(rev, size, output_mb, runs):
+    """Time `runs` requests for one output size in this process"""
+    sys.path.insert(0, ROOT)
+    from benchmarks import fake_gemini
+    fake_gemini.install(image_size=int(output_mb * 1024 * 1024), image_format='jpeg', latency=0.0)
+
+    workdir = tempfile.mkdtemp()
+    os.environ['OBJECT_STORE_DIR'] = os.path.join(workdir, 'generated')
+    os.environ.setdefault('OBJECT_STORE', 'local')
+    os.makedirs(os.path.join(workdir, 'static', 'templates_gallery'))
+    with open(os.path.join(workdir, 'static', 'templates_gallery', 'tpl.jpg'), 'wb') as f:
+        f.write(fake_gemini.noise_jpeg(200_000))
+    os.chdir(workdir)
+
+    # Write the function where its relative import of the repo root still works
+    path = os.path.join(ROOT, 'netlify', 'functions', f'_bench_{os.getpid()}.py')
+    with open(path, 'w') as f:
+        f.write(load_source(rev))
+    try:
+        spec = importlib.util.spec_from_file_location('bench_generate', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        os.remove(path)
+
+    photo = base64.b64encode(fake_gemini.noise_jpeg(200_000)).decode('ascii')
+    event = {
+        'httpMethod': 'POST',
+        'body': json.dumps({'user_photo': photo, 'template_id': 'tpl.jpg', 'image_size': size.lower()}),
+    }
+
+    samples = []
+    for _ in range(runs + 1):
+        start = time.perf_counter()
+        response = module.handler(event, None)
+        handler_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        json.loads(response['body'])
+        parse_ms = (time.perf_counter() - start) * 1000
+        timing = response.get('headers', {}).get('Server-Timing', '')
+        samples.append({
+            'status': response['statusCode'],
+            'response_bytes': len(response['body']),
+            'serialize_ms': stage_ms(timing, 'serialize'),
+            'store_ms': stage_ms(timing, 'store'),
+            'preview_ms': stage_ms(timing, 'preview'),
+            'handler_ms': handler_ms,
+            'client_parse_ms': parse_ms,
+        })
+    # The first request also pays for lazy imports; leave it out
+    samples = samples[1:]
+
+    result = {'rev': rev, 'size': size, 'output_mb': output_mb, 'status': samples[0]['status']}
+    for key in ('response_bytes', 'serialize_ms', 'store_ms', 'preview_ms', 'handler_ms', 'client_parse_ms'):
+        result[key] = round(statistics.median(s[key] for s in samples), 1)
+    result['response_bytes'] = int(result['response_bytes'])
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--before', default='HEAD', help='git revision to compare against')
+    parser.add_argument('--after', default='WORKTREE')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='output size=MB pairs')
+    parser.add_argument('--runs', type=int, default=3, help='requests per size (median)')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--child', nargs=3, metavar=('REV', 'SIZE', 'MB'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        rev, size, output_mb = args.child
+        print(json.dumps(run_child(rev, size, float(output_mb), args.runs)))
+        return
+
+    env = dict(os.environ, GEMINI_API_KEY=os.environ.get('GEMINI_API_KEY', 'benchmark'))
+    results = []
+    for size, output_mb in parse_sizes(args.sizes).items():
+        for rev in (args.before, args.after):
+            out = subprocess.check_output([
+                sys.executable, '-m', 'benchmarks.netlify_response', '--child', rev, size, str(output_mb),
+                '--runs', str(args.runs),
+            ], cwd=ROOT, env=env, text=True)
+            results.append(json.loads(out.strip().splitlines()[-1]))
+
+    print(f"{'size':<6}{'revision':>12}{'status':>8}{'response':>14}{'serialize ms':>14}"
+          f"{'store ms':>10}{'preview ms':>12}{'handler ms':>12}{'parse ms':>10}")
+    for r in results:
+        print(f"{r['size']:<6}{r['rev'][:12]:>12}{r['status']:>8}{r['response_bytes']:>14,}{r['serialize_ms']:>14}"
+              f"{r['store_ms']:>10}{r['preview_ms']:>12}{r['handler_ms']:>12}{r['client_parse_ms']:>10}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'options': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
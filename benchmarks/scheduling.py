@@ -0,0 +1,222 @@
+"""Simulated swap queue: 1K latency under 4K pressure, FIFO vs fair lanes
+
+Replays one random mixed-size workload through each scheduler in
+faceswap/scheduler.py on a simulated clock, driving it exactly as JobQueue
+does (push on arrival, pop when a worker is free, finished when a job ends),
+so hours of traffic take a second and nothing calls the model. Steady
+traffic from many clients arrives as a Poisson stream; on top of it one
+heavy client keeps dropping bursts of 4K jobs into the queue.
+
+Jobs have the app's per-size deadlines (SWAP_DEADLINES, queueing
+included): one still queued at its deadline is dropped, one still running
+is stopped there. Reports per size the share cancelled that way, the wait
+and the total latency (wait plus generation) percentiles of the jobs that
+finished, the waits of the heavy client against everyone else, and how far
+the estimated waits reported at enqueue time were off.
+
+    python -m benchmarks.scheduling
+    python -m benchmarks.scheduling --workers 4 --rate 0.1 --burst 8 --burst-every 600 --json scheduling.json
+    python -m benchmarks.scheduling --deadlines "4K=0"     # without deadlines
+"""
+import argparse
+import heapq
+import json
+import math
+import random
+
+from faceswap.admission import parse_deadlines
+from faceswap.scheduler import DEFAULT_SHARES, DEFAULT_WEIGHTS, FairScheduler, FifoScheduler, LaneLatency, parse_lanes
+
+# Mean generation seconds per size and the share of steady traffic asking for it
+SERVICE_SECONDS = {'1K': 15.0, '2K': 25.0, '4K': 75.0}
+MIX = {'1K': 0.6, '2K': 0.25, '4K': 0.15}
+
+HEAVY = 'heavy'
+
+
+class SimJob:
+    """The parts of faceswap.jobs.Job a scheduler looks at"""
+
+    def __init__(self, index, lane, client, arrived, service, deadline=None):
+        self.index = index
+        self.lane = lane
+        self.client = client
+        self.arrived = arrived
+        self.service = service
+        self.deadline = arrived + deadline if deadline else None
+        self.status = 'queued'
+        self.started_at = None
+        self.finished_at = None
+        self.estimate = None
+
+
+def workload(args):
+    """Arrival-ordered SimJobs for the whole run"""
+    rng = random.Random(args.seed)
+    deadlines = parse_deadlines(args.deadlines)
+    jobs = []
+    sizes, weights = zip(*MIX.items())
+
+    def service(lane):
+        # Log-normal around the mean: most near it, a few much slower
+        sigma = 0.35
+        return SERVICE_SECONDS[lane] * math.exp(rng.gauss(-sigma * sigma / 2, sigma))
+
+    now = 0.0
+    while True:
+        now += rng.expovariate(args.rate)
+        if now >= args.duration:
+            break
+        lane = rng.choices(sizes, weights)[0]
+        jobs.append(SimJob(len(jobs), lane, f'client{rng.randrange(args.clients)}', now, service(lane),
+                           deadlines.get(lane)))
+    if args.burst:
+        burst_at = args.burst_every / 2
+        while burst_at < args.duration:
+            for _ in range(args.burst):
+                jobs.append(SimJob(len(jobs), '4K', HEAVY, burst_at, service('4K'), deadlines.get('4K')))
+            burst_at += args.burst_every
+    jobs.sort(key=lambda job: (job.arrived, job.index))
+    return jobs
+
+
+def simulate(scheduler, jobs, workers):
+    """Run `jobs` through `scheduler` with `workers` slots; fills in their times"""
+    events = [(job.arrived, 2, job.index, job) for job in jobs]
+    events += [(job.deadline, 1, job.index, job) for job in jobs if job.deadline is not None]
+    heapq.heapify(events)
+    running = 0
+    while events:
+        now, kind, _, job = heapq.heappop(events)
+        if kind == 0:
+            if job.status != 'running':
+                continue
+            job.status = 'done'
+            job.finished_at = now
+            scheduler.finished(job)
+            running -= 1
+        elif kind == 1:
+            # Past its deadline: dropped from the queue or stopped mid-generation
+            if job.status == 'queued':
+                scheduler.remove(job)
+            elif job.status == 'running':
+                scheduler.finished(job)
+                running -= 1
+            else:
+                continue
+            job.status = 'deadline'
+            job.finished_at = now
+        else:
+            scheduler.push(job)
+            job.estimate = scheduler.estimated_wait(job)
+        while running < workers:
+            started = scheduler.pop()
+            if started is None:
+                break
+            started.status = 'running'
+            started.started_at = now
+            running += 1
+            # Completions sort before deadlines and arrivals at the same instant
+            heapq.heappush(events, (now + started.service, 0, started.index, started))
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(math.ceil(p / 100 * len(values))) - 1)], 1)
+
+
+def summarize(jobs):
+    lanes = {}
+    for lane in sorted({job.lane for job in jobs}):
+        lane_jobs = [job for job in jobs if job.lane == lane]
+        done = [job for job in lane_jobs if job.status == 'done']
+        waits = [job.started_at - job.arrived for job in done]
+        latencies = [job.finished_at - job.arrived for job in done]
+        errors = [abs(job.estimate - wait) for job, wait in zip(done, waits)]
+        lanes[lane] = {
+            'jobs': len(lane_jobs),
+            'deadline_rate': round(1 - len(done) / len(lane_jobs), 3),
+            'wait_p50': percentile(waits, 50),
+            'wait_p95': percentile(waits, 95),
+            'latency_p50': percentile(latencies, 50),
+            'latency_p95': percentile(latencies, 95),
+            'latency_p99': percentile(latencies, 99),
+            'estimate_error_p50': percentile(errors, 50),
+        }
+    clients = {}
+    for name, group in (('heavy', [j for j in jobs if j.client == HEAVY]),
+                        ('others', [j for j in jobs if j.client != HEAVY])):
+        if not group:
+            continue
+        waits = [job.started_at - job.arrived for job in group if job.status == 'done']
+        clients[name] = {
+            'jobs': len(group),
+            'deadline_rate': round(1 - len(waits) / len(group), 3),
+            'wait_p50': percentile(waits, 50),
+            'wait_p95': percentile(waits, 95),
+        }
+    return {'lanes': lanes, 'clients': clients}
+
+
+def build(policy, args):
+    latency = LaneLatency(dict(SERVICE_SECONDS))
+    if policy == 'fifo':
+        return FifoScheduler(args.workers, latency=latency)
+    return FairScheduler(args.workers, weights=parse_lanes(args.weights, DEFAULT_WEIGHTS),
+                         shares=parse_lanes(args.shares, DEFAULT_SHARES), latency=latency)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4, help='jobs running at once (SWAP_WORKERS)')
+    parser.add_argument('--rate', type=float, default=0.1, help='steady arrivals per second')
+    parser.add_argument('--clients', type=int, default=50, help='clients sharing the steady traffic')
+    parser.add_argument('--burst', type=int, default=8, help='4K jobs per burst from the heavy client (0: none)')
+    parser.add_argument('--burst-every', type=float, default=900, help='seconds between bursts')
+    parser.add_argument('--duration', type=float, default=8 * 3600, help='simulated seconds')
+    parser.add_argument('--weights', default='', help='lane weights for the fair scheduler, e.g. "1K=4,2K=2,4K=1"')
+    parser.add_argument('--shares', default='', help='lane caps for the fair scheduler, e.g. "4K=0.5"')
+    parser.add_argument('--deadlines', default='', help='per-size deadlines over the app\'s, e.g. "4K=600" (0: none)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    demand = sum(MIX[lane] * SERVICE_SECONDS[lane] for lane in MIX) * args.rate
+    if args.burst:
+        demand += args.burst * SERVICE_SECONDS['4K'] / args.burst_every
+    print(f"{args.workers} workers, offered load {demand / args.workers:.0%} "
+          f"({args.rate}/s steady, {args.burst} x 4K every {args.burst_every:g}s), "
+          f"{args.duration / 3600:g}h simulated\n")
+
+    results = {}
+    for policy in ('fifo', 'fair'):
+        jobs = workload(args)
+        simulate(build(policy, args), jobs, args.workers)
+        results[policy] = summarize(jobs)
+
+    print(f"{'policy':<7}{'size':<6}{'jobs':>6}{'deadline':>10}{'wait p50':>10}{'wait p95':>10}"
+          f"{'lat p50':>9}{'lat p95':>9}{'lat p99':>9}{'est err p50':>13}")
+    for policy, summary in results.items():
+        for lane, r in summary['lanes'].items():
+            print(f"{policy:<7}{lane:<6}{r['jobs']:>6}{r['deadline_rate']:>10.1%}{r['wait_p50']:>10}{r['wait_p95']:>10}"
+                  f"{r['latency_p50']:>9}{r['latency_p95']:>9}{r['latency_p99']:>9}{r['estimate_error_p50']:>13}")
+    print(f"\n{'policy':<7}{'client':<8}{'jobs':>6}{'deadline':>10}{'wait p50':>10}{'wait p95':>10}")
+    for policy, summary in results.items():
+        for name, r in summary['clients'].items():
+            print(f"{policy:<7}{name:<8}{r['jobs']:>6}{r['deadline_rate']:>10.1%}{r['wait_p50']:>10}{r['wait_p95']:>10}")
+
+    fifo, fair = (results[policy]['lanes'].get('1K', {}).get('latency_p95') for policy in ('fifo', 'fair'))
+    if fifo and fair:
+        print(f"\n1K p95 latency: {fifo}s FIFO -> {fair}s fair ({fair / fifo - 1:+.0%})")
+    fifo, fair = (results[policy]['lanes'].get('4K', {}).get('deadline_rate') for policy in ('fifo', 'fair'))
+    if fifo is not None and fair is not None:
+        print(f"4K cancelled at the deadline: {fifo:.1%} FIFO -> {fair:.1%} fair")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'options': vars(args), 'offered_load': demand / args.workers, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
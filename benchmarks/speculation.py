@@ -0,0 +1,158 @@
+"""Click-to-result latency with and without speculative generation
+
+Simulated users each pick a fresh photo and a template, then think for a
+while (exponentially distributed, --think seconds on average) before
+clicking Generate; some (--change) switch to another size halfway through.
+With speculation on they post /swap/speculate as the page does, after each
+pick. Both runs drive the Flask app in a fresh subprocess against a fake
+Gemini with --latency seconds per generation, and report click-to-result
+percentiles, then for the speculative run its hit rate, the head start
+adopted generations had and the model time spent on unused ones.
+
+    python -m benchmarks.speculation
+    python -m benchmarks.speculation --users 40 --concurrency 8 --think 10 --change 0.3 --latency 15 --json spec.json
+
+Uploads and results go to a scratch directory, never the checkout.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.loadtest import make_photo, percentile, prepare_workdir
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SIZES = ('1k', '2k')
+
+
+def user(client, photo, plan, speculate):
+    """One user's visit; returns seconds from the click to the result"""
+    first, second, think = plan
+
+    def form(size):
+        return {'user_photo': (io.BytesIO(photo), 'me.jpg'), 'template_id': 'bench.jpg', 'image_size': size}
+
+    if speculate:
+        client.post('/swap/speculate', data=form(first))
+    if second != first:
+        time.sleep(think / 2)
+        if speculate:
+            client.post('/swap/speculate', data=form(second))
+        time.sleep(think / 2)
+    else:
+        time.sleep(think)
+
+    start = time.monotonic()
+    response = client.post('/swap', data=form(second))
+    if response.status_code == 202:
+        result_url = response.get_json()['result_url']
+        while (response := client.get(result_url)).status_code == 202:
+            time.sleep(0.05)
+    if response.status_code != 200:
+        raise RuntimeError(f'Swap failed: {response.status_code} {response.get_json()}')
+    return time.monotonic() - start
+
+
+def run_child(mode, args):
+    """Serve every simulated user from one app in this process"""
+    workdir = prepare_workdir(args.template_px)
+    try:
+        os.environ.update(GEMINI_API_KEY='benchmark', CLIENT_RATE='0', MODEL_RATE='0', MAX_QUEUE='0',
+                          STORAGE_SWEEP_INTERVAL='0', SWAP_WORKERS=str(args.workers),
+                          SPECULATION='1' if mode == 'on' else '0',
+                          SPECULATION_BUDGET=str(args.budget))
+        sys.path.insert(0, ROOT)
+        from benchmarks import fake_gemini
+        fake_gemini.install(image_size=50_000, image_format='jpeg', latency=args.latency, seed=args.seed)
+        os.chdir(workdir)
+        sys.path.insert(0, workdir)
+        import app
+
+        rng = random.Random(args.seed)
+        plans = []
+        for _ in range(args.users):
+            first = rng.choice(SIZES)
+            second = rng.choice([s for s in SIZES if s != first]) if rng.random() < args.change else first
+            plans.append((first, second, rng.expovariate(1 / args.think)))
+        photos = [make_photo(args.photo_px) for _ in range(args.users)]
+        lock = threading.Lock()
+        latencies = []
+
+        def visit(index):
+            seconds = user(app.app.test_client(), photos[index], plans[index], mode == 'on')
+            with lock:
+                latencies.append(seconds)
+
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            list(pool.map(visit, range(args.users)))
+        # Let superseded jobs settle so their model time is counted
+        time.sleep(args.latency + 1)
+
+        result = {
+            'mode': mode,
+            'users': len(latencies),
+            'p50_s': round(percentile(latencies, 50), 2),
+            'p95_s': round(percentile(latencies, 95), 2),
+            'mean_s': round(sum(latencies) / len(latencies), 2),
+        }
+        if mode == 'on':
+            stats = app.speculator.stats()
+            result.update({key: stats[key] for key in (
+                'started', 'adopted', 'superseded', 'expired', 'refused', 'hit_rate',
+                'mean_saved_seconds', 'wasted_model_seconds')})
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=24)
+    parser.add_argument('--concurrency', type=int, default=6, help='users on the page at once')
+    parser.add_argument('--workers', type=int, default=4, help='SWAP_WORKERS')
+    parser.add_argument('--think', type=float, default=4.0, help='mean seconds between the picks and the click')
+    parser.add_argument('--change', type=float, default=0.3, help='share of users switching size before clicking')
+    parser.add_argument('--latency', type=float, default=3.0, help='seconds per fake generation')
+    parser.add_argument('--budget', type=int, default=3, help='SPECULATION_BUDGET')
+    parser.add_argument('--photo-px', type=int, default=1024)
+    parser.add_argument('--template-px', type=int, default=1024)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--child', choices=('off', 'on'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child(args.child, args)))
+        return
+
+    argv = sys.argv[1:]
+    results = {}
+    for mode in ('off', 'on'):
+        out = subprocess.check_output([sys.executable, '-m', 'benchmarks.speculation', *argv, '--child', mode],
+                                      cwd=ROOT, env=dict(os.environ, PYTHONDONTWRITEBYTECODE='1'), text=True)
+        results[mode] = json.loads(out.strip().splitlines()[-1])
+
+    print(f"{args.users} users, {args.concurrency} at a time, think ~{args.think:g}s, "
+          f"{args.change:.0%} change size, {args.latency:g}s per generation, {args.workers} workers\n")
+    print(f"{'speculation':<13}{'p50 s':>8}{'p95 s':>8}{'mean s':>8}")
+    for mode, r in results.items():
+        print(f"{mode:<13}{r['p50_s']:>8}{r['p95_s']:>8}{r['mean_s']:>8}")
+    on = results['on']
+    print(f"\nhit rate {on['hit_rate']}, {on['adopted']}/{on['started']} adopted, "
+          f"mean head start {on['mean_saved_seconds']}s, {on['wasted_model_seconds']}s of model time unused, "
+          f"refused {on['refused'] or 'none'}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'options': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
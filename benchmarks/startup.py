@@ -0,0 +1,204 @@
+"""Cold-start cost of every entry point: import time and time to first response
+
+Each entry point is loaded in a fresh interpreter, run with -X importtime,
+and then answers its first request: the WSGI and ASGI apps render the home
+page, the Netlify functions answer a request that needs no model call. The
+generate function then does one generation against a fake Gemini client,
+which is where the genai SDK now gets imported, and a second, warm one.
+Import time is broken down by top-level package.
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --runs 5 --json startup.json
+
+--check turns it into a regression test: it exits non-zero if any entry
+point imports the genai SDK at startup or takes longer to import than its
+budget in BUDGET_MS (scaled by --budget-scale for slower machines).
+"""
+import argparse
+import asyncio
+import base64
+import collections
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENTRY_POINTS = ('wsgi', 'asgi', 'generate', 'admin-upload', 'admin-delete')
+
+# Import-time budgets in ms, about twice what a small cloud VM measures
+BUDGET_MS = {
+    'wsgi': 500,
+    'asgi': 800,
+    'generate': 300,
+    'admin-upload': 50,
+    'admin-delete': 50,
+}
+
+SDK = 'google.genai'
+
+MARKERS = ('-- startup benchmark: import --', '-- startup benchmark: requests --')
+
+
+def load_function(name):
+    path = os.path.join(ROOT, 'netlify', 'functions', f'{name}.py')
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, round((time.perf_counter() - start) * 1000, 1)
+
+
+def first_response(entry, module):
+    """(status, ms) of the first request an entry point answers without the model"""
+    if entry == 'wsgi':
+        client = module.app.test_client()
+        return timed(lambda: client.get('/').status_code)
+    if entry == 'asgi':
+        client = module.app.test_client()
+        return timed(lambda: asyncio.run(client.get('/')).status_code)
+
+    headers = {'authorization': 'Bearer admin-2'}
+    events = {
+        'generate': {'httpMethod': 'POST', 'body': json.dumps({'image_size': 'x1'})},
+        'admin-upload': {'httpMethod': 'POST', 'headers': headers, 'body': json.dumps({})},
+        'admin-delete': {'httpMethod': 'DELETE', 'headers': headers, 'path': '/admin/delete/missing.png'},
+    }
+    return timed(lambda: module.handler(events[entry], None)['statusCode'])
+
+
+def generation(module):
+    """(status, ms) of one generate request through the fake model"""
+    template = sorted(os.listdir(os.path.join(ROOT, 'static', 'templates_gallery')))[0]
+    with open(os.path.join(ROOT, 'static', 'templates_gallery', template), 'rb') as f:
+        photo = base64.b64encode(f.read()).decode('ascii')
+    event = {'httpMethod': 'POST', 'body': json.dumps({'user_photo': photo, 'template_id': template, 'image_size': 'x1'})}
+    return timed(lambda: module.handler(event, None)['statusCode'])
+
+
+def run_child(entry):
+    """Load `entry` in this (fresh) interpreter and return its figures"""
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    sys.stderr.write(MARKERS[0] + '\n')
+    sys.stderr.flush()
+    if entry in ('wsgi', 'asgi'):
+        module, import_ms = timed(lambda: __import__('wsgi' if entry == 'wsgi' else 'asgi_app'))
+    else:
+        module, import_ms = timed(lambda: load_function(entry))
+    sdk_at_import = SDK in sys.modules
+    sys.stderr.write(MARKERS[1] + '\n')
+    sys.stderr.flush()
+
+    status, first_ms = first_response(entry, module)
+    result = {
+        'entry': entry,
+        'import_ms': import_ms,
+        'sdk_at_import': sdk_at_import,
+        'first_status': status,
+        'first_response_ms': first_ms,
+    }
+    if entry == 'generate':
+        from benchmarks import fake_gemini
+
+        # Installing the fake imports the SDK, as the first real generation would
+        start = time.perf_counter()
+        fake_gemini.install(image_size=200_000, latency=0.0)
+        status, _ = generation(module)
+        result['generation_status'] = status
+        result['first_generation_ms'] = round((time.perf_counter() - start) * 1000, 1)
+        _, result['warm_generation_ms'] = generation(module)
+    return result
+
+
+def import_breakdown(stderr):
+    """Self import time in ms per top-level package: ({at import}, {while serving})"""
+    phases = [collections.Counter(), collections.Counter()]
+    phase = None
+    for line in stderr.splitlines():
+        if line in MARKERS:
+            phase = phases[MARKERS.index(line)]
+        elif phase is not None and line.startswith('import time:') and 'self [us]' not in line:
+            self_us, _, name = line[len('import time:'):].split('|')
+            phase[name.strip().split('.')[0]] += int(self_us) / 1000
+    return tuple({name: round(ms, 1) for name, ms in totals.most_common()} for totals in phases)
+
+
+def measure(entry, runs):
+    env = dict(os.environ, GEMINI_API_KEY=os.environ.get('GEMINI_API_KEY', 'benchmark'), STORAGE_SWEEP_INTERVAL='0')
+    results = []
+    for _ in range(runs):
+        proc = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-m', 'benchmarks.startup', '--child', entry],
+            cwd=ROOT, env=env, capture_output=True, text=True,
+        )
+        if proc.returncode:
+            raise RuntimeError(f"{entry} failed:\n{proc.stderr[-2000:]}")
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        result['breakdown'], result['lazy_imports'] = import_breakdown(proc.stderr)
+        results.append(result)
+
+    summary = dict(results[0])
+    for key in ('import_ms', 'first_response_ms', 'first_generation_ms', 'warm_generation_ms'):
+        if key in summary:
+            summary[key] = round(statistics.median(r[key] for r in results), 1)
+    summary['sdk_at_import'] = any(r['sdk_at_import'] for r in results)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('entries', nargs='*', default=list(ENTRY_POINTS))
+    parser.add_argument('--runs', type=int, default=3, help='fresh interpreters per entry point (median)')
+    parser.add_argument('--top', type=int, default=6, help='packages shown in the breakdown')
+    parser.add_argument('--check', action='store_true', help='exit 1 on an SDK import at startup or a blown budget')
+    parser.add_argument('--budget-scale', type=float, default=1.0)
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child(args.child)))
+        return
+
+    rows = [measure(entry, args.runs) for entry in args.entries]
+
+    print(f"{'entry point':<14}{'import ms':>10}{'first ms':>10}{'status':>8}{'SDK':>6}{'1st gen ms':>12}{'warm ms':>9}")
+    for r in rows:
+        print(f"{r['entry']:<14}{r['import_ms']:>10}{r['first_response_ms']:>10}{r['first_status']:>8}"
+              f"{'yes' if r['sdk_at_import'] else 'no':>6}{r.get('first_generation_ms', ''):>12}"
+              f"{r.get('warm_generation_ms', ''):>9}")
+    print('\nimport ms by package, at startup (and first imported while serving)')
+    for r in rows:
+        top = ', '.join(f"{name} {ms}" for name, ms in list(r['breakdown'].items())[:args.top])
+        lazy = ', '.join(f"{name} {ms}" for name, ms in list(r['lazy_imports'].items())[:3])
+        print(f"{r['entry']:<14}{top or '-'}" + (f"  ({lazy})" if lazy else ''))
+
+    failures = []
+    for r in rows:
+        if r['sdk_at_import']:
+            failures.append(f"{r['entry']} imports {SDK} at startup")
+        budget = BUDGET_MS.get(r['entry'])
+        if budget and r['import_ms'] > budget * args.budget_scale:
+            failures.append(f"{r['entry']} import took {r['import_ms']} ms, budget {budget * args.budget_scale:g} ms")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'options': vars(args), 'budget_ms': BUDGET_MS, 'results': rows, 'failures': failures}, f, indent=2)
+    if failures:
+        print('\n' + '\n'.join(failures))
+        if args.check:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
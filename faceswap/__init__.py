@@ -0,0 +1 @@
+"""Shared building blocks for the Face Swap AI app"""
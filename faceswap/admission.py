@@ -0,0 +1,284 @@
+"""Admission control, quota pacing and retries around the model call"""
+import asyncio
+import math
+import random
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+# Upstream status codes worth another attempt
+RETRYABLE_CODES = (429, 500, 502, 503, 504)
+
+# Seconds a generation may take end to end, queueing included, by output size.
+# 4K jobs yield workers to the quicker lanes (faceswap/scheduler.py), so
+# they get the longer wait that costs them; python -m benchmarks.scheduling
+# reports how many each setting cancels
+DEFAULT_DEADLINES = {'1K': 120.0, '2K': 180.0, '4K': 480.0}
+
+
+def parse_deadlines(spec):
+    """Per-size deadlines from a "1K=120,2K=180,4K=480" string, over the defaults
+
+    A value of zero disables the deadline for that size.
+    """
+    deadlines = dict(DEFAULT_DEADLINES)
+    for item in spec.split(','):
+        size, sep, seconds = item.partition('=')
+        if sep:
+            deadlines[size.strip().upper()] = float(seconds)
+    return deadlines
+
+
+class Overloaded(Exception):
+    """A request was shed; `retry_after` is a hint in whole seconds"""
+
+    def __init__(self, message, retry_after, reason):
+        super().__init__(message)
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+        self.reason = reason
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `burst`
+
+    A rate of zero or less means unlimited.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def unlimited(self):
+        return self.rate <= 0
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def tokens(self):
+        if self.unlimited:
+            return math.inf
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens
+
+    def try_acquire(self, n=1):
+        """Take n tokens if available; otherwise return seconds until they will be"""
+        if self.unlimited:
+            return 0.0
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= n:
+                self._tokens -= n
+                return 0.0
+            return (n - self._tokens) / self.rate
+
+    def acquire(self, timeout):
+        """Block until a token is taken; False if that would take longer than timeout"""
+        deadline = time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    async def acquire_async(self, timeout):
+        """acquire() for coroutines: sleeps on the event loop instead of the thread"""
+        deadline = time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+
+def _loaded(name):
+    # Errors of a library that was never imported cannot have been raised, so
+    # checking them needs no import (which keeps the SDK out of cold starts)
+    return sys.modules.get(name)
+
+
+def is_retryable(exc):
+    """Transient upstream failures: overload, server errors and dropped connections"""
+    errors = _loaded('google.genai.errors')
+    if errors is not None and isinstance(exc, errors.APIError):
+        return exc.code in RETRYABLE_CODES
+    httpx = _loaded('httpx')
+    return isinstance(exc, ConnectionError) or (httpx is not None and isinstance(exc, httpx.TransportError))
+
+
+def retry_hint(exc):
+    """Seconds the upstream asked us to wait, from Retry-After or a RetryInfo detail"""
+    response = getattr(exc, 'response', None)
+    httpx = _loaded('httpx')
+    if httpx is not None and isinstance(response, httpx.Response):
+        try:
+            return float(response.headers.get('Retry-After', 0))
+        except ValueError:
+            pass
+    details = getattr(exc, 'details', None)
+    if isinstance(details, dict):
+        for detail in details.get('error', {}).get('details', []) or []:
+            delay = detail.get('retryDelay') if isinstance(detail, dict) else None
+            if isinstance(delay, str) and delay.endswith('s'):
+                try:
+                    return float(delay[:-1])
+                except ValueError:
+                    pass
+    return 0.0
+
+
+class RetryPolicy:
+    """Exponential backoff with jitter, bounded by attempts and a total deadline"""
+
+    def __init__(self, attempts=4, base_delay=1.0, max_delay=16.0, deadline=90.0):
+        self.attempts = max(1, int(attempts))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def backoff(self, attempt):
+        # "Equal jitter": never less than half the exponential step
+        step = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return step / 2 + random.uniform(0, step / 2)
+
+
+class AdmissionController:
+    """Front door for model calls
+
+    `admit()` runs in the request: it enforces a per-client token bucket and
+    sheds work once `queue_length()` reaches `max_queue`. `call()` (or
+    `acall()` for coroutines) runs in the worker: every attempt takes a token
+    from the global bucket sized to the API quota, and transient upstream
+    errors are retried per `retry`.
+    Shed requests raise Overloaded; `on_shed(reason)` and
+    `on_retry(attempt, delay, exc)` let the caller record them.
+    """
+
+    def __init__(self, rate=1.0, burst=5, client_rate=0.2, client_burst=5, max_queue=32,
+                 queue_length=None, retry=None, max_clients=10000, on_shed=None):
+        self.bucket = TokenBucket(rate, burst)
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.max_queue = max_queue
+        self.queue_length = queue_length or (lambda: 0)
+        self.retry = retry or RetryPolicy()
+        self.max_clients = max_clients
+        self.on_shed = on_shed
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        self._admitted = 0
+        self._shed = {}
+        self._retries = 0
+
+    def _client_bucket(self, client_id):
+        with self._lock:
+            bucket = self._clients.pop(client_id, None)
+            if bucket is None:
+                bucket = TokenBucket(self.client_rate, self.client_burst)
+            self._clients[client_id] = bucket
+            # Dropping an idle client only forgets a bucket that had refilled anyway
+            while len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+            return bucket
+
+    def _shed_request(self, reason, message, retry_after):
+        with self._lock:
+            self._shed[reason] = self._shed.get(reason, 0) + 1
+        if self.on_shed is not None:
+            self.on_shed(reason)
+        return Overloaded(message, retry_after, reason)
+
+    def admit(self, client_id):
+        """Accept one submission from client_id or raise Overloaded"""
+        wait = self._client_bucket(client_id).try_acquire()
+        if wait:
+            raise self._shed_request('client', 'Too many requests, please slow down', wait)
+
+        queued = self.queue_length()
+        if self.max_queue and queued >= self.max_queue:
+            drain = queued / self.bucket.rate if not self.bucket.unlimited else self.retry.max_delay
+            raise self._shed_request('queue', 'The server is busy, please try again shortly', drain)
+
+        with self._lock:
+            self._admitted += 1
+
+    def call(self, func, deadline=None, retryable=None, on_retry=None):
+        """Run func() under the global quota, retrying transient upstream errors
+
+        `deadline` is a time.monotonic() value that can only shorten the
+        retry policy's own; `retryable(exc)` can veto a retry, e.g. once the
+        attempt has produced side effects.
+        """
+        deadline = self._deadline(deadline)
+        attempt = 0
+        while True:
+            attempt += 1
+            if not self.bucket.acquire(deadline - time.monotonic()):
+                raise self._quota_exhausted()
+            try:
+                return func()
+            except Exception as e:
+                delay = self._retry_delay(attempt, e, deadline, retryable, on_retry)
+            time.sleep(delay)
+
+    async def acall(self, func, deadline=None, retryable=None, on_retry=None):
+        """call() for a coroutine function, waiting on the event loop"""
+        deadline = self._deadline(deadline)
+        attempt = 0
+        while True:
+            attempt += 1
+            if not await self.bucket.acquire_async(deadline - time.monotonic()):
+                raise self._quota_exhausted()
+            try:
+                return await func()
+            except Exception as e:
+                delay = self._retry_delay(attempt, e, deadline, retryable, on_retry)
+            await asyncio.sleep(delay)
+
+    def _deadline(self, deadline):
+        limit = time.monotonic() + self.retry.deadline
+        return limit if deadline is None else min(deadline, limit)
+
+    def _quota_exhausted(self):
+        return self._shed_request('quota', 'The server is busy, please try again shortly', 1 / self.bucket.rate)
+
+    def _retry_delay(self, attempt, exc, deadline, retryable, on_retry):
+        """Seconds to wait before the next attempt; re-raises when there is none"""
+        if not is_retryable(exc) or (retryable is not None and not retryable(exc)):
+            raise exc
+        delay = max(self.retry.backoff(attempt), retry_hint(exc))
+        if attempt >= self.retry.attempts or time.monotonic() + delay > deadline:
+            raise self._shed_request(
+                'upstream', 'The image model is overloaded, please try again shortly', delay
+            ) from exc
+        with self._lock:
+            self._retries += 1
+        if on_retry is not None:
+            on_retry(attempt, delay, exc)
+        return delay
+
+    def stats(self):
+        tokens = self.bucket.tokens
+        with self._lock:
+            return {
+                'tokens': None if math.isinf(tokens) else round(tokens, 2),
+                'rate': self.bucket.rate,
+                'burst': self.bucket.burst,
+                'queue_length': self.queue_length(),
+                'max_queue': self.max_queue,
+                'clients': len(self._clients),
+                'admitted': self._admitted,
+                'shed': dict(self._shed),
+                'retries': self._retries,
+            }
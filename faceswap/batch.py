@@ -0,0 +1,152 @@
+import collections
+import threading
+import time
+import uuid
+
+from faceswap.jobs import DONE, FAILED, EventLog, Job
+
+
+class Batch(EventLog):
+    """Fans a list of calls out over a JobQueue with at most `concurrency` in flight
+
+    Items are started in order as earlier ones finish, so one large batch
+    cannot take every worker from other users. `describe(result)` turns a
+    finished item's result into the JSON-able dict reported to clients.
+    Item jobs are owned by the batch, so clients following the batch keep
+    them from being abandoned.
+    """
+
+    def __init__(self, queue, concurrency=3, describe=None, client=None):
+        super().__init__()
+        self.id = str(uuid.uuid4())
+        self.queue = queue
+        self.concurrency = max(1, int(concurrency))
+        self.describe = describe or (lambda result: {'result': result})
+        self.client = client
+        self.items = []
+        self.created_at = time.time()
+        self.finished_at = None
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._running = 0
+
+    @property
+    def finished(self):
+        return self.finished_at is not None
+
+    def add(self, func, *args, meta=None, timeout=None, lane=None, **kwargs):
+        """Queue func(*args, **kwargs) as the next item of the batch
+
+        `timeout` is the item's deadline in seconds, counted from when the batch queues it.
+        Items run as jobs in `lane`, on behalf of the batch's client.
+        """
+        item = self._new_item(meta)
+        self._pending.append((item, func, args, kwargs, timeout, lane))
+        return item
+
+    def add_result(self, result, meta=None):
+        """Record an item that is already complete, e.g. a cache hit"""
+        item = self._new_item(meta)
+        item['status'] = DONE
+        item.update(self.describe(result))
+        return item
+
+    def add_error(self, error, meta=None):
+        """Record an item that failed before it could be queued"""
+        item = self._new_item(meta)
+        item['status'] = FAILED
+        item['error'] = error
+        return item
+
+    def start(self):
+        self.emit('status', status='running', total=len(self.items))
+        for item in self.items:
+            if item['status'] in (DONE, FAILED):
+                self.emit('item', **item)
+        self._launch()
+        self._check_finished()
+
+    def to_dict(self):
+        with self._lock:
+            items = [dict(item) for item in self.items]
+        return {
+            'id': self.id,
+            'status': self.status,
+            'total': len(items),
+            'done': sum(1 for item in items if item['status'] == DONE),
+            'failed': sum(1 for item in items if item['status'] == FAILED),
+            'created_at': self.created_at,
+            'finished_at': self.finished_at,
+            'items': items,
+        }
+
+    @property
+    def status(self):
+        if not self.finished:
+            return 'running'
+        failed = sum(1 for item in self.items if item['status'] == FAILED)
+        if not failed:
+            return DONE
+        return FAILED if failed == len(self.items) else 'partial'
+
+    def _new_item(self, meta):
+        item = dict(meta or {})
+        item.update({'index': len(self.items), 'status': 'queued', 'job_id': None})
+        self.items.append(item)
+        return item
+
+    def _launch(self):
+        while True:
+            with self._lock:
+                if self._running >= self.concurrency or not self._pending:
+                    return
+                item, func, args, kwargs, timeout, lane = self._pending.popleft()
+                self._running += 1
+            job = self.queue.enqueue(Job(func, args, kwargs, timeout=timeout, owner=self, lane=lane, client=self.client))
+            with self._lock:
+                item['job_id'] = job.id
+                item['status'] = 'running'
+            job.add_done_callback(lambda job, item=item: self._on_done(item, job))
+
+    def _on_done(self, item, job):
+        with self._lock:
+            self._running -= 1
+            item['status'] = job.status
+            if job.status == DONE:
+                item.update(self.describe(job.result))
+            else:
+                item['error'] = job.error
+            snapshot = dict(item)
+        self.emit('item', **snapshot)
+        self._launch()
+        self._check_finished()
+
+    def _check_finished(self):
+        with self._lock:
+            if self.finished or self._pending or self._running:
+                return
+            self.finished_at = time.time()
+        self.emit('status', status=self.status)
+
+
+class BatchRegistry:
+    """Keeps batches addressable by id for `ttl` seconds after they finish"""
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._batches = {}
+
+    def add(self, batch):
+        with self._lock:
+            cutoff = time.time() - self.ttl
+            expired = [batch_id for batch_id, b in self._batches.items()
+                       if b.finished and b.finished_at < cutoff]
+            for batch_id in expired:
+                del self._batches[batch_id]
+            self._batches[batch.id] = batch
+        return batch
+
+    def get(self, batch_id):
+        with self._lock:
+            return self._batches.get(batch_id)
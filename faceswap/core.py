@@ -0,0 +1,120 @@
+"""What every entry point shares about the model call, cheap to import
+
+app.py (and so wsgi.py and asgi_app.py) and the Netlify functions import
+this rather than each other. Only the standard library is imported at load
+time: the genai SDK, which takes most of a second to import, is loaded by
+genai_types() on first model use, so a cold start that never calls the
+model (admin work, a 4xx answer, a health check) does not pay for it.
+benchmarks/startup.py keeps an eye on that.
+"""
+import hashlib
+import os
+import sys
+import threading
+
+MODEL = "gemini-3-pro-image-preview"
+
+# Image size mappings
+IMAGE_SIZES = {
+    "x1": "1K",
+    "1k": "1K",
+    "2k": "2K",
+    "4k": "4K"
+}
+
+# Face swap prompt template
+FACE_SWAP_PROMPT = """Make the person's face from picture number 1 replace the face in picture number 2. 
+You can change the clothes but only one thing: don't change the hairstyle or anything about the character from picture number 1.
+Keep the same face of the person from picture one, don't change anything about their skin or face.
+Change the position of the person to make the picture look natural and well composed.
+
+Picture 1 is the user's face photo.
+Picture 2 is the template/background image.
+
+Create the final image with the face from picture 1 placed onto picture 2's scene/pose."""
+
+# Bumps automatically whenever the prompt text changes, invalidating cached results
+PROMPT_VERSION = hashlib.sha256(FACE_SWAP_PROMPT.encode('utf-8')).hexdigest()[:12]
+
+# One-time process setup, kept across warm invocations of a function
+_init_lock = threading.Lock()
+_env_loaded = False
+_folders_made = set()
+
+
+def init_once(*folders):
+    """Load .env and create `folders`, doing each only once per process"""
+    global _env_loaded
+    with _init_lock:
+        if not _env_loaded:
+            from dotenv import load_dotenv
+
+            load_dotenv()
+            _env_loaded = True
+        for folder in folders:
+            if folder not in _folders_made:
+                os.makedirs(folder, exist_ok=True)
+                _folders_made.add(folder)
+
+
+def genai_types():
+    """The google.genai.types module, imported on first use"""
+    from google.genai import types
+
+    return types
+
+
+def build_request(inputs, image_size, aspect_ratio=None, http_options=None):
+    """Prompt contents and generation config for one face swap
+
+    `inputs` is (user data, user mime, template data, template mime).
+    """
+    types = genai_types()
+    user_image_data, user_mime, template_image_data, template_mime = inputs
+
+    # Build prompt with aspect ratio if specified
+    prompt = FACE_SWAP_PROMPT
+    if aspect_ratio:
+        prompt += f"\n\nGenerate the output image with aspect ratio {aspect_ratio}."
+
+    contents = [
+        types.Content(
+            role="user",
+            parts=[
+                types.Part.from_text(text="Picture 1 (User's face):"),
+                types.Part.from_bytes(data=user_image_data, mime_type=user_mime),
+                types.Part.from_text(text="Picture 2 (Template/Background):"),
+                types.Part.from_bytes(data=template_image_data, mime_type=template_mime),
+                types.Part.from_text(text=prompt),
+            ],
+        ),
+    ]
+
+    generate_content_config = types.GenerateContentConfig(
+        response_modalities=["IMAGE", "TEXT"],
+        image_config=types.ImageConfig(
+            image_size=image_size,
+        ),
+        http_options=http_options,
+    )
+    return contents, generate_content_config
+
+
+def chunk_part(chunk):
+    """First content part of a streamed chunk, or None if it carries nothing"""
+    if (
+        chunk.candidates is None
+        or chunk.candidates[0].content is None
+        or chunk.candidates[0].content.parts is None
+    ):
+        return None
+    return chunk.candidates[0].content.parts[0]
+
+
+def is_timeout(error):
+    """Whether `error` is our own deadline or an HTTP client timeout"""
+    if isinstance(error, TimeoutError):
+        return True
+    # Without httpx loaded, nothing can have raised one of its errors
+    httpx = sys.modules.get('httpx')
+    return httpx is not None and isinstance(error, httpx.TimeoutException)
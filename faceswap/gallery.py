@@ -0,0 +1,175 @@
+import io
+import os
+import threading
+
+from PIL import Image, ImageOps
+
+from faceswap.result_cache import file_digest
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+
+THUMB_WIDTHS = (160, 320, 640)
+
+THUMB_FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpg': ('JPEG', 'image/jpeg'),
+}
+
+
+class TemplateIndex:
+    """In-memory index of the template gallery
+
+    The folder is rescanned only when its mtime changes or `invalidate()` is
+    called, and only new or modified files are re-read (header-only decode
+    for dimensions plus a content hash). Entries are ordered newest first.
+    """
+
+    def __init__(self, folder, thumb_folder, thumb_url, widths=THUMB_WIDTHS):
+        self.folder = folder
+        self.thumb_folder = thumb_folder
+        self.thumb_url = thumb_url
+        self.widths = tuple(widths)
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._entries = []
+        self._by_name = {}
+        self._by_hash = {}
+
+    def invalidate(self):
+        with self._lock:
+            self._stamp = None
+
+    def discard(self, digest):
+        """Forget a removed template and delete the thumbnails of its content `digest`
+
+        They are kept while another template has the same content. Returns
+        the number of files deleted.
+        """
+        self.invalidate()
+        self._refresh()
+        prefix = digest[:32]
+        if prefix in self._by_hash:
+            return 0
+        removed = 0
+        for width in self.widths:
+            for ext in THUMB_FORMATS:
+                try:
+                    os.remove(os.path.join(self.thumb_folder, f"{prefix}_{width}.{ext}"))
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    def entries(self):
+        """All templates, refreshing the index first if the folder changed"""
+        self._refresh()
+        return self._entries
+
+    def page(self, offset=0, limit=24):
+        entries = self.entries()
+        return entries[offset:offset + limit], len(entries)
+
+    def get(self, filename):
+        self._refresh()
+        return self._by_name.get(filename)
+
+    def _refresh(self):
+        try:
+            stamp = os.stat(self.folder).st_mtime_ns
+        except FileNotFoundError:
+            stamp = 0
+        if stamp == self._stamp:
+            return
+
+        with self._lock:
+            if stamp == self._stamp:
+                return
+            by_name = {}
+            if stamp:
+                with os.scandir(self.folder) as it:
+                    for dir_entry in it:
+                        if not dir_entry.is_file() or not dir_entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                            continue
+                        st = dir_entry.stat()
+                        entry = self._by_name.get(dir_entry.name)
+                        if entry is None or entry['_stat'] != (st.st_mtime_ns, st.st_size):
+                            entry = self._describe(dir_entry.name, dir_entry.path, st)
+                        if entry is not None:
+                            by_name[dir_entry.name] = entry
+            self._by_name = by_name
+            self._by_hash = {e['hash'][:32]: e for e in by_name.values()}
+            self._entries = sorted(by_name.values(), key=lambda e: e['_stat'][0], reverse=True)
+            self._stamp = stamp
+
+    def _describe(self, filename, path, st):
+        try:
+            # Image.open only parses the header, the pixels are never decoded here
+            with Image.open(path) as img:
+                width, height = img.size
+                if (img.getexif() or {}).get(0x0112) in (5, 6, 7, 8):
+                    width, height = height, width
+        except Exception:
+            return None
+
+        digest = file_digest(path)
+        thumbs = {
+            ext: [(w, f"{self.thumb_url}/{digest[:32]}_{w}.{ext}") for w in self.widths]
+            for ext in THUMB_FORMATS
+        }
+        return {
+            'filename': filename,
+            'path': f'/static/templates_gallery/{filename}',
+            'width': width,
+            'height': height,
+            'aspect_ratio': round(width / height, 4) if height else None,
+            'bytes': st.st_size,
+            'hash': digest,
+            'thumbnail': thumbs['jpg'][1][1],
+            'srcset': ', '.join(f"{url} {w}w" for w, url in thumbs['jpg']),
+            'srcset_webp': ', '.join(f"{url} {w}w" for w, url in thumbs['webp']),
+            '_stat': (st.st_mtime_ns, st.st_size),
+        }
+
+    def public(self, entry):
+        """Entry without internal bookkeeping, ready for JSON"""
+        return {k: v for k, v in entry.items() if not k.startswith('_')}
+
+    def thumbnail(self, name):
+        """Path of a thumbnail file such as '<hash>_320.webp', rendering it on first use
+
+        Returns (path, mime_type) or None when the name does not match a
+        known template and width.
+        """
+        stem, _, ext = name.rpartition('.')
+        digest_prefix, _, width = stem.rpartition('_')
+        if ext not in THUMB_FORMATS or not width.isdigit() or int(width) not in self.widths:
+            return None
+        self._refresh()
+        source = self._by_hash.get(digest_prefix)
+        if source is None:
+            return None
+
+        pil_format, mime_type = THUMB_FORMATS[ext]
+        path = os.path.join(self.thumb_folder, name)
+        if not os.path.exists(path):
+            os.makedirs(self.thumb_folder, exist_ok=True)
+            data = render_thumbnail(os.path.join(self.folder, source['filename']), int(width), pil_format)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return path, mime_type
+
+
+def render_thumbnail(path, width, pil_format='JPEG', quality=80):
+    """Encode a `width`-pixel wide, EXIF-oriented copy of an image"""
+    with Image.open(path) as img:
+        img.draft('RGB', (width, width * 4))
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ('RGB', 'RGBA') or (pil_format == 'JPEG' and img.mode == 'RGBA'):
+            img = img.convert('RGB')
+        if img.width > width:
+            img = img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS)
+        out = io.BytesIO()
+        img.save(out, pil_format, quality=quality, optimize=True)
+    return out.getvalue()
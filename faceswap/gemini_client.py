@@ -0,0 +1,161 @@
+import os
+import threading
+
+from faceswap.core import genai_types
+
+
+class GeminiClientManager:
+    """Process-wide genai.Client built once over a pooled, keep-alive HTTP client
+
+    The client is created lazily on first use and shared by every thread
+    (and, on Netlify, by every warm invocation of the same container); the
+    SDK itself is only imported then, keeping it out of cold starts.
+    `client.aio` gets its own pool with the same limits for asyncio servers.
+    Connection reuse is tracked through httpx trace events so `stats()` can
+    show how many requests rode on an already-open connection.
+    """
+
+    def __init__(self, api_key=None, max_connections=20, max_keepalive=10,
+                 keepalive_expiry=60.0, connect_timeout=10.0, timeout=180.0):
+        self.api_key = api_key
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.keepalive_expiry = keepalive_expiry
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._client = None
+        self._stats_lock = threading.Lock()
+        self._requests = 0
+        self._connections = 0
+        self._tls_handshakes = 0
+        self._errors = 0
+
+    @classmethod
+    def from_env(cls):
+        """Build a manager configured from GEMINI_* environment variables"""
+        return cls(
+            max_connections=int(os.environ.get('GEMINI_POOL_SIZE', 20)),
+            max_keepalive=int(os.environ.get('GEMINI_POOL_KEEPALIVE', 10)),
+            keepalive_expiry=float(os.environ.get('GEMINI_KEEPALIVE_EXPIRY', 60)),
+            connect_timeout=float(os.environ.get('GEMINI_CONNECT_TIMEOUT', 10)),
+            timeout=float(os.environ.get('GEMINI_TIMEOUT', 180)),
+        )
+
+    def get(self):
+        """Return the shared client, creating it on first call"""
+        client = self._client
+        if client is not None:
+            return client
+        with self._lock:
+            if self._client is None:
+                self._client = self._build()
+            return self._client
+
+    def request_options(self, timeout=None):
+        """Per-call HttpOptions; `timeout` (seconds) can shorten the default one
+
+        The SDK applies it to the HTTP request and forwards it upstream as
+        X-Server-Timeout, so the server stops working on a request we are
+        about to give up on.
+        """
+        if timeout is None or timeout > self.timeout:
+            timeout = self.timeout
+        return genai_types().HttpOptions(timeout=max(1, int(timeout * 1000)))
+
+    def warm_up(self, model, background=True):
+        """Open the pooled connection ahead of the first generation
+
+        Fetches the model metadata, which costs no generation quota but pays
+        for DNS, TCP and TLS setup up front.
+        """
+        def run():
+            try:
+                self.get().models.get(model=model)
+            except Exception:
+                with self._stats_lock:
+                    self._errors += 1
+
+        if background:
+            threading.Thread(target=run, name='gemini-warmup', daemon=True).start()
+        else:
+            run()
+
+    def reset(self):
+        """Drop the shared client, e.g. after the API key changes"""
+        with self._lock:
+            self._client = None
+
+    def stats(self):
+        with self._stats_lock:
+            reused = max(0, self._requests - self._connections)
+            return {
+                'created': self._client is not None,
+                'max_connections': self.max_connections,
+                'max_keepalive': self.max_keepalive,
+                'requests': self._requests,
+                'connections_opened': self._connections,
+                'tls_handshakes': self._tls_handshakes,
+                'requests_reusing_connection': reused,
+                'reuse_ratio': reused / self._requests if self._requests else 0.0,
+                'errors': self._errors,
+            }
+
+    def _build(self):
+        import httpx
+        from google import genai
+
+        types = genai_types()
+        limits = httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+        timeout = httpx.Timeout(self.timeout, connect=self.connect_timeout)
+        return genai.Client(
+            api_key=self.api_key or os.environ.get("GEMINI_API_KEY"),
+            http_options=types.HttpOptions(
+                timeout=int(self.timeout * 1000),
+                client_args={
+                    'limits': limits,
+                    'timeout': timeout,
+                    'event_hooks': {
+                        'request': [self._on_request],
+                        'response': [self._on_response],
+                    },
+                },
+                # httpx.AsyncClient awaits its hooks and trace callbacks
+                async_client_args={
+                    'limits': limits,
+                    'timeout': timeout,
+                    'event_hooks': {
+                        'request': [self._on_request_async],
+                        'response': [self._on_response_async],
+                    },
+                },
+            ),
+        )
+
+    def _on_request(self, request):
+        request.extensions['trace'] = self._trace
+
+    def _on_response(self, response):
+        with self._stats_lock:
+            self._requests += 1
+
+    def _trace(self, event_name, info):
+        if event_name == 'connection.connect_tcp.complete':
+            with self._stats_lock:
+                self._connections += 1
+        elif event_name == 'connection.start_tls.complete':
+            with self._stats_lock:
+                self._tls_handshakes += 1
+
+    async def _on_request_async(self, request):
+        request.extensions['trace'] = self._trace_async
+
+    async def _on_response_async(self, response):
+        self._on_response(response)
+
+    async def _trace_async(self, event_name, info):
+        self._trace(event_name, info)
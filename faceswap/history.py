@@ -0,0 +1,249 @@
+"""Server-side record of every generation, in an embedded SQLite database
+
+One row per swap request: who asked (a per-browser session id), the photo
+and template hashes, size, ratio and prompt version, how it ended, its
+stage timings and the output files, which also get a row each so a file in
+static/generated can be traced back to the request that produced it.
+
+The database runs in WAL mode, so readers never block the writer, and every
+thread of every worker process opens its own connection; writes are short
+transactions that wait out each other through busy_timeout. Indexes cover
+the queries the app makes: a session's history newest first (paged by
+cursor), per-template stats and pruning by age.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+QUEUED = 'queued'
+DONE = 'done'
+FAILED = 'failed'
+CACHED = 'cached'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS generations (
+    id INTEGER PRIMARY KEY,
+    job_id TEXT UNIQUE,
+    session_id TEXT NOT NULL,
+    created REAL NOT NULL,
+    finished REAL,
+    status TEXT NOT NULL,
+    user_hash TEXT NOT NULL,
+    template TEXT NOT NULL,
+    template_hash TEXT NOT NULL,
+    image_size TEXT NOT NULL,
+    aspect_ratio TEXT NOT NULL DEFAULT '',
+    prompt_version TEXT NOT NULL,
+    cache_key TEXT NOT NULL,
+    seconds REAL,
+    timings TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS generations_session ON generations (session_id, id);
+CREATE INDEX IF NOT EXISTS generations_template ON generations (template, status, seconds);
+CREATE INDEX IF NOT EXISTS generations_created ON generations (created);
+
+CREATE TABLE IF NOT EXISTS outputs (
+    generation_id INTEGER NOT NULL REFERENCES generations (id) ON DELETE CASCADE,
+    filename TEXT NOT NULL,
+    PRIMARY KEY (generation_id, filename)
+);
+CREATE INDEX IF NOT EXISTS outputs_filename ON outputs (filename);
+"""
+
+
+class HistoryStore:
+    """Generation history in the SQLite database at `path`
+
+    Rows older than `max_age` seconds are dropped by prune(); zero keeps
+    them forever.
+    """
+
+    def __init__(self, path, max_age=0, busy_timeout=5.0):
+        self.path = path
+        self.max_age = max_age
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connect().executescript(SCHEMA)
+
+    @classmethod
+    def from_env(cls, path):
+        """Store at HISTORY_DB (default `path`) keeping HISTORY_MAX_AGE seconds of rows"""
+        return cls(
+            os.environ.get('HISTORY_DB', path),
+            max_age=int(os.environ.get('HISTORY_MAX_AGE', 90 * 24 * 3600)),
+        )
+
+    def _connect(self):
+        # Connections must not cross a fork, so they are per process as well as per thread
+        db = getattr(self._local, 'db', None)
+        if db is not None and self._local.pid == os.getpid():
+            return db
+        db = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('PRAGMA foreign_keys=ON')
+        db = _Connection(db)
+        self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def record(self, session_id, user_hash, template, template_hash, image_size, aspect_ratio,
+               prompt_version, cache_key, job_id=None, files=None):
+        """Add a generation and return its id
+
+        With `files` it is a result served from the cache and is finished
+        right away; otherwise it stays queued until finish(job_id, ...).
+        """
+        now = time.time()
+        status = QUEUED if files is None else CACHED
+        with self._connect() as db:
+            generation_id = db.execute(
+                "INSERT INTO generations (job_id, session_id, created, finished, status, user_hash, template,"
+                " template_hash, image_size, aspect_ratio, prompt_version, cache_key)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, session_id, now, None if files is None else now, status, user_hash, template,
+                 template_hash, image_size, aspect_ratio or '', prompt_version, cache_key),
+            ).lastrowid
+            if files:
+                self._add_outputs(db, generation_id, files)
+        return generation_id
+
+    def finish(self, job_id, status, files=(), seconds=None, timings=None, error=None):
+        """Record how the generation run by `job_id` ended
+
+        `timings` are (stage, seconds) pairs, stored as total ms per stage.
+        """
+        totals = {}
+        for stage, value in timings or ():
+            totals[stage] = round(totals.get(stage, 0) + value * 1000, 1)
+        with self._connect() as db:
+            row = db.execute("SELECT id FROM generations WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None:
+                return
+            db.execute(
+                "UPDATE generations SET status = ?, finished = ?, seconds = ?, timings = ?, error = ? WHERE id = ?",
+                (status, time.time(), seconds, json.dumps(totals) if totals else None, error, row['id']),
+            )
+            self._add_outputs(db, row['id'], files)
+
+    def _add_outputs(self, db, generation_id, files):
+        db.executemany(
+            "INSERT OR IGNORE INTO outputs (generation_id, filename) VALUES (?, ?)",
+            [(generation_id, name) for name in files],
+        )
+
+    def page(self, session_id, cursor=None, limit=20):
+        """A session's generations newest first: ([row dict], next cursor or None)
+
+        A result served again from the cache shares its files with the
+        generation that made it; only the newest of such rows is listed. The
+        cursor is the id of the last row returned, so pages stay stable
+        while new generations are added.
+        """
+        params = [session_id]
+        where = ("session_id = ? AND NOT EXISTS (SELECT 1 FROM outputs o"
+                 " JOIN outputs n ON n.filename = o.filename AND n.generation_id > o.generation_id"
+                 " JOIN generations later ON later.id = n.generation_id AND later.session_id = g.session_id"
+                 " WHERE o.generation_id = g.id)")
+        if cursor is not None:
+            where += " AND g.id < ?"
+            params.append(int(cursor))
+        db = self._connect()
+        rows = db.execute(
+            f"SELECT g.* FROM generations g WHERE {where} ORDER BY g.id DESC LIMIT ?", params + [limit + 1]
+        ).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        outputs = self._outputs(db, [row['id'] for row in rows])
+        items = [self._item(row, outputs.get(row['id'], [])) for row in rows]
+        return items, (str(rows[-1]['id']) if more else None)
+
+    def _outputs(self, db, ids):
+        outputs = {}
+        if ids:
+            marks = ','.join('?' * len(ids))
+            for row in db.execute(
+                f"SELECT generation_id, filename FROM outputs WHERE generation_id IN ({marks}) ORDER BY rowid", ids
+            ):
+                outputs.setdefault(row['generation_id'], []).append(row['filename'])
+        return outputs
+
+    def _item(self, row, files):
+        item = dict(row)
+        item['timings'] = json.loads(row['timings']) if row['timings'] else {}
+        item['files'] = files
+        return item
+
+    def lookup(self, filename):
+        """Every generation that produced (or was served) output `filename`"""
+        db = self._connect()
+        rows = db.execute(
+            "SELECT g.* FROM outputs o JOIN generations g ON g.id = o.generation_id"
+            " WHERE o.filename = ? ORDER BY g.id", (filename,)
+        ).fetchall()
+        outputs = self._outputs(db, [row['id'] for row in rows])
+        return [self._item(row, outputs.get(row['id'], [])) for row in rows]
+
+    def template_stats(self, since=None):
+        """Counts by outcome and mean model seconds per template, busiest first"""
+        where, params = ("WHERE created >= ?", [since]) if since else ("", [])
+        rows = self._connect().execute(
+            "SELECT template, COUNT(*) AS total, SUM(status = ?) AS done, SUM(status = ?) AS failed,"
+            " SUM(status = ?) AS cached, AVG(seconds) AS mean_seconds"
+            f" FROM generations {where} GROUP BY template ORDER BY total DESC", [DONE, FAILED, CACHED] + params
+        ).fetchall()
+        return [dict(row, mean_seconds=round(row['mean_seconds'], 2) if row['mean_seconds'] else None)
+                for row in rows]
+
+    def discard_output(self, filename):
+        """Forget an output file that has been deleted"""
+        with self._connect() as db:
+            db.execute("DELETE FROM outputs WHERE filename = ?", (filename,))
+
+    def prune(self, max_age=None):
+        """Delete generations older than `max_age` (default: the store's) seconds; returns the count"""
+        max_age = self.max_age if max_age is None else max_age
+        if not max_age:
+            return 0
+        with self._connect() as db:
+            return db.execute("DELETE FROM generations WHERE created < ?", (time.time() - max_age,)).rowcount
+
+    def stats(self):
+        db = self._connect()
+        return {
+            'generations': db.execute("SELECT COUNT(*) FROM generations").fetchone()[0],
+            'outputs': db.execute("SELECT COUNT(*) FROM outputs").fetchone()[0],
+            'max_age': self.max_age,
+        }
+
+
+class _Connection:
+    """An autocommit sqlite3 connection whose `with` block is one immediate transaction
+
+    BEGIN IMMEDIATE takes the write lock up front, so concurrent writers
+    queue on busy_timeout instead of failing to upgrade a read lock.
+    """
+
+    def __init__(self, db):
+        self._db = db
+
+    def execute(self, *args):
+        return self._db.execute(*args)
+
+    def executemany(self, *args):
+        return self._db.executemany(*args)
+
+    def executescript(self, script):
+        return self._db.executescript(script)
+
+    def __enter__(self):
+        self._db.execute('BEGIN IMMEDIATE')
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._db.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+        return False
@@ -0,0 +1,69 @@
+import base64
+import mimetypes
+import mmap
+import os
+
+# Below this size a plain read is cheaper than setting up a mapping
+MMAP_THRESHOLD = 256 * 1024
+
+
+def get_mime_type(file_path):
+    """Get MIME type from file path"""
+    mime_type, _ = mimetypes.guess_type(file_path)
+    return mime_type or 'image/png'
+
+
+def sniff_mime(data):
+    """Identify JPEG/PNG/WebP from leading magic bytes"""
+    if data[:3] == b'\xff\xd8\xff':
+        return 'image/jpeg'
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'image/png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+def read_bytes(file_path):
+    """Read a whole file into one bytes object
+
+    Unbuffered FileIO.readall() sizes its allocation from fstat, so the data
+    is copied exactly once, straight from the kernel into the result.
+    """
+    with open(file_path, 'rb', buffering=0) as f:
+        return f.readall()
+
+
+def update_digest(digest, file_path):
+    """Feed a file into a hashlib object, memory-mapping large files to avoid copies"""
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                digest.update(mm)
+            return digest
+        digest.update(f.read())
+    return digest
+
+
+def load_image(source, name=None):
+    """Return (bytes, mime_type) for a path or an in-memory image
+
+    In-memory data (bytes, bytearray) is passed through untouched so callers
+    can feed request bodies straight to the model without a temp file.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        data = bytes(source) if isinstance(source, bytearray) else source
+        return data, sniff_mime(data) or (get_mime_type(name) if name else 'image/png')
+    data = read_bytes(source)
+    return data, sniff_mime(data) or get_mime_type(source)
+
+
+def decode_base64(value):
+    """Decode a base64 JSON field (str or bytes) straight to bytes"""
+    return base64.b64decode(value)
+
+
+def encode_base64(data):
+    """Encode bytes for a JSON response; only call this at the response edge"""
+    return base64.b64encode(data).decode('ascii')
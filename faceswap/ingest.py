@@ -0,0 +1,254 @@
+"""Streaming ingestion of uploaded images
+
+The form parser writes each uploaded file into an Upload as the request
+body arrives. An Upload hashes the bytes on their way to a temporary file,
+enforces the size limit, checks the magic bytes of the first chunk and
+decodes just the image header as soon as enough of it is in, so a file that
+is too big or is not an image is rejected mid-body instead of after it has
+been stored and sent to the model. Only the header is ever held in memory.
+
+Hook it into a framework through the form parser's stream factory (see
+app.py and asgi_app.py), then call accept() on the parsed file field.
+"""
+import hashlib
+import io
+import os
+import threading
+import uuid
+import weakref
+
+from PIL import Image
+
+from faceswap.image_io import sniff_mime
+from faceswap.storage import TEMP_SUFFIX
+
+MB = 1024 * 1024
+
+# Enough leading bytes for sniff_mime()
+MAGIC_BYTES = 12
+
+# The header is decoded once this much has arrived, retrying at twice the
+# size until it fits (large EXIF or ICC blocks push a JPEG's SOF back)
+HEADER_ATTEMPT = 16 * 1024
+HEADER_LIMIT = 1 * MB
+
+
+class Rejected(Exception):
+    """An upload failed a check; `status` is the HTTP status to answer with"""
+
+    def __init__(self, message, status, reason):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+
+
+def _discard(f, path):
+    f.close()
+    if path is not None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class Upload:
+    """Readable and writable stream for one uploaded file, checked as it is written
+
+    After accept(), `digest`, `size`, `mime_type`, `width` and `height`
+    describe the file without reading it again, and commit() moves it into
+    place. An upload that is never committed is deleted when it is closed
+    or garbage collected.
+    """
+
+    def __init__(self, ingestor, path):
+        self.ingestor = ingestor
+        self.path = path
+        self._file = open(path, 'w+b')
+        self._finalizer = weakref.finalize(self, _discard, self._file, path)
+        self._hash = hashlib.sha256()
+        self._head = bytearray()
+        self._next_attempt = HEADER_ATTEMPT
+        self.size = 0
+        self.mime_type = None
+        self.width = None
+        self.height = None
+        self.accepted = False
+
+    @property
+    def digest(self):
+        return self._hash.hexdigest()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.ingestor.max_bytes:
+            self._reject(self.ingestor.too_large())
+        self._hash.update(data)
+        if self.width is None:
+            self._inspect(data)
+        return self._file.write(data)
+
+    def finish(self):
+        """Run the checks that need the whole file (a header that never decoded)"""
+        if self.accepted:
+            return self
+        if self.width is None:
+            if self.mime_type is None:
+                self._reject(self.ingestor.not_image())
+            self._decode_header(final=True)
+        self._file.flush()
+        self._file.seek(0)
+        self.accepted = True
+        self.ingestor.record_accept(self.size)
+        return self
+
+    def commit(self, path):
+        """Move the uploaded file to `path` without copying it"""
+        self._file.flush()
+        os.replace(self.path, path)
+        self._finalizer.detach()
+        self._finalizer = weakref.finalize(self, _discard, self._file, None)
+        self.path = path
+
+    def close(self):
+        self._finalizer()
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def readline(self, size=-1):
+        return self._file.readline(size)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def __getattr__(self, name):
+        if name == '_file':
+            raise AttributeError(name)
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def _inspect(self, data):
+        if len(self._head) < HEADER_LIMIT:
+            self._head += data[:HEADER_LIMIT - len(self._head)]
+        if self.mime_type is None and len(self._head) >= MAGIC_BYTES:
+            self.mime_type = sniff_mime(self._head)
+            if self.mime_type is None:
+                self._reject(self.ingestor.not_image())
+        if self.mime_type is not None and len(self._head) >= self._next_attempt:
+            self._next_attempt *= 2
+            self._decode_header(final=len(self._head) >= HEADER_LIMIT)
+
+    def _decode_header(self, final):
+        try:
+            with Image.open(io.BytesIO(self._head)) as image:
+                width, height = image.size
+        except Image.DecompressionBombError:
+            self._reject(self.ingestor.reject('The photo has too many pixels', 413, 'dimensions'))
+        except Exception:
+            if final:
+                self._reject(self.ingestor.reject('The photo could not be read as an image', 400, 'unreadable'))
+            return
+        error = self.ingestor.check_dimensions(width, height)
+        if error is not None:
+            self._reject(error)
+        self.width, self.height = width, height
+        self._head = bytearray()
+
+    def _reject(self, error):
+        self.close()
+        raise error
+
+
+class Ingestor:
+    """Creates Uploads in `staging_dir` and holds the limits they enforce
+
+    Zero `max_pixels` or `min_side` disables that check. Staged files carry
+    the storage TEMP_SUFFIX, so any left behind by a crash get swept.
+    `on_reject(reason)` lets the caller count rejections.
+    """
+
+    def __init__(self, staging_dir, max_bytes=20 * MB, max_pixels=40_000_000, min_side=64, on_reject=None):
+        self.staging_dir = staging_dir
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.min_side = min_side
+        self.on_reject = on_reject
+        self._lock = threading.Lock()
+        self._accepted = 0
+        self._bytes = 0
+        self._rejected = {}
+
+    @classmethod
+    def from_env(cls, staging_dir, on_reject=None):
+        """Ingestor limited by UPLOAD_MAX_BYTES, UPLOAD_MAX_PIXELS and UPLOAD_MIN_SIDE"""
+        return cls(
+            staging_dir,
+            max_bytes=int(os.environ.get('UPLOAD_MAX_BYTES', 20 * MB)),
+            max_pixels=int(os.environ.get('UPLOAD_MAX_PIXELS', 40_000_000)),
+            min_side=int(os.environ.get('UPLOAD_MIN_SIDE', 64)),
+            on_reject=on_reject,
+        )
+
+    def open(self, content_length=None):
+        """New Upload for one file part; a declared length over the limit is refused outright"""
+        if content_length and content_length > self.max_bytes:
+            raise self.too_large()
+        path = os.path.join(self.staging_dir, f"upload.{uuid.uuid4().hex}{TEMP_SUFFIX}")
+        return Upload(self, path)
+
+    def check_dimensions(self, width, height):
+        """Rejected for an image too small or too large to swap, else None"""
+        if self.min_side and min(width, height) < self.min_side:
+            return self.reject(f'The photo must be at least {self.min_side}px on each side', 400, 'dimensions')
+        if self.max_pixels and width * height > self.max_pixels:
+            return self.reject(f'The photo must be at most {self.max_pixels // 1_000_000} megapixels', 413, 'dimensions')
+        return None
+
+    def too_large(self):
+        return self.reject(f'The photo must be at most {self.max_bytes // MB} MB', 413, 'too_large')
+
+    def not_image(self):
+        return self.reject('Please upload a JPEG, PNG or WebP image', 415, 'not_image')
+
+    def reject(self, message, status, reason):
+        with self._lock:
+            self._rejected[reason] = self._rejected.get(reason, 0) + 1
+        if self.on_reject is not None:
+            self.on_reject(reason)
+        return Rejected(message, status, reason)
+
+    def record_accept(self, size):
+        with self._lock:
+            self._accepted += 1
+            self._bytes += size
+
+    def stats(self):
+        with self._lock:
+            return {
+                'accepted': self._accepted,
+                'accepted_bytes': self._bytes,
+                'rejected': dict(self._rejected),
+                'max_bytes': self.max_bytes,
+                'max_pixels': self.max_pixels,
+                'min_side': self.min_side,
+            }
+
+
+def accept(file_storage):
+    """The checked Upload behind a parsed file field
+
+    Raises Rejected if the file fails the checks that need all of it.
+    """
+    upload = file_storage.stream
+    if not isinstance(upload, Upload):
+        raise TypeError('File was not parsed through an Ingestor; see faceswap.ingest')
+    return upload.finish()
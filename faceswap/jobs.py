@@ -0,0 +1,532 @@
+import asyncio
+import contextlib
+import contextvars
+import logging
+import threading
+import time
+import uuid
+
+from faceswap.scheduler import FifoScheduler
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Why a job was cancelled
+CLIENT = 'client'
+DEADLINE = 'deadline'
+ABANDONED = 'abandoned'
+SPECULATION = 'speculation'  # a speculative job that was not adopted
+
+# Seconds between sweeps for overdue and abandoned jobs
+SWEEP_INTERVAL = 2.0
+
+# A context variable rather than a thread-local, so asyncio tasks (and the
+# threads they hand work to) each see their own job
+_current = contextvars.ContextVar('current_job', default=None)
+
+
+def current_job():
+    """Job being executed by the calling worker thread or task, or None"""
+    return _current.get()
+
+
+def checkpoint():
+    """Raise Cancelled if the current job should stop; long-running work calls this between steps"""
+    job = _current.get()
+    if job is not None:
+        job.check()
+
+class Cancelled(Exception):
+    """A job was stopped before it finished; `reason` is CLIENT, DEADLINE or ABANDONED"""
+
+    MESSAGES = {
+        CLIENT: 'Cancelled',
+        DEADLINE: 'Generation took too long and was stopped, please try again',
+        ABANDONED: 'Cancelled because nobody was waiting for the result',
+    }
+
+    def __init__(self, reason):
+        super().__init__(self.MESSAGES.get(reason, 'Cancelled'))
+        self.reason = reason
+
+
+class EventLog:
+    """Append-only list of progress events that readers can block on
+
+    Readers also register interest: streams hold `watching()` open and
+    pollers call `touch()`, so `idle_for()` tells when nobody is following.
+    """
+
+    def __init__(self):
+        self.events = []
+        self._events_cond = threading.Condition()
+        self._async_waiters = []
+        self.watchers = 0
+        self.last_seen = time.monotonic()
+
+    @property
+    def finished(self):
+        return False
+
+    def touch(self):
+        """Record that a client just asked about this log"""
+        self.last_seen = time.monotonic()
+
+    @contextlib.contextmanager
+    def watching(self):
+        """Count a streaming client for as long as the block runs"""
+        with self._events_cond:
+            self.watchers += 1
+        try:
+            yield
+        finally:
+            with self._events_cond:
+                self.watchers -= 1
+                self.last_seen = time.monotonic()
+
+    def idle_for(self):
+        """Seconds since a client last streamed or polled this log, 0 while one is streaming"""
+        with self._events_cond:
+            return 0.0 if self.watchers else time.monotonic() - self.last_seen
+
+    def emit(self, event, **data):
+        """Append a progress event and wake up anyone streaming it"""
+        data['event'] = event
+        data['time'] = time.time()
+        with self._events_cond:
+            self.events.append(data)
+            self._events_cond.notify_all()
+            waiters = list(self._async_waiters)
+        for loop, woken in waiters:
+            try:
+                loop.call_soon_threadsafe(woken.set)
+            except RuntimeError:
+                pass  # Loop already closed
+
+    def wait_events(self, since, timeout=None):
+        """Return events after index `since`, blocking up to timeout for new ones"""
+        with self._events_cond:
+            if len(self.events) <= since and not self.finished:
+                self._events_cond.wait(timeout)
+            return self.events[since:]
+
+    async def wait_events_async(self, since, timeout=None):
+        """wait_events for coroutines: waits without holding a thread"""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._events_cond:
+            if len(self.events) > since or self.finished:
+                return self.events[since:]
+            self._async_waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._events_cond:
+                self._async_waiters.remove(waiter)
+        with self._events_cond:
+            return self.events[since:]
+
+
+def _detach(exc):
+    """Drop traceback frames, and the image buffers they reference, from an exception chain"""
+    pending = [exc]
+    while pending:
+        e = pending.pop()
+        if e is not None and e.__traceback__ is not None:
+            e.__traceback__ = None
+            pending += [e.__cause__, e.__context__]
+    return exc
+
+
+class Job(EventLog):
+    """A single unit of background work and its outcome
+
+    `timeout` (seconds from creation) sets a deadline, after which the job
+    is cancelled. Clients following `owner` (e.g. the batch the job belongs
+    to) count as following the job itself. `lane` and `client` are what a
+    FairScheduler shares workers by, e.g. the output size and the caller.
+    """
+
+    def __init__(self, func, args, kwargs, timeout=None, owner=None, lane=None, client=None):
+        super().__init__()
+        self.id = str(uuid.uuid4())
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.exception = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._callbacks = []
+        self.timings = []
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.owner = owner
+        self.lane = lane
+        self.client = client
+        self.cancel_reason = None
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+    def remaining(self):
+        """Seconds left before the deadline, or None without one"""
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def reset_deadline(self, timeout):
+        """Give the job `timeout` seconds from now instead, e.g. once a client adopts it"""
+        self.deadline = time.monotonic() + timeout if timeout else None
+
+    def cancelled(self):
+        """Why the job should stop now, or None; running out of time counts as DEADLINE"""
+        if self.cancel_reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+            return DEADLINE
+        return self.cancel_reason
+
+    def check(self):
+        """Raise Cancelled if the job should stop"""
+        reason = self.cancelled()
+        if reason is not None:
+            self.cancel_reason = reason
+            raise Cancelled(reason)
+
+    def overdue(self, abandon_after=0):
+        """Reason to cancel the job now: DEADLINE, ABANDONED or None
+
+        A job is abandoned once no client has followed it (or its owner) for
+        `abandon_after` seconds; zero disables that check.
+        """
+        reason = self.cancelled()
+        if reason is None and abandon_after and (self.owner or self).idle_for() > abandon_after:
+            reason = ABANDONED
+        return reason
+
+    def add_done_callback(self, fn):
+        """Call fn(job) once the job has finished, immediately if it already has"""
+        with self._events_cond:
+            if not self.finished:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _settle(self, result=None, exc=None):
+        """Record the outcome and tell anyone streaming this job"""
+        with self._events_cond:
+            if exc is None:
+                self.result = result
+            else:
+                self.error = str(exc) or type(exc).__name__
+                self.exception = _detach(exc)
+                if isinstance(exc, Cancelled) and self.cancel_reason is None:
+                    self.cancel_reason = exc.reason
+            self.finished_at = time.time()
+            self.status = DONE if exc is None else FAILED
+        if exc is None:
+            self.emit('status', status=DONE)
+        else:
+            self.emit('status', status=FAILED, error=self.error)
+
+    def _run_callbacks(self):
+        with self._events_cond:
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logger.exception("Job %s done callback failed", self.id)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'error': self.error,
+            'cancelled': self.cancel_reason,
+        }
+
+
+class JobQueue:
+    """Job queue drained by a fixed pool of worker threads
+
+    `scheduler` picks which waiting job runs next (see faceswap/scheduler.py);
+    by default it is arrival order.
+
+    Workers are started lazily on the first submit so that importing the app
+    (e.g. gunicorn --preload) does not spawn threads before forking.
+    Finished jobs are kept for `ttl` seconds so clients can collect results.
+    `on_change(queued, running)` is called whenever either count changes.
+
+    A sweeper cancels jobs that pass their deadline or that no client has
+    followed for `abandon_after` seconds; `on_cancel(job)` is called for
+    every cancelled job.
+    """
+
+    def __init__(self, workers=4, ttl=3600, on_change=None, abandon_after=0, on_cancel=None, scheduler=None):
+        self.workers = max(1, int(workers))
+        self.ttl = ttl
+        self.on_change = on_change
+        self.abandon_after = abandon_after
+        self.on_cancel = on_cancel
+        self._cond = threading.Condition()
+        self._jobs = {}
+        self._scheduler = scheduler if scheduler is not None else FifoScheduler(self.workers)
+        self._running = 0
+        self._cancelled = 0
+        self._threads = []
+        self._sweeper = None
+
+    def submit(self, func, *args, **kwargs):
+        """Enqueue `func(*args, **kwargs)` and return its Job"""
+        return self.enqueue(Job(func, args, kwargs))
+
+    def enqueue(self, job):
+        """Enqueue a Job built by the caller, e.g. one with a deadline"""
+        with self._cond:
+            self._prune()
+            self._ensure_started()
+            self._jobs[job.id] = job
+            self._scheduler.push(job)
+            job.emit('status', status=QUEUED, position=self._scheduler.position(job),
+                     estimated_wait=round(self._scheduler.estimated_wait(job), 1))
+            self._cond.notify()
+            self._changed()
+        return job
+
+    def get(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job, reason=CLIENT):
+        """Stop a job: a queued one finishes at once, a running one at its next checkpoint
+
+        Returns False if the job had already finished or been cancelled.
+        """
+        with self._cond:
+            if job.finished or job.cancel_reason is not None:
+                return False
+            job.cancel_reason = reason
+            queued = self._scheduler.remove(job)
+            if queued:
+                self._changed()
+        if queued:
+            job.func = job.args = job.kwargs = None
+            self._settle(job, exc=Cancelled(reason))
+            job._run_callbacks()
+        else:
+            self._interrupt(job)
+        return True
+
+    def sweep(self):
+        """Cancel jobs that are past their deadline or that nobody is following"""
+        with self._cond:
+            active = [job for job in self._jobs.values() if not job.finished and job.cancel_reason is None]
+        for job in active:
+            reason = job.overdue(self.abandon_after)
+            if reason is not None:
+                self.cancel(job, reason)
+
+    def position(self, job):
+        """1-based position of a queued job (within its lane, if any), 0 once it has left the queue"""
+        with self._cond:
+            return self._scheduler.position(job)
+
+    def promote(self, job, lane):
+        """Move a queued job to `lane`, e.g. once nobody can call it low priority any more
+
+        Returns False if the job has already left the queue; a running job
+        keeps the lane it was started from.
+        """
+        with self._cond:
+            if job.lane == lane or not self._scheduler.move(job, lane):
+                return False
+            self._cond.notify()
+        return True
+
+    def estimated_wait(self, job):
+        """Seconds until a queued job is likely to start, 0 once it has"""
+        with self._cond:
+            return self._scheduler.estimated_wait(job)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'workers': self.workers,
+                'queued': len(self._scheduler),
+                'running': self._running,
+                'tracked': len(self._jobs),
+                'cancelled': self._cancelled,
+                'scheduler': self._scheduler.stats(),
+            }
+
+    def _changed(self):
+        # Called with self._cond held
+        if self.on_change is not None:
+            self.on_change(len(self._scheduler), self._running)
+
+    def _ensure_started(self):
+        self._threads = [t for t in self._threads if t.is_alive()]
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker, name='swap-worker', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        if self._sweeper is None or not self._sweeper.is_alive():
+            self._sweeper = threading.Thread(target=self._sweep_forever, name='swap-sweeper', daemon=True)
+            self._sweeper.start()
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(SWEEP_INTERVAL)
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("Job sweep failed")
+
+    def _interrupt(self, job):
+        # Worker threads cannot be interrupted; the job stops at its next checkpoint()
+        pass
+
+    def _start(self, job):
+        """Announce a job that has just left the queue, unless it is already overdue"""
+        reason = job.overdue(self.abandon_after)
+        if reason is not None:
+            job.cancel_reason = reason
+            raise Cancelled(reason)
+        job.emit('status', status=RUNNING)
+
+    def _settle(self, job, result=None, exc=None):
+        job._settle(result, exc)
+        if isinstance(exc, Cancelled):
+            with self._cond:
+                self._cancelled += 1
+            if self.on_cancel is not None:
+                self.on_cancel(job)
+
+    def _prune(self):
+        cutoff = time.time() - self.ttl
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished and job.finished_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while (job := self._scheduler.pop()) is None:
+                    self._cond.wait()
+                job.status = RUNNING
+                job.started_at = time.time()
+                self._running += 1
+                self._changed()
+
+            _current.set(job)
+            try:
+                self._start(job)
+                result = job.func(*job.args, **job.kwargs)
+            except Exception as e:
+                self._settle(job, exc=e)
+            else:
+                self._settle(job, result)
+            finally:
+                _current.set(None)
+                job.func = job.args = job.kwargs = None
+                with self._cond:
+                    self._scheduler.finished(job)
+                    self._running -= 1
+                    self._changed()
+                    # The slot may let a job from a capped lane start on another worker
+                    self._cond.notify()
+            job._run_callbacks()
+
+
+class AsyncJobQueue(JobQueue):
+    """JobQueue for asyncio servers: jobs are coroutine functions run as tasks
+
+    Up to `workers` jobs run concurrently on the event loop; the rest wait
+    for `scheduler` to pick them. A waiting generation costs a task, not a thread, so this can
+    be set in the hundreds. Use it from the event loop thread only.
+    Cancelling a running job cancels its task.
+    """
+
+    def __init__(self, workers=256, ttl=3600, on_change=None, abandon_after=0, on_cancel=None, scheduler=None):
+        super().__init__(workers=workers, ttl=ttl, on_change=on_change,
+                         abandon_after=abandon_after, on_cancel=on_cancel, scheduler=scheduler)
+        self._tasks = {}
+
+    def _ensure_started(self):
+        # Jobs are dispatched as tasks from enqueue(), there are no threads
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.get_running_loop().create_task(self._sweep_forever())
+
+    async def _sweep_forever(self):
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("Job sweep failed")
+
+    def _interrupt(self, job):
+        task = self._tasks.get(job.id)
+        if task is not None:
+            task.cancel()
+
+    def enqueue(self, job):
+        job = super().enqueue(job)
+        self._dispatch()
+        return job
+
+    def promote(self, job, lane):
+        promoted = super().promote(job, lane)
+        if promoted:
+            self._dispatch()
+        return promoted
+
+    def _dispatch(self):
+        with self._cond:
+            started = []
+            while self._running < self.workers and (job := self._scheduler.pop()) is not None:
+                job.status = RUNNING
+                job.started_at = time.time()
+                self._running += 1
+                started.append(job)
+            if started:
+                self._changed()
+        for job in started:
+            task = asyncio.get_running_loop().create_task(self._run(job))
+            # The loop only keeps weak references to tasks
+            self._tasks[job.id] = task
+            task.add_done_callback(lambda task, job_id=job.id: self._tasks.pop(job_id, None))
+
+    async def _run(self, job):
+        _current.set(job)
+        try:
+            self._start(job)
+            result = await job.func(*job.args, **job.kwargs)
+        except asyncio.CancelledError as e:
+            if job.cancel_reason is None:
+                # Not ours, e.g. the server shutting down
+                self._settle(job, exc=e)
+                raise
+            self._settle(job, exc=Cancelled(job.cancel_reason))
+        except Exception as e:
+            self._settle(job, exc=e)
+        else:
+            self._settle(job, result)
+        finally:
+            job.func = job.args = job.kwargs = None
+            with self._cond:
+                self._scheduler.finished(job)
+                self._running -= 1
+                self._changed()
+            job._run_callbacks()
+            self._dispatch()
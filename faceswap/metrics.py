@@ -0,0 +1,143 @@
+"""Prometheus metrics and Server-Timing helpers
+
+Set PROMETHEUS_MULTIPROC_DIR (to an empty, writable directory) before the
+app is imported to aggregate metrics across gunicorn workers; see
+gunicorn.conf.py for the matching worker-exit hook.
+"""
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120, 180)
+
+STAGE_SECONDS = Histogram(
+    'faceswap_stage_seconds',
+    'Time spent in each stage of a face swap request',
+    ['stage', 'image_size'],
+    buckets=LATENCY_BUCKETS,
+)
+GENERATION_SECONDS = Histogram(
+    'faceswap_generation_seconds',
+    'End-to-end model generation time per template',
+    ['image_size', 'template'],
+    buckets=LATENCY_BUCKETS,
+)
+BYTES = Counter(
+    'faceswap_bytes_total',
+    'Image bytes moved, by direction (upload, model_in, model_out)',
+    ['direction'],
+)
+ERRORS = Counter(
+    'faceswap_errors_total',
+    'Exceptions raised, by stage and exception class',
+    ['stage', 'error'],
+)
+SHED = Counter(
+    'faceswap_shed_total',
+    'Requests turned away by admission control, by reason',
+    ['reason'],
+)
+RETRIES = Counter(
+    'faceswap_upstream_retries_total',
+    'Model calls retried after a transient upstream error',
+    ['error'],
+)
+CANCELLED = Counter(
+    'faceswap_cancelled_total',
+    'Jobs cancelled before finishing, by reason and the last stage they reached',
+    ['reason', 'stage'],
+)
+CANCELLED_MODEL_SECONDS = Counter(
+    'faceswap_cancelled_model_seconds_total',
+    'Time cancelled generations had spent waiting on the model, i.e. quota thrown away',
+    ['reason'],
+)
+STORAGE_BYTES = Gauge(
+    'faceswap_storage_bytes',
+    'Bytes held in each managed folder as of the last sweep',
+    ['folder'],
+    multiprocess_mode='max',
+)
+STORAGE_RECLAIMED_BYTES = Counter(
+    'faceswap_storage_reclaimed_bytes_total',
+    'Bytes deleted by the storage sweeper, by folder and reason (age, size, temp)',
+    ['folder', 'reason'],
+)
+UPLOADS_REJECTED = Counter(
+    'faceswap_uploads_rejected_total',
+    'Uploads refused while streaming in, by reason (too_large, not_image, unreadable, dimensions)',
+    ['reason'],
+)
+SPECULATIONS = Counter(
+    'faceswap_speculations_total',
+    'Speculative generations by how they ended (adopted, superseded, expired) or why none was started',
+    ['outcome'],
+)
+SPECULATION_SAVED_SECONDS = Histogram(
+    'faceswap_speculation_saved_seconds',
+    'Head start an adopted speculative generation had when the user asked for it',
+    buckets=LATENCY_BUCKETS,
+)
+QUEUE_DEPTH = Gauge(
+    'faceswap_queue_depth',
+    'Jobs waiting for a worker',
+    multiprocess_mode='livesum',
+)
+JOBS_RUNNING = Gauge(
+    'faceswap_jobs_running',
+    'Jobs currently being generated',
+    multiprocess_mode='livesum',
+)
+
+
+@contextmanager
+def stage(name, image_size='', sink=None):
+    """Time a block as `name`, recording it in the histogram and in `sink`
+
+    `sink` is a list collecting (stage, seconds) pairs for a Server-Timing
+    header. Exceptions are counted against the stage and re-raised.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        ERRORS.labels(name, type(e).__name__).inc()
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(name, image_size).observe(elapsed)
+        if sink is not None:
+            sink.append((name, elapsed))
+
+
+def observe(name, seconds, image_size='', sink=None):
+    """Record a duration measured outside of a `stage` block"""
+    STAGE_SECONDS.labels(name, image_size).observe(seconds)
+    if sink is not None:
+        sink.append((name, seconds))
+
+
+def server_timing(timings):
+    """Format (stage, seconds) pairs as a Server-Timing header value"""
+    return ', '.join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings)
+
+
+def render():
+    """Current metrics in the Prometheus text format, merged across workers if needed"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,87 @@
+"""Where generated images are written, and the URLs they are served from
+
+With a store configured, the Netlify generate function puts each image
+there as it arrives from the model stream and answers with its URL instead
+of base64 in the response body. LocalStore is a directory served by the
+site (by default static/generated, served as /generated/), which only works
+where the function can write to what the site serves, e.g. `netlify dev`; a
+blob store plugs in through OBJECT_STORE, naming a factory that builds it:
+
+    OBJECT_STORE=                             # default: images inline in the response
+    OBJECT_STORE=local
+    OBJECT_STORE=mypackage.blobs:from_env     # any callable returning a store
+
+A store needs put(key, data, content_type) returning the object's URL,
+url(key) and delete(key). A store that cannot be built or written to
+raises ConfigurationError.
+"""
+import importlib
+import os
+
+from faceswap.storage import TEMP_SUFFIX
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ConfigurationError(Exception):
+    """OBJECT_STORE names a store that cannot be built or written to"""
+
+
+class LocalStore:
+    """Objects kept as files in `folder`, served under `base_url`"""
+
+    def __init__(self, folder, base_url):
+        self.folder = folder
+        self.base_url = base_url.rstrip('/') + '/'
+
+    @classmethod
+    def from_env(cls):
+        """Store in OBJECT_STORE_DIR, served under OBJECT_STORE_URL"""
+        return cls(
+            os.environ.get('OBJECT_STORE_DIR', os.path.join(BASE_DIR, 'static', 'generated')),
+            os.environ.get('OBJECT_STORE_URL', '/generated/'),
+        )
+
+    def path(self, key):
+        if not key or os.path.basename(key) != key or key.startswith('.'):
+            raise ValueError(f'Invalid object key: {key!r}')
+        return os.path.join(self.folder, key)
+
+    def put(self, key, data, content_type=None):
+        """Write `data` under `key` and return its URL; readers never see a partial file"""
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}{TEMP_SUFFIX}"
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            raise ConfigurationError(f'Cannot write generated images to {self.folder}: {e}') from e
+        return self.url(key)
+
+    def url(self, key):
+        return self.base_url + key
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+def from_env():
+    """The store named by OBJECT_STORE, or None if it is unset"""
+    spec = os.environ.get('OBJECT_STORE', '').strip()
+    if not spec:
+        return None
+    if spec == 'local':
+        return LocalStore.from_env()
+    module_name, _, attr = spec.partition(':')
+    if not attr:
+        raise ConfigurationError(f"OBJECT_STORE must be 'local' or 'module:factory', not {spec!r}")
+    try:
+        factory = getattr(importlib.import_module(module_name), attr)
+    except (ImportError, AttributeError) as e:
+        raise ConfigurationError(f'OBJECT_STORE={spec}: {e}') from e
+    return factory()
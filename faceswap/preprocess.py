@@ -0,0 +1,341 @@
+import collections
+import functools
+import io
+import itertools
+import logging
+import os
+import threading
+
+from PIL import Image, ImageEnhance, ImageFilter, ImageOps
+
+from faceswap.image_io import get_mime_type, load_image, sniff_mime
+from faceswap.result_cache import file_digest
+
+logger = logging.getLogger(__name__)
+
+# Longest edge sent to the model for each requested output size. The model
+# re-samples its inputs internally, so anything much larger only costs upload
+# time and latency.
+MAX_INPUT_EDGE = {
+    "1K": 1024,
+    "2K": 1536,
+    "4K": 2048,
+}
+
+# Output aspect ratios offered to users; templates get a variant framed for each
+ASPECT_RATIOS = ["1:1", "16:9", "9:16", "4:3", "3:4", "3:2", "2:3"]
+
+# Crop a template to a new aspect ratio only while this much of it survives;
+# beyond that it is padded instead
+REFRAME_MIN_KEEP = 0.6
+
+FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg', '.jpg'),
+    'webp': ('WEBP', 'image/webp', '.webp'),
+}
+
+
+def open_rgb(source, draft_edge):
+    """Decode an image as EXIF-oriented RGB, transparency flattened onto white
+
+    JPEGs are decoded at reduced scale down to about `draft_edge` pixels.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    with Image.open(source) as img:
+        # Let the JPEG decoder scale down by 1/2..1/8 instead of decoding full size
+        img.draft('RGB', (draft_edge, draft_edge))
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel('A'))
+            return background
+        if img.mode != 'RGB':
+            return img.convert('RGB')
+        img.load()
+        return img
+
+
+def encode_image(img, max_edge, fmt='jpeg', quality=90):
+    """Downsample an RGB image to `max_edge` and encode it; returns (bytes, mime_type)"""
+    pil_format, mime_type, _ = FORMATS[fmt]
+    if max(img.size) > max_edge:
+        img = img.copy()
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    out = io.BytesIO()
+    img.save(out, pil_format, quality=quality, optimize=True)
+    return out.getvalue(), mime_type
+
+
+def normalize_image(source, max_edge, fmt='jpeg', quality=90, crop=None):
+    """Decode, EXIF-orient, downsample and re-encode an image
+
+    `source` is a path, a binary file object or the encoded bytes. Metadata is dropped and
+    transparency is flattened onto white. `crop(img)` may replace the oriented
+    RGB image, e.g. with a region of it. Returns (bytes, mime_type).
+    """
+    # A crop keeps only part of the picture, so it needs more pixels
+    img = open_rgb(source, max_edge * 2 if crop is not None else max_edge)
+    if crop is not None:
+        img = crop(img)
+    return encode_image(img, max_edge, fmt, quality)
+
+
+def parse_ratio(aspect_ratio):
+    """Width / height for a "W:H" string, or None if it is not one"""
+    try:
+        width, height = (int(n) for n in aspect_ratio.split(':'))
+    except (AttributeError, ValueError):
+        return None
+    return width / height if width > 0 and height > 0 else None
+
+
+def fit_to_ratio(img, aspect_ratio, min_keep=REFRAME_MIN_KEEP):
+    """Reframe an RGB image to `aspect_ratio` ("W:H") by cropping or padding
+
+    The crop keeps the window with the most detail (edge energy) along the
+    axis being cut. When it would keep less than `min_keep` of the picture,
+    e.g. a portrait template asked for 16:9, the whole image is instead
+    centred on a blurred, darkened copy of itself filling the new frame.
+    """
+    ratio = parse_ratio(aspect_ratio)
+    if ratio is None:
+        return img
+    width, height = img.size
+    if abs(width / height - ratio) < 0.01 * ratio:
+        return img
+    if width / height > ratio:
+        window = round(height * ratio)
+        if window / width >= min_keep:
+            left = _salient_offset(img, window, horizontal=True)
+            return img.crop((left, 0, left + window, height))
+        canvas = (width, round(width / ratio))
+    else:
+        window = round(width / ratio)
+        if window / height >= min_keep:
+            top = _salient_offset(img, window, horizontal=False)
+            return img.crop((0, top, width, top + window))
+        canvas = (round(height * ratio), height)
+
+    small = img.copy()
+    small.thumbnail((256, 256), Image.BILINEAR)
+    scale = max(canvas) / 256
+    backdrop = ImageOps.fit(small, (max(1, round(canvas[0] / scale)), max(1, round(canvas[1] / scale))))
+    backdrop = ImageEnhance.Brightness(backdrop.filter(ImageFilter.GaussianBlur(8))).enhance(0.7)
+    backdrop = backdrop.resize(canvas, Image.BILINEAR)
+    backdrop.paste(img, ((canvas[0] - width) // 2, (canvas[1] - height) // 2))
+    return backdrop
+
+
+def _salient_offset(img, window, horizontal):
+    """Start of the `window`-long span along one axis with the most edge energy"""
+    length = img.width if horizontal else img.height
+    edges = img.convert('L')
+    edges.thumbnail((128, 128), Image.BILINEAR)
+    edges = edges.filter(ImageFilter.FIND_EDGES)
+    columns, rows = edges.size
+    pixels = edges.tobytes()
+    if horizontal:
+        profile = [sum(pixels[x::columns]) for x in range(columns)]
+    else:
+        profile = [sum(pixels[y * columns:(y + 1) * columns]) for y in range(rows)]
+
+    scale = length / len(profile)
+    span = min(len(profile), max(1, round(window / scale)))
+    centre = (len(profile) - span) / 2
+    prefix = list(itertools.accumulate(profile, initial=0))
+    # Ties (flat backgrounds) go to the centred window
+    best = max(range(len(profile) - span + 1),
+               key=lambda start: (prefix[start + span] - prefix[start], -abs(start - centre)))
+    return min(length - window, max(0, round(best * scale)))
+
+
+class Preprocessor:
+    """Normalizes model inputs and keeps per-size template variants on disk
+
+    With a `face_cropper` (see faceswap.face_crop), user photos are cut down
+    to the face before downsampling. Templates are cached whole and reframed
+    for each of ASPECT_RATIOS, per size: 3 sizes x 8 framings, a few MB per
+    template as 90% JPEG.
+    """
+
+    def __init__(self, cache_folder, fmt='jpeg', quality=90, enabled=True, recent_size=16, face_cropper=None):
+        self.cache_folder = cache_folder
+        self.fmt = fmt
+        self.quality = quality
+        self.enabled = enabled
+        self.recent_size = recent_size
+        self.face_cropper = face_cropper
+        self._lock = threading.Lock()
+        self._recent = collections.OrderedDict()
+        self.images = 0
+        self.template_cache_hits = 0
+        self.failures = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def max_edge(self, image_size):
+        return MAX_INPUT_EDGE.get(image_size, MAX_INPUT_EDGE["2K"])
+
+    def user_image(self, source, image_size, fallback_mime='image/png'):
+        """Return (bytes, mime_type, bytes_before) for an uploaded photo (path or bytes)
+
+        Results for paths are remembered briefly so a batch that sends one
+        photo to many templates decodes and resizes it only once.
+        """
+        memo_key = None
+        if not isinstance(source, (bytes, bytearray)):
+            st = os.stat(source)
+            memo_key = (source, st.st_mtime_ns, st.st_size, self.max_edge(image_size))
+            with self._lock:
+                memo = self._recent.get(memo_key)
+                if memo is not None:
+                    self._recent.move_to_end(memo_key)
+            if memo is not None:
+                self._count(memo[2], len(memo[0]))
+                return memo
+
+        crop = self.face_cropper.crop if self.face_cropper is not None else None
+        data, mime_type, before, _ = self._normalize(source, image_size, fallback_mime, crop)
+        self._count(before, len(data))
+        if memo_key is not None:
+            with self._lock:
+                self._recent[memo_key] = (data, mime_type, before)
+                while len(self._recent) > self.recent_size:
+                    self._recent.popitem(last=False)
+        return data, mime_type, before
+
+    def template_image(self, path, image_size, fallback_mime='image/png', aspect_ratio=None):
+        """Like user_image, but reuses a normalized variant cached per (template, size, ratio)
+
+        With one of ASPECT_RATIOS the template is first reframed to it (see
+        fit_to_ratio), so the model starts from the composition it is asked
+        for. Variants are usually rendered ahead of time by
+        render_template_variants(); a missing one is rendered here.
+        """
+        if aspect_ratio not in ASPECT_RATIOS:
+            aspect_ratio = None
+        if not self.enabled:
+            data, mime_type, before, _ = self._normalize(path, image_size, fallback_mime)
+            self._count(before, len(data))
+            return data, mime_type, before
+
+        cache_path = self.variant_path(file_digest(path), self.max_edge(image_size), aspect_ratio)
+        try:
+            with open(cache_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            pass
+        else:
+            before = os.path.getsize(path)
+            with self._lock:
+                self.template_cache_hits += 1
+            self._count(before, len(data))
+            return data, sniff_mime(data) or FORMATS[self.fmt][1], before
+
+        crop = functools.partial(fit_to_ratio, aspect_ratio=aspect_ratio) if aspect_ratio else None
+        data, mime_type, before, normalized = self._normalize(path, image_size, fallback_mime, crop)
+        # Re-encoding an already small JPEG/WebP can make it bigger; templates
+        # carry no user metadata, so keep the original bytes in that case
+        if (normalized and aspect_ratio is None and len(data) >= before
+                and get_mime_type(path) in ('image/jpeg', 'image/webp')):
+            data, mime_type = load_image(path)
+        self._count(before, len(data))
+        if normalized:
+            self._store(cache_path, data)
+        return data, mime_type, before
+
+    def variant_path(self, digest, max_edge, aspect_ratio=None):
+        """Where the template with content `digest` is cached for one size and ratio"""
+        ext = FORMATS[self.fmt][2]
+        ratio = f"_{aspect_ratio.replace(':', 'x')}" if aspect_ratio else ''
+        return os.path.join(self.cache_folder, f"{digest}_{max_edge}_{self.quality}{ratio}{ext}")
+
+    def render_template_variants(self, path, force=False):
+        """Write every missing (size, aspect ratio) variant of a template; returns how many
+
+        The template is decoded once at the largest size and every variant is
+        cut from that, which is what makes pre-rendering cheaper than letting
+        requests fill the cache one variant at a time.
+        """
+        if not self.enabled:
+            return 0
+        digest = file_digest(path)
+        edges = sorted(set(MAX_INPUT_EDGE.values()), reverse=True)
+        wanted = [(edge, ratio) for ratio in [None] + ASPECT_RATIOS for edge in edges
+                  if force or not os.path.exists(self.variant_path(digest, edge, ratio))]
+        if not wanted:
+            return 0
+
+        before = os.path.getsize(path)
+        original = open_rgb(path, edges[0] * 2)
+        framed = {}
+        for edge, ratio in wanted:
+            if ratio not in framed:
+                framed[ratio] = fit_to_ratio(original, ratio) if ratio else original
+            data, _ = encode_image(framed[ratio], edge, self.fmt, self.quality)
+            if ratio is None and len(data) >= before and get_mime_type(path) in ('image/jpeg', 'image/webp'):
+                data, _ = load_image(path)
+            self._store(self.variant_path(digest, edge, ratio), data)
+        return len(wanted)
+
+    def discard_template_variants(self, digest):
+        """Delete every cached variant of the template with content `digest`"""
+        removed = 0
+        prefix = f"{digest}_"
+        try:
+            names = os.listdir(self.cache_folder)
+        except FileNotFoundError:
+            return 0
+        for name in names:
+            if name.startswith(prefix):
+                try:
+                    os.remove(os.path.join(self.cache_folder, name))
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    def _store(self, cache_path, data):
+        os.makedirs(self.cache_folder, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, cache_path)
+
+    def _normalize(self, source, image_size, fallback_mime, crop=None):
+        in_memory = isinstance(source, (bytes, bytearray))
+        before = len(source) if in_memory else os.path.getsize(source)
+        if self.enabled:
+            try:
+                data, mime_type = normalize_image(source, self.max_edge(image_size), self.fmt, self.quality, crop)
+            except Exception as e:
+                logger.warning("Could not normalize %s, sending original: %s",
+                               'upload' if in_memory else source, e)
+                with self._lock:
+                    self.failures += 1
+            else:
+                return data, mime_type, before, True
+        data, _ = load_image(source)
+        return data, sniff_mime(data) or fallback_mime, before, False
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'format': self.fmt,
+                'images': self.images,
+                'template_cache_hits': self.template_cache_hits,
+                'failures': self.failures,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'saved_ratio': 1 - self.bytes_out / self.bytes_in if self.bytes_in else 0.0,
+                'face_crop': self.face_cropper.stats() if self.face_cropper is not None else None,
+            }
+
+    def _count(self, before, after):
+        with self._lock:
+            self.images += 1
+            self.bytes_in += before
+            self.bytes_out += after
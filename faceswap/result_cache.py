@@ -0,0 +1,232 @@
+import asyncio
+import collections
+import hashlib
+import os
+import threading
+import time
+
+from faceswap.image_io import update_digest
+
+CHUNK_SIZE = 1024 * 1024
+
+_digest_lock = threading.Lock()
+_file_digests = {}
+
+
+def stream_digest(stream):
+    """SHA-256 hex digest of a binary stream, read in chunks from its current position"""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_digest(path):
+    """SHA-256 of a file, memoized on (path, mtime, size) so templates hash once"""
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _digest_lock:
+        cached = _file_digests.get(path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    value = update_digest(hashlib.sha256(), path).hexdigest()
+    with _digest_lock:
+        _file_digests[path] = (stamp, value)
+    return value
+
+
+def cache_key(user_digest, template_digest, image_size, aspect_ratio, prompt_version):
+    """Content address of one generation request"""
+    parts = [user_digest, template_digest, image_size, aspect_ratio or '', prompt_version]
+    return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self._lock = threading.Lock()
+        self._waiters = []
+
+    def finish(self):
+        with self._lock:
+            self.done.set()
+            waiters, self._waiters = self._waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future)
+
+    async def wait_async(self):
+        with self._lock:
+            if self.done.is_set():
+                return
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.append((asyncio.get_running_loop(), future))
+        await future
+
+    def outcome(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class ResultCache:
+    """LRU map from request content address to generated files
+
+    Entries point at files already written to `folder`; an entry whose files
+    have disappeared is treated as a miss. Eviction (by total bytes and age)
+    only forgets the mapping, it never deletes the generated files.
+    Concurrent misses for the same key share a single computation.
+    """
+
+    def __init__(self, folder, max_bytes=2 * 1024 ** 3, max_age=7 * 24 * 3600):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._inflight = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def get(self, key, count=True):
+        """Return the cached (files, text) for key, or None
+
+        Only hits are counted here; misses are counted by get_or_compute when
+        a generation actually starts, so a peek followed by a compute is one miss.
+        `count=False` looks without counting a hit, for results only offered.
+        """
+        with self._lock:
+            result = self._lookup(key)
+            if result is not None and count:
+                self.hits += 1
+            return result
+
+    def put(self, key, files, text):
+        size = 0
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(self.folder, name))
+            except OSError:
+                return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (list(files), text, time.time(), size)
+            self._bytes += size
+            self._evict()
+
+    def get_or_compute(self, key, func, *args, **kwargs):
+        """Return the cached result for key or compute it once via func(*args, **kwargs)
+
+        func must return (files, text). Callers that arrive while the same key
+        is being computed wait for that result instead of starting their own.
+        """
+        result, flight, owner = self._begin(key)
+        if result is not None:
+            return result
+        if not owner:
+            flight.done.wait()
+            return flight.outcome()
+
+        try:
+            flight.result = self._store(key, func(*args, **kwargs))
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            self._end(key, flight)
+
+    async def get_or_compute_async(self, key, func, *args, **kwargs):
+        """get_or_compute for a coroutine function; waiters do not hold a thread"""
+        result, flight, owner = self._begin(key)
+        if result is not None:
+            return result
+        if not owner:
+            await flight.wait_async()
+            return flight.outcome()
+
+        try:
+            flight.result = self._store(key, await func(*args, **kwargs))
+            return flight.result
+        except BaseException as e:
+            # Includes cancellation, which must not leave waiters hanging
+            flight.error = e
+            raise
+        finally:
+            self._end(key, flight)
+
+    def _begin(self, key):
+        """(cached result, None, False) or (None, flight, whether we own it)"""
+        with self._lock:
+            result = self._lookup(key)
+            if result is not None:
+                self.hits += 1
+                return result, None, False
+            flight = self._inflight.get(key)
+            if flight is None:
+                self.misses += 1
+                flight = self._inflight[key] = _Flight()
+                return None, flight, True
+            self.coalesced += 1
+            return None, flight, False
+
+    def _store(self, key, result):
+        files, text = result
+        if files:
+            self.put(key, files, text)
+        return files, text
+
+    def _end(self, key, flight):
+        with self._lock:
+            del self._inflight[key]
+        flight.finish()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'inflight': len(self._inflight),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        files, text, created_at, _ = entry
+        if time.time() - created_at > self.max_age or not all(
+                os.path.exists(os.path.join(self.folder, name)) for name in files):
+            self._remove(key)
+            self.evictions += 1
+            return None
+        self._entries.move_to_end(key)
+        return list(files), text
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[3]
+
+    def _evict(self):
+        cutoff = time.time() - self.max_age
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if self._bytes <= self.max_bytes and entry[2] >= cutoff:
+                break
+            self._remove(key)
+            self.evictions += 1
@@ -0,0 +1,295 @@
+"""Which queued job a free worker runs next
+
+A JobQueue keeps its waiting jobs in a scheduler. FifoScheduler is plain
+arrival order. FairScheduler splits them into lanes, one per output size
+for swaps, so a few slow 4K generations cannot hold up every 1K one:
+
+- free workers go to the lane furthest below its weighted share, so with
+  weights 1K=4, 4K=1 the 1K lane gets four starts for every 4K start while
+  both have work, and either gets every worker when alone;
+- a lane may be capped to a share of the workers (4K to three quarters by
+  default), which keeps a slot free for quick jobs arriving behind a wall of
+  slow ones;
+- within a lane, clients take turns, so one client queueing many jobs
+  delays its own later jobs rather than everybody else's.
+
+Both estimate how long a queued job will wait from the recent run times
+of its lane. Schedulers are not thread-safe: JobQueue calls them with its
+lock held.
+
+    python -m benchmarks.scheduling     # 1K latency under 4K pressure, FIFO vs fair
+"""
+import collections
+import os
+import statistics
+
+# Speculative generations (see faceswap/speculation.py) wait in a lane of
+# their own, lighter than any size and capped to half the workers
+SPECULATIVE = 'SPECULATIVE'
+
+# Lane weights, caps (fraction of workers) and initial run time estimates in seconds
+DEFAULT_WEIGHTS = {'1K': 4.0, '2K': 2.0, '4K': 1.0, SPECULATIVE: 0.5}
+DEFAULT_SHARES = {'4K': 0.75, SPECULATIVE: 0.5}
+DEFAULT_SECONDS = {'1K': 20.0, '2K': 30.0, '4K': 60.0, SPECULATIVE: 30.0}
+
+
+def parse_lanes(spec, defaults):
+    """Per-lane numbers from a "1K=4,2K=2,4K=1" string, over `defaults`"""
+    values = dict(defaults)
+    for item in spec.split(','):
+        lane, sep, value = item.partition('=')
+        if sep:
+            values[lane.strip().upper()] = float(value)
+    return values
+
+
+class LaneLatency:
+    """Run times of the last `window` finished jobs per lane
+
+    Lanes without any use `estimates`, then the mean of all lanes' estimates.
+    """
+
+    def __init__(self, estimates=None, window=32):
+        self.estimates = dict(estimates or DEFAULT_SECONDS)
+        self.window = window
+        self._recent = collections.defaultdict(lambda: collections.deque(maxlen=self.window))
+
+    def add(self, lane, seconds):
+        self._recent[lane].append(seconds)
+
+    def get(self, lane):
+        recent = self._recent.get(lane)
+        if recent:
+            return statistics.fmean(recent)
+        if lane in self.estimates:
+            return self.estimates[lane]
+        return statistics.fmean(self.estimates.values()) if self.estimates else 0.0
+
+    def stats(self):
+        return {lane: round(self.get(lane), 2) for lane in set(self.estimates) | set(self._recent)}
+
+
+def _run_seconds(job):
+    """How long a finished job ran, or None if it did not complete normally"""
+    if job.status != 'done' or job.started_at is None or job.finished_at is None:
+        return None
+    return job.finished_at - job.started_at
+
+
+class FifoScheduler:
+    """Jobs in arrival order, whatever their lane or client"""
+
+    def __init__(self, workers=1, latency=None):
+        self.workers = max(1, int(workers))
+        self.latency = latency or LaneLatency()
+        self._queue = collections.deque()
+        self._running = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def push(self, job):
+        self._queue.append(job)
+
+    def pop(self):
+        """The job to start next, or None"""
+        if not self._queue:
+            return None
+        self._running += 1
+        return self._queue.popleft()
+
+    def remove(self, job):
+        """Take a queued job out; False if it is not queued"""
+        try:
+            self._queue.remove(job)
+        except ValueError:
+            return False
+        return True
+
+    def move(self, job, lane):
+        """Put a queued job in `lane`; lanes do not order the queue, so it keeps its place"""
+        if job not in self._queue:
+            return False
+        job.lane = lane
+        return True
+
+    def finished(self, job):
+        """A job returned by pop() has stopped running"""
+        self._running -= 1
+        seconds = _run_seconds(job)
+        if seconds is not None:
+            self.latency.add(job.lane, seconds)
+
+    def position(self, job):
+        """1-based position of a queued job, 0 if it is not queued"""
+        try:
+            return self._queue.index(job) + 1
+        except ValueError:
+            return 0
+
+    def estimated_wait(self, job):
+        """Seconds until a queued job starts: the work ahead of it spread over every worker"""
+        position = self.position(job)
+        if not position:
+            return 0.0
+        ahead = sum(self.latency.get(other.lane) for other in list(self._queue)[:position - 1])
+        return (ahead + self.latency.get(job.lane)) / self.workers
+
+    def stats(self):
+        return {'policy': 'fifo', 'latency': self.latency.stats()}
+
+
+class FairScheduler:
+    """Weighted fair lanes with per-client turns; see the module docstring
+
+    `weights` and `shares` are per lane; lanes not listed weigh 1 and are
+    uncapped. Jobs without a lane share the '' lane.
+    """
+
+    def __init__(self, workers=1, weights=None, shares=None, latency=None):
+        self.workers = max(1, int(workers))
+        self.weights = dict(DEFAULT_WEIGHTS if weights is None else weights)
+        self.shares = dict(DEFAULT_SHARES if shares is None else shares)
+        self.latency = latency or LaneLatency()
+        # lane -> client -> queued jobs; the first client is the next to go
+        self._lanes = collections.defaultdict(collections.OrderedDict)
+        self._running = collections.Counter()
+        # Starts per unit of weight, which the lane furthest behind catches up on
+        self._virtual = collections.Counter()
+        self._count = 0
+
+    @classmethod
+    def from_env(cls, workers):
+        """Scheduler weighted by SWAP_LANE_WEIGHTS, capped by SWAP_LANE_SHARES
+
+        SWAP_LANE_SECONDS seeds the wait estimates until lanes have run times.
+        """
+        return cls(
+            workers,
+            weights=parse_lanes(os.environ.get('SWAP_LANE_WEIGHTS', ''), DEFAULT_WEIGHTS),
+            shares=parse_lanes(os.environ.get('SWAP_LANE_SHARES', ''), DEFAULT_SHARES),
+            latency=LaneLatency(parse_lanes(os.environ.get('SWAP_LANE_SECONDS', ''), DEFAULT_SECONDS)),
+        )
+
+    def __len__(self):
+        return self._count
+
+    def weight(self, lane):
+        return max(self.weights.get(lane, 1.0), 1e-6)
+
+    def limit(self, lane):
+        """Most jobs of `lane` that may run at once"""
+        share = self.shares.get(lane)
+        if not share:
+            return self.workers
+        return max(1, int(self.workers * share))
+
+    def push(self, job):
+        lane = job.lane or ''
+        clients = self._lanes[lane]
+        if not clients and not self._running[lane]:
+            # A lane coming back from idle starts level with the busy ones
+            # instead of cashing in the turns it did not need
+            active = [self._virtual[other] for other in self._active() if other != lane]
+            if active:
+                self._virtual[lane] = max(self._virtual[lane], min(active))
+        clients.setdefault(job.client, collections.deque()).append(job)
+        self._count += 1
+
+    def pop(self):
+        """The job to start next, or None if every lane with work is at its cap"""
+        ready = [lane for lane, clients in self._lanes.items()
+                 if clients and self._running[lane] < self.limit(lane)]
+        if not ready:
+            return None
+        lane = min(ready, key=lambda lane: (self._running[lane] / self.weight(lane), self._virtual[lane]))
+        clients = self._lanes[lane]
+        client, jobs = next(iter(clients.items()))
+        job = jobs.popleft()
+        if jobs:
+            clients.move_to_end(client)
+        else:
+            del clients[client]
+        self._count -= 1
+        self._running[lane] += 1
+        self._virtual[lane] += 1 / self.weight(lane)
+        return job
+
+    def remove(self, job):
+        """Take a queued job out; False if it is not queued"""
+        lane = job.lane or ''
+        clients = self._lanes.get(lane)
+        jobs = clients.get(job.client) if clients else None
+        if not jobs or job not in jobs:
+            return False
+        jobs.remove(job)
+        if not jobs:
+            del clients[job.client]
+        self._count -= 1
+        return True
+
+    def move(self, job, lane):
+        """Put a queued job at the back of its client's jobs in `lane`; False if it is not queued"""
+        if not self.remove(job):
+            return False
+        job.lane = lane
+        self.push(job)
+        return True
+
+    def finished(self, job):
+        """A job returned by pop() has stopped running"""
+        self._running[job.lane or ''] -= 1
+        seconds = _run_seconds(job)
+        if seconds is not None:
+            self.latency.add(job.lane or '', seconds)
+
+    def _active(self):
+        return [lane for lane, clients in self._lanes.items() if clients or self._running[lane]]
+
+    def _order(self, lane):
+        # Clients take turns: each one's first job, then each one's second...
+        queues = list(self._lanes.get(lane, {}).values())
+        order = []
+        for depth in range(max((len(jobs) for jobs in queues), default=0)):
+            order.extend(jobs[depth] for jobs in queues if depth < len(jobs))
+        return order
+
+    def position(self, job):
+        """1-based position of a queued job within its lane, 0 if it is not queued"""
+        try:
+            return self._order(job.lane or '').index(job) + 1
+        except ValueError:
+            return 0
+
+    def slots(self, lane):
+        """Workers `lane` can expect while the currently active lanes keep their work
+
+        That is its weighted share, or more when the other lanes' running and
+        queued jobs leave workers over.
+        """
+        active = set(self._active()) | {lane}
+        share = self.workers * self.weight(lane) / sum(self.weight(other) for other in active)
+        others = sum(self._running[other] + sum(len(jobs) for jobs in self._lanes[other].values())
+                     for other in active if other != lane)
+        return min(self.limit(lane), max(share, self.workers - others))
+
+    def estimated_wait(self, job):
+        """Seconds until a queued job starts, from its lane's share and recent run times"""
+        position = self.position(job)
+        if not position:
+            return 0.0
+        lane = job.lane or ''
+        return position * self.latency.get(lane) / self.slots(lane)
+
+    def stats(self):
+        lanes = {}
+        for lane in sorted(set(self._lanes) | set(self._running)):
+            lanes[lane or 'default'] = {
+                'queued': sum(len(jobs) for jobs in self._lanes.get(lane, {}).values()),
+                'running': self._running[lane],
+                'clients': len(self._lanes.get(lane, {})),
+                'weight': self.weight(lane),
+                'limit': self.limit(lane),
+                'latency': round(self.latency.get(lane), 2),
+            }
+        return {'policy': 'fair', 'lanes': lanes}
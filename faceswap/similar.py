@@ -0,0 +1,192 @@
+"""Perceptual hashes and a near-duplicate index for swap requests
+
+The same selfie often comes back re-compressed by a phone, resized or
+re-saved, which changes every byte and so misses the exact-content result
+cache. A 64-bit difference hash (dHash) survives those changes: two
+encodings of one picture land a few bits apart, unrelated pictures about 32.
+
+HammingIndex finds every stored hash within a Hamming radius using
+multi-index hashing: the hash is split into four 16-bit chunks, each with
+its own table, and by the pigeonhole principle a match within radius r
+agrees with the query to within r // 4 bits on at least one chunk. A query
+therefore probes a few hundred table slots and verifies a handful of
+candidates instead of scanning every entry; benchmarks/near_duplicates.py
+measures it.
+"""
+import collections
+import io
+import itertools
+import os
+import threading
+
+from PIL import Image, ImageOps
+
+HASH_BITS = 64
+CHUNKS = 4
+CHUNK_BITS = HASH_BITS // CHUNKS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+if hasattr(int, 'bit_count'):
+    popcount = int.bit_count
+else:  # Python < 3.10
+    def popcount(value):
+        return bin(value).count('1')
+
+_memo_lock = threading.Lock()
+_file_hashes = {}
+_flip_masks = {}
+
+
+def dhash(source):
+    """64-bit difference hash of an image path, file object or encoded bytes
+
+    Each bit says whether a pixel of the 9x8 grayscale thumbnail is brighter
+    than its right-hand neighbour. JPEGs are decoded at reduced scale.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    with Image.open(source) as img:
+        img.draft('L', (64, 64))
+        img = ImageOps.exif_transpose(img).convert('L').resize((9, 8), Image.BILINEAR, reducing_gap=2.0)
+    pixels = img.tobytes()
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            i = row * 9 + col
+            value = (value << 1) | (pixels[i] > pixels[i + 1])
+    return value
+
+
+def file_dhash(path):
+    """dhash() of a file, memoized on (path, mtime, size) so templates hash once"""
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _memo_lock:
+        cached = _file_hashes.get(path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    value = dhash(path)
+    with _memo_lock:
+        _file_hashes[path] = (stamp, value)
+    return value
+
+
+def hamming(a, b):
+    return popcount(a ^ b)
+
+
+def _masks(distance):
+    """Every CHUNK_BITS-bit mask with at most `distance` bits set"""
+    masks = _flip_masks.get(distance)
+    if masks is None:
+        masks = [0]
+        for n in range(1, distance + 1):
+            for bits in itertools.combinations(range(CHUNK_BITS), n):
+                masks.append(sum(1 << bit for bit in bits))
+        _flip_masks[distance] = masks
+    return masks
+
+
+class HammingIndex:
+    """Items keyed by 64-bit hashes, searchable by Hamming distance
+
+    Not thread-safe; NearDuplicates wraps it in a lock.
+    """
+
+    def __init__(self):
+        self._tables = [{} for _ in range(CHUNKS)]
+        self._entries = {}
+        self._ids = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, value, item):
+        """Store `item` under hash `value` and return an id for remove()"""
+        entry_id = next(self._ids)
+        self._entries[entry_id] = (value, item)
+        for i, table in enumerate(self._tables):
+            table.setdefault((value >> (i * CHUNK_BITS)) & CHUNK_MASK, {})[entry_id] = value
+        return entry_id
+
+    def remove(self, entry_id):
+        value, _ = self._entries.pop(entry_id)
+        for i, table in enumerate(self._tables):
+            chunk = (value >> (i * CHUNK_BITS)) & CHUNK_MASK
+            bucket = table[chunk]
+            del bucket[entry_id]
+            if not bucket:
+                del table[chunk]
+
+    def search(self, value, radius):
+        """[(distance, item)] for every entry within `radius` bits, nearest first"""
+        masks = _masks(radius // CHUNKS)
+        found = {}
+        for i, table in enumerate(self._tables):
+            chunk = (value >> (i * CHUNK_BITS)) & CHUNK_MASK
+            for mask in masks:
+                bucket = table.get(chunk ^ mask)
+                if not bucket:
+                    continue
+                # A match can turn up in several chunks; found dedupes it
+                for entry_id, stored in bucket.items():
+                    distance = popcount(stored ^ value)
+                    if distance <= radius:
+                        found[entry_id] = distance
+        entries = self._entries
+        return [(distance, entries[entry_id][1])
+                for entry_id, distance in sorted(found.items(), key=lambda match: (match[1], match[0]))]
+
+
+class NearDuplicates:
+    """Remembers which generation answered which (photo, template, context)
+
+    `context` is whatever must match exactly for a result to be reusable,
+    e.g. (image size, aspect ratio, prompt version). The photo and template
+    only have to be within `photo_radius` and `template_radius` bits. The
+    oldest entries are forgotten beyond `max_entries`.
+    """
+
+    def __init__(self, max_entries=200_000, photo_radius=6, template_radius=4):
+        self.max_entries = max_entries
+        self.photo_radius = photo_radius
+        self.template_radius = template_radius
+        self._lock = threading.Lock()
+        self._index = HammingIndex()
+        self._order = collections.OrderedDict()
+        self.lookups = 0
+        self.matches = 0
+
+    def add(self, photo_hash, template_hash, context, key):
+        entry = (photo_hash, template_hash, context)
+        with self._lock:
+            entry_id = self._order.pop(entry, None)
+            if entry_id is not None:
+                self._index.remove(entry_id)
+            self._order[entry] = self._index.add(photo_hash, (template_hash, context, key))
+            while len(self._order) > self.max_entries:
+                _, oldest = self._order.popitem(last=False)
+                self._index.remove(oldest)
+
+    def find(self, photo_hash, template_hash, context):
+        """[(photo distance, key)] of earlier requests like this one, nearest first"""
+        with self._lock:
+            self.lookups += 1
+            matches = [
+                (distance, key)
+                for distance, (other_template, other_context, key) in self._index.search(photo_hash, self.photo_radius)
+                if other_context == context and hamming(other_template, template_hash) <= self.template_radius
+            ]
+            if matches:
+                self.matches += 1
+            return matches
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._order),
+                'photo_radius': self.photo_radius,
+                'template_radius': self.template_radius,
+                'lookups': self.lookups,
+                'matches': self.matches,
+            }
@@ -0,0 +1,231 @@
+"""Speculative generations: start a swap before the user asks for it
+
+With a photo and a template chosen, the page can post its current settings
+to /swap/speculate while the user is still looking at sizes and ratios. The
+server queues that generation in a low-priority lane; when the user clicks
+Generate with the same photo, template, size and ratio, /swap adopts the
+running (or finished) job instead of starting over. Different settings
+supersede the speculation and cancel its job.
+
+Each browser session has at most one live speculation, which lapses `ttl`
+seconds after it was last posted, and may waste at most `budget`
+speculations (ones never adopted) per `window` seconds; adopted ones do not
+count. Everything here is per process, like the job queue itself.
+"""
+import collections
+import threading
+import time
+import uuid
+
+# How a speculation ended
+ADOPTED = 'adopted'
+SUPERSEDED = 'superseded'
+EXPIRED = 'expired'
+
+
+class Speculation:
+    """One speculative generation: its session, result cache key and job
+
+    Stands in as the job's owner, so the job counts as followed (and is
+    not abandoned) until the speculation lapses.
+    """
+
+    def __init__(self, session_id, key, job, ttl):
+        self.id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.key = key
+        self.job = job
+        self.ttl = ttl
+        self.created = time.time()
+        self.touched = self.created
+        self.outcome = None
+
+    def idle_for(self):
+        return max(0.0, time.time() - self.touched - self.ttl)
+
+    def expired(self, now=None):
+        return (now or time.time()) - self.touched > self.ttl
+
+    def head_start(self, now=None):
+        """Seconds of the generation done before it was adopted at `now`"""
+        now = now or time.time()
+        if self.job.finished_at is not None:
+            now = min(now, self.job.finished_at)
+        return max(0.0, now - self.created)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.job.status,
+            'created': self.created,
+            'expires': self.touched + self.ttl,
+        }
+
+
+class Speculator:
+    """Live speculations by session, with their budget and hit rate
+
+    `cancel(job)` stops the job of a speculation that will not be adopted;
+    `on_finish(speculation)` is called once each speculation ends, with its
+    `outcome` set. Both are called without the lock held.
+    """
+
+    def __init__(self, budget=3, window=3600, ttl=120, cancel=None, on_finish=None):
+        self.budget = budget
+        self.window = window
+        self.ttl = ttl
+        self.cancel = cancel
+        self.on_finish = on_finish
+        self._lock = threading.Lock()
+        self._live = {}
+        # session -> times of its speculations that were not adopted
+        self._wasted = collections.defaultdict(collections.deque)
+        self._counts = collections.Counter()
+        self._refused = collections.Counter()
+        self._saved = 0.0
+        self._wasted_seconds = 0.0
+
+    def allowed(self, session_id):
+        """Whether `session_id` has budget for another speculation
+
+        Its live one, which a new one would supersede, counts as wasted.
+        """
+        with self._lock:
+            wasted = len(self._recent_waste(session_id, time.time())) + (session_id in self._live)
+            return wasted < self.budget
+
+    def current(self, session_id, key=None):
+        """The session's live speculation (for `key`, if given), touched, or None"""
+        ended = []
+        with self._lock:
+            now = time.time()
+            ended.extend(self._expire(now))
+            speculation = self._live.get(session_id)
+            if speculation is not None and key is not None and speculation.key != key:
+                speculation = None
+            if speculation is not None:
+                speculation.touched = now
+        self._finish(ended)
+        return speculation
+
+    def start(self, session_id, key, job):
+        """Make `job` the session's speculation for `key`, superseding any other
+
+        The job must not have been enqueued yet: it takes the speculation as
+        its owner.
+        """
+        speculation = Speculation(session_id, key, job, self.ttl)
+        job.owner = speculation
+        with self._lock:
+            ended = list(self._expire(time.time()))
+            previous = self._live.pop(session_id, None)
+            if previous is not None:
+                ended.append(self._end(previous, SUPERSEDED))
+            self._live[session_id] = speculation
+            self._counts['started'] += 1
+        self._finish(ended)
+        return speculation
+
+    def claim(self, session_id, key):
+        """Adopt the session's speculation if it was for `key`; supersede it otherwise
+
+        Returns the adopted speculation or None. A failed job is not adopted.
+        """
+        adopted = None
+        with self._lock:
+            now = time.time()
+            ended = list(self._expire(now))
+            speculation = self._live.pop(session_id, None)
+            if speculation is not None:
+                if speculation.key == key and speculation.job.status != 'failed':
+                    adopted = speculation
+                    # From now on the adopting client follows the job itself;
+                    # its idle time must start here, not when it was created
+                    speculation.job.touch()
+                    speculation.job.owner = None
+                    self._saved += speculation.head_start(now)
+                    ended.append(self._end(speculation, ADOPTED))
+                else:
+                    ended.append(self._end(speculation, SUPERSEDED))
+        self._finish(ended)
+        return adopted
+
+    def drop(self, session_id):
+        """Give up the session's speculation, e.g. once its photo is cleared; False without one"""
+        with self._lock:
+            speculation = self._live.pop(session_id, None)
+            ended = [self._end(speculation, SUPERSEDED)] if speculation else []
+        self._finish(ended)
+        return bool(ended)
+
+    def stats(self):
+        with self._lock:
+            ended = list(self._expire(time.time()))
+            counts = dict(self._counts)
+            adopted = counts.get(ADOPTED, 0)
+            settled = adopted + counts.get(SUPERSEDED, 0) + counts.get(EXPIRED, 0)
+            stats = {
+                'live': len(self._live),
+                'started': counts.get('started', 0),
+                ADOPTED: adopted,
+                SUPERSEDED: counts.get(SUPERSEDED, 0),
+                EXPIRED: counts.get(EXPIRED, 0),
+                'refused': dict(self._refused),
+                'hit_rate': round(adopted / settled, 3) if settled else None,
+                'saved_seconds': round(self._saved, 1),
+                'mean_saved_seconds': round(self._saved / adopted, 1) if adopted else None,
+                'wasted_model_seconds': round(self._wasted_seconds, 1),
+                'budget': self.budget,
+                'window': self.window,
+                'ttl': self.ttl,
+            }
+        self._finish(ended)
+        return stats
+
+    def refused(self, reason):
+        """Count a speculation turned away, e.g. for 'budget' or 'busy'"""
+        with self._lock:
+            self._refused[reason] += 1
+
+    def _count_waste(self, job):
+        # Done callback of a job nobody adopted: the model time it used
+        if job.started_at is not None:
+            with self._lock:
+                self._wasted_seconds += job.finished_at - job.started_at
+
+    def _recent_waste(self, session_id, now):
+        # Called with self._lock held
+        times = self._wasted.get(session_id)
+        if times is None:
+            return ()
+        while times and times[0] < now - self.window:
+            times.popleft()
+        if not times:
+            del self._wasted[session_id]
+        return times
+
+    def _expire(self, now):
+        # Called with self._lock held; yields the speculations that just lapsed
+        for session_id, speculation in list(self._live.items()):
+            if speculation.expired(now):
+                del self._live[session_id]
+                yield self._end(speculation, EXPIRED)
+        for session_id in list(self._wasted):
+            self._recent_waste(session_id, now)
+
+    def _end(self, speculation, outcome):
+        # Called with self._lock held
+        speculation.outcome = outcome
+        self._counts[outcome] += 1
+        if outcome != ADOPTED:
+            self._wasted[speculation.session_id].append(time.time())
+        return speculation
+
+    def _finish(self, ended):
+        for speculation in ended:
+            if speculation.outcome != ADOPTED:
+                if self.cancel is not None:
+                    self.cancel(speculation.job)
+                speculation.job.add_done_callback(self._count_waste)
+            if self.on_finish is not None:
+                self.on_finish(speculation)
@@ -0,0 +1,151 @@
+import logging
+import os
+import threading
+
+from flask import abort, request, send_file
+from PIL import Image, features
+from werkzeug.security import safe_join
+
+from faceswap.result_cache import file_digest
+
+logger = logging.getLogger(__name__)
+
+# Pre-encoded siblings in order of preference, with the Pillow encoder and
+# options for each. AVIF is skipped when Pillow was built without it.
+VARIANT_FORMATS = {
+    'avif': ('image/avif', 'AVIF', {'quality': 60}),
+    'webp': ('image/webp', 'WEBP', {'quality': 85, 'method': 4}),
+}
+
+ONE_YEAR = 365 * 24 * 3600
+
+
+def available_formats(wanted):
+    formats = []
+    for ext in wanted:
+        if ext in VARIANT_FORMATS and features.check(ext):
+            formats.append(ext)
+    return tuple(formats)
+
+
+class ImmutableFiles:
+    """Serves never-changing, UUID-named images with strong caching
+
+    Responses carry a content-hash ETag, Last-Modified, a one-year
+    `immutable` Cache-Control and support conditional and Range requests.
+    When the client accepts them, smaller AVIF/WebP encodings kept under
+    `variants_folder` are served in place of the original (with Vary: Accept).
+    Missing variants are encoded in the background after the first request.
+    `on_access(folder_key, path)` is called for every file served.
+    """
+
+    def __init__(self, variants_folder, formats=('webp',), max_age=ONE_YEAR, on_access=None):
+        self.variants_folder = variants_folder
+        self.formats = available_formats(formats)
+        self.max_age = max_age
+        self.on_access = on_access
+        self._lock = threading.Lock()
+        self._encoding = set()
+
+    def variant_path(self, folder_key, filename, ext):
+        return os.path.join(self.variants_folder, folder_key, f"{filename}.{ext}")
+
+    def encode_variants(self, folder_key, path):
+        """Write every configured variant of `path` that is smaller than the original
+
+        A variant that would not be smaller is recorded as an empty file so
+        it is not attempted again.
+        """
+        filename = os.path.basename(path)
+        original_size = os.path.getsize(path)
+        os.makedirs(os.path.join(self.variants_folder, folder_key), exist_ok=True)
+        with Image.open(path) as img:
+            img.load()
+            for ext in self.formats:
+                target = self.variant_path(folder_key, filename, ext)
+                if os.path.exists(target):
+                    continue
+                _, pil_format, options = VARIANT_FORMATS[ext]
+                tmp_path = f"{target}.{threading.get_ident()}.tmp"
+                img.save(tmp_path, pil_format, **options)
+                if os.path.getsize(tmp_path) >= original_size:
+                    open(tmp_path, 'wb').close()
+                os.replace(tmp_path, target)
+
+    def discard_variants(self, folder_key, filename):
+        """Delete the variants of a file that has itself been deleted"""
+        for ext in VARIANT_FORMATS:
+            try:
+                os.remove(self.variant_path(folder_key, filename, ext))
+            except FileNotFoundError:
+                pass
+
+    def schedule_variants(self, folder_key, path):
+        """Encode variants on a background thread, at most once at a time per file"""
+        if not self.formats:
+            return
+        marker = (folder_key, path)
+        with self._lock:
+            if marker in self._encoding:
+                return
+            self._encoding.add(marker)
+
+        def run():
+            try:
+                self.encode_variants(folder_key, path)
+            except Exception as e:
+                logger.warning("Could not encode variants of %s: %s", path, e)
+            finally:
+                with self._lock:
+                    self._encoding.discard(marker)
+
+        threading.Thread(target=run, name='image-variants', daemon=True).start()
+
+    def resolve(self, folder, folder_key, filename, accept_mimetypes):
+        """(original path, path to serve, mimetype or None), or None if there is no such file"""
+        path = safe_join(folder, filename)
+        if path is None or not os.path.isfile(path):
+            return None
+
+        # Only explicit listings count: '*/*' does not promise AVIF/WebP decoding
+        accepted = {value for value, quality in accept_mimetypes if quality > 0}
+        serve_path, mimetype = path, None
+        missing = False
+        for ext in self.formats:
+            mime_type = VARIANT_FORMATS[ext][0]
+            if mime_type not in accepted:
+                continue
+            candidate = self.variant_path(folder_key, filename, ext)
+            try:
+                size = os.path.getsize(candidate)
+            except OSError:
+                missing = True
+                continue
+            if size:
+                serve_path, mimetype = candidate, mime_type
+                break
+        if missing:
+            self.schedule_variants(folder_key, path)
+        if self.on_access is not None:
+            self.on_access(folder_key, path)
+        return path, serve_path, mimetype
+
+    def send(self, folder, folder_key, filename):
+        resolved = self.resolve(folder, folder_key, filename, request.accept_mimetypes)
+        if resolved is None:
+            abort(404)
+        path, serve_path, mimetype = resolved
+
+        response = send_file(
+            serve_path,
+            mimetype=mimetype,
+            etag=file_digest(serve_path)[:32],
+            last_modified=os.path.getmtime(path),
+            max_age=self.max_age,
+            conditional=True,
+        )
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        if self.formats:
+            response.vary.add('Accept')
+        return response
@@ -0,0 +1,338 @@
+"""Retention for generated images and uploaded photos
+
+Files expire after `max_age` seconds without being accessed, and once a
+folder is over `max_bytes` the least recently accessed files go first.
+Last access is the file's atime, set explicitly whenever the app serves or
+reuses a file, so it survives restarts, is shared by every worker process
+and does not depend on how the filesystem is mounted.
+
+Report what a sweep would reclaim, or run one, with:
+
+    python -m faceswap.storage            # dry run
+    python -m faceswap.storage --apply
+"""
+import argparse
+import collections
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: sweeps are not coordinated between processes
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DAY = 24 * 3600
+GIB = 1024 ** 3
+
+# Touching a file again within this many seconds is skipped
+TOUCH_INTERVAL = 300
+
+# Suffix of files still being written; leftovers are removed after the grace period
+TEMP_SUFFIX = '.tmp'
+
+
+class Folder:
+    """A directory of files whose retention is managed by StorageManager
+
+    Zero `max_age` or `max_bytes` disables that limit. `on_delete(name)` is
+    called after a file is removed, e.g. to drop derived files.
+    """
+
+    def __init__(self, name, path, max_age=0, max_bytes=0, on_delete=None):
+        self.name = name
+        self.path = path
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.on_delete = on_delete
+
+    def scan(self):
+        """(last access, size, path) for every file, least recently accessed first"""
+        files = []
+        try:
+            entries = list(os.scandir(self.path))
+        except FileNotFoundError:
+            return files
+        for entry in entries:
+            try:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            files.append((max(st.st_atime, st.st_mtime), st.st_size, os.path.normpath(entry.path)))
+        files.sort()
+        return files
+
+
+class StorageManager:
+    """Keeps managed folders within their age and size limits
+
+    Files accessed within the last `grace` seconds, and files pinned by
+    running work, are never removed, so a size cap is a target rather than
+    a hard limit. A background thread sweeps every `interval` seconds; with
+    several worker processes only one sweeps at a time, coordinated through
+    a lock file at `lock_path`. `on_sweep(report)` receives every report.
+    """
+
+    def __init__(self, folders, grace=3600, interval=600, lock_path=None, on_sweep=None):
+        self.folders = {folder.name: folder for folder in folders}
+        self.grace = grace
+        self.interval = interval
+        self.lock_path = lock_path
+        self.on_sweep = on_sweep
+        self._lock = threading.Lock()
+        self._pins = collections.Counter()
+        self._thread = None
+        self.sweeps = 0
+        self.reclaimed_files = 0
+        self.reclaimed_bytes = 0
+        self.reused = 0
+        self.last_report = None
+
+    @classmethod
+    def from_env(cls, generated_folder, uploads_folder, state_folder, on_delete_generated=None, on_sweep=None):
+        """Manager for the generated and upload folders, configured from the environment
+
+        GENERATED_MAX_AGE / GENERATED_MAX_BYTES and UPLOADS_MAX_AGE /
+        UPLOADS_MAX_BYTES set the limits (seconds and bytes, 0 for none);
+        STORAGE_GRACE and STORAGE_SWEEP_INTERVAL the timing.
+        """
+        env = os.environ.get
+        return cls(
+            [
+                Folder(
+                    'generated', generated_folder,
+                    max_age=float(env('GENERATED_MAX_AGE', 30 * DAY)),
+                    max_bytes=int(env('GENERATED_MAX_BYTES', 10 * GIB)),
+                    on_delete=on_delete_generated,
+                ),
+                Folder(
+                    'uploads', uploads_folder,
+                    max_age=float(env('UPLOADS_MAX_AGE', DAY)),
+                    max_bytes=int(env('UPLOADS_MAX_BYTES', 2 * GIB)),
+                ),
+            ],
+            grace=float(env('STORAGE_GRACE', 3600)),
+            interval=float(env('STORAGE_SWEEP_INTERVAL', 600)),
+            lock_path=os.path.join(state_folder, 'storage.lock'),
+            on_sweep=on_sweep,
+        )
+
+    def touch(self, path):
+        """Record an access to `path`; cheap enough to call on every request"""
+        self._ensure_started()
+        try:
+            st = os.stat(path)
+            now = time.time()
+            if now - st.st_atime > TOUCH_INTERVAL:
+                # Only atime moves: mtime backs Last-Modified and the ETag memo
+                os.utime(path, ns=(time.time_ns(), st.st_mtime_ns))
+        except OSError:
+            pass
+
+    def reuse(self, path):
+        """Touch and return True if `path` already exists, e.g. an identical earlier upload"""
+        if not os.path.exists(path):
+            return False
+        self.touch(path)
+        with self._lock:
+            self.reused += 1
+        return True
+
+    @contextlib.contextmanager
+    def pinned(self, *paths):
+        """Keep `paths` from being swept while the block runs"""
+        paths = [os.path.normpath(path) for path in paths]
+        with self._lock:
+            self._pins.update(paths)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pins.subtract(paths)
+                self._pins += collections.Counter()  # Drop counts that reached zero
+
+    def plan(self, now=None):
+        """Files a sweep would remove, as {folder name: [(path, size, reason)]}
+
+        Files past max_age go first ('age'), then the least recently used
+        until the folder fits max_bytes ('size').
+        """
+        return {name: doomed for name, (_, doomed) in self._assess(now).items()}
+
+    def _assess(self, now=None):
+        """{folder name: (scanned files, files to remove)}"""
+        now = time.time() if now is None else now
+        with self._lock:
+            pins = set(self._pins)
+        plan = {}
+        for folder in self.folders.values():
+            files = folder.scan()
+            total = sum(size for _, size, _ in files)
+            doomed = []
+            for last_access, size, path in files:
+                idle = now - last_access
+                if idle < self.grace or path in pins:
+                    continue
+                if path.endswith(TEMP_SUFFIX):
+                    reason = 'temp'
+                elif folder.max_age and idle > folder.max_age:
+                    reason = 'age'
+                elif folder.max_bytes and total > folder.max_bytes:
+                    reason = 'size'
+                else:
+                    continue
+                doomed.append((path, size, reason))
+                total -= size
+            plan[folder.name] = (files, doomed)
+        return plan
+
+    def sweep(self, dry_run=False):
+        """Remove what plan() lists and return a report; dry_run only reports
+
+        Returns None when another process is already sweeping.
+        """
+        with self._sweep_lock() as acquired:
+            if not acquired:
+                return None
+            started = time.perf_counter()
+            report = {'dry_run': dry_run, 'folders': {}}
+            for name, (files, doomed) in self._assess().items():
+                folder = self.folders[name]
+                reclaimed = collections.Counter()
+                reclaimed_files = collections.Counter()
+                for path, size, reason in doomed:
+                    if not dry_run:
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            continue
+                        except OSError as e:
+                            logger.warning("Could not remove %s: %s", path, e)
+                            continue
+                        if folder.on_delete is not None:
+                            folder.on_delete(os.path.basename(path))
+                    reclaimed[reason] += size
+                    reclaimed_files[reason] += 1
+                report['folders'][name] = {
+                    'files': len(files),
+                    'bytes': sum(size for _, size, _ in files),
+                    'max_bytes': folder.max_bytes,
+                    'max_age': folder.max_age,
+                    'reclaim_files': sum(reclaimed_files.values()),
+                    'reclaim_bytes': sum(reclaimed.values()),
+                    'by_reason': {reason: {'files': reclaimed_files[reason], 'bytes': reclaimed[reason]}
+                                  for reason in reclaimed},
+                    'oldest_access': files[0][0] if files else None,
+                }
+            report['seconds'] = round(time.perf_counter() - started, 3)
+
+        if not dry_run:
+            with self._lock:
+                self.sweeps += 1
+                for folder_report in report['folders'].values():
+                    self.reclaimed_files += folder_report['reclaim_files']
+                    self.reclaimed_bytes += folder_report['reclaim_bytes']
+                self.last_report = report
+            if self.on_sweep is not None:
+                self.on_sweep(report)
+        return report
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sweeps': self.sweeps,
+                'reclaimed_files': self.reclaimed_files,
+                'reclaimed_bytes': self.reclaimed_bytes,
+                'reused_uploads': self.reused,
+                'pinned': len(self._pins),
+                'last_sweep': self.last_report,
+            }
+
+    @contextlib.contextmanager
+    def _sweep_lock(self):
+        if fcntl is None or self.lock_path is None:
+            yield True
+            return
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        with open(self.lock_path, 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _ensure_started(self):
+        # Started on first use, like the job workers, so forking servers do not inherit it
+        if self.interval <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._sweep_forever, name='storage-sweeper', daemon=True)
+                self._thread.start()
+
+    def _sweep_forever(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("Storage sweep failed")
+            time.sleep(self.interval)
+
+
+def _format_bytes(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(n) < 1024 or unit == 'GB':
+            return f"{n:.0f} {unit}" if unit == 'B' else f"{n:.1f} {unit}"
+        n /= 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report (or reclaim) space in static/generated and static/user_uploads")
+    parser.add_argument('--apply', action='store_true', help='delete the files instead of only reporting them')
+    parser.add_argument('--list', action='store_true', help='print every file that would be removed')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    storage = StorageManager.from_env(
+        os.path.join(BASE_DIR, 'static', 'generated'),
+        os.path.join(BASE_DIR, 'static', 'user_uploads'),
+        os.path.join(BASE_DIR, 'cache'),
+    )
+    if args.list:
+        for name, doomed in storage.plan().items():
+            for path, size, reason in doomed:
+                print(f"{name}\t{reason}\t{size}\t{path}")
+    report = storage.sweep(dry_run=not args.apply)
+    if report is None:
+        parser.exit(1, "Another process is sweeping, try again shortly\n")
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    verb = 'Reclaimed' if args.apply else 'Would reclaim'
+    for name, r in report['folders'].items():
+        limits = ', '.join(filter(None, [
+            f"max {_format_bytes(r['max_bytes'])}" if r['max_bytes'] else '',
+            f"max age {r['max_age'] / DAY:g} days" if r['max_age'] else '',
+        ])) or 'no limits'
+        print(f"{name}: {r['files']} files, {_format_bytes(r['bytes'])} ({limits})")
+        print(f"  {verb} {r['reclaim_files']} files, {_format_bytes(r['reclaim_bytes'])}")
+        for reason, counts in sorted(r['by_reason'].items()):
+            print(f"    {reason:<5} {counts['files']:>7} files {_format_bytes(counts['bytes']):>10}")
+
+
+if __name__ == '__main__':
+    main()
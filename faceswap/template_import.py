@@ -0,0 +1,381 @@
+"""Bulk import of gallery templates from ZIP archives and multi-file uploads
+
+Each uploaded file is written straight to disk as the body arrives (see
+TemplateImporter.open_part), then an import job works through it on a
+background thread:
+
+1. every image, whether a plain file or a ZIP entry, is streamed through an
+   Ingestor in chunks, so it is hashed and checked like a single upload
+   without ever being held in memory whole;
+2. images whose content is already in the gallery, or earlier in the same
+   import, are reported as duplicates and dropped;
+3. the rest get their model-input variants and gallery thumbnails rendered
+   across a process pool;
+4. the finished files are moved into the gallery in one pass and the index
+   is invalidated once, so templates never show up half processed.
+
+Memory stays flat in the size of the archive: only the ZIP central
+directory and the per-file report are kept. Progress and the per-file
+report are served by get(). A single template uploaded through the admin
+form takes steps 2 to 4 in the request instead (see add()), so its
+rendering runs in the pool too rather than in the web process.
+"""
+import collections
+import concurrent.futures
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+import weakref
+import zipfile
+
+from werkzeug.utils import secure_filename
+
+from faceswap.gallery import IMAGE_EXTENSIONS, THUMB_FORMATS, render_thumbnail
+from faceswap.ingest import MB, Ingestor, Rejected
+from faceswap.preprocess import Preprocessor
+from faceswap.storage import DAY, TEMP_SUFFIX
+
+logger = logging.getLogger(__name__)
+
+GB = 1024 * MB
+
+CHUNK = 1 * MB
+
+PENDING = 'pending'
+IMPORTED = 'imported'
+DUPLICATE = 'duplicate'
+REJECTED = 'rejected'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+# Settings for pool workers, set by _init_worker
+_worker = None
+
+
+def _init_worker(cache_folder, fmt, quality, thumb_folder, thumb_widths):
+    global _worker
+    _worker = (Preprocessor(cache_folder, fmt=fmt, quality=quality), thumb_folder, thumb_widths)
+
+
+def _prepare(path, digest):
+    """Render the variants and thumbnails of one staged template; returns an error or None"""
+    preprocessor, thumb_folder, thumb_widths = _worker
+    try:
+        preprocessor.render_template_variants(path)
+        os.makedirs(thumb_folder, exist_ok=True)
+        for ext, (pil_format, _) in THUMB_FORMATS.items():
+            for width in thumb_widths:
+                thumb_path = os.path.join(thumb_folder, f"{digest[:32]}_{width}.{ext}")
+                if os.path.exists(thumb_path):
+                    continue
+                tmp_path = f"{thumb_path}.{os.getpid()}{TEMP_SUFFIX}"
+                with open(tmp_path, 'wb') as f:
+                    f.write(render_thumbnail(path, width, pil_format))
+                os.replace(tmp_path, thumb_path)
+    except Exception as e:
+        return str(e)
+    return None
+
+
+def _discard(f, path):
+    f.close()
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class Part:
+    """One file of an import request, written to disk as it arrives
+
+    Deleted when closed or garbage collected unless claim()ed by a job.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'w+b')
+        self._finalizer = weakref.finalize(self, _discard, self._file, path)
+
+    def write(self, data):
+        return self._file.write(data)
+
+    def claim(self):
+        """Keep the file past close() and return its path"""
+        self._file.flush()
+        self._finalizer.detach()
+        self._file.close()
+        return self.path
+
+    def close(self):
+        self._finalizer()
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def __getattr__(self, name):
+        if name == '_file':
+            raise AttributeError(name)
+        return getattr(self._file, name)
+
+
+class ImportJob:
+    """Progress and per-file results of one import"""
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.state = 'receiving'
+        self.created = time.time()
+        self.finished = None
+        self.error = None
+        self.files = []
+
+    def add(self, name, status, **details):
+        entry = {'name': name, 'status': status, **details}
+        self.files.append(entry)
+        return entry
+
+    def report(self):
+        counts = collections.Counter(entry['status'] for entry in self.files)
+        return {
+            'import_id': self.id,
+            'state': self.state,
+            'error': self.error,
+            'created': self.created,
+            'seconds': round((self.finished or time.time()) - self.created, 2),
+            'counts': {status: counts[status] for status in (PENDING, IMPORTED, DUPLICATE, REJECTED, FAILED, SKIPPED)},
+            'files': list(self.files),
+        }
+
+
+class TemplateImporter:
+    """Runs bulk imports into `gallery` (a faceswap.gallery.TemplateIndex)
+
+    Imports stage their files in `staging_dir`, which must be on the same
+    filesystem as the gallery folder. Every image is held to `ingestor`'s
+    limits; an import request may carry at most `max_bytes` in total and
+    `max_files` images. Variants are rendered with `preprocessor`'s cache
+    and format over `workers` processes (default: one per CPU).
+    """
+
+    def __init__(self, gallery, staging_dir, ingestor, preprocessor, workers=None,
+                 max_bytes=2 * GB, max_files=2000, keep=20):
+        self.gallery = gallery
+        self.staging_dir = staging_dir
+        self.ingestor = ingestor
+        self.preprocessor = preprocessor
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._commit_lock = threading.Lock()
+        self._jobs = collections.OrderedDict()
+        os.makedirs(staging_dir, exist_ok=True)
+        self._remove_stale()
+
+    @classmethod
+    def from_env(cls, gallery, staging_dir, preprocessor):
+        """Importer limited by IMPORT_MAX_BYTES, IMPORT_MAX_FILES and the UPLOAD_* image limits
+
+        IMPORT_WORKERS sets the size of the process pool.
+        """
+        workers = int(os.environ.get('IMPORT_WORKERS', 0)) or None
+        return cls(
+            gallery,
+            staging_dir,
+            Ingestor.from_env(staging_dir),
+            preprocessor,
+            workers=workers,
+            max_bytes=int(os.environ.get('IMPORT_MAX_BYTES', 2 * GB)),
+            max_files=int(os.environ.get('IMPORT_MAX_FILES', 2000)),
+        )
+
+    def open_part(self):
+        """New Part for one file of an import request"""
+        return Part(os.path.join(self.staging_dir, f"part.{uuid.uuid4().hex}{TEMP_SUFFIX}"))
+
+    def too_large(self):
+        return Rejected(f'An import must be at most {self.max_bytes // MB} MB', 413, 'too_large')
+
+    def start(self, parts):
+        """Import [(filename, Part)] on a background thread; returns the ImportJob"""
+        job = ImportJob()
+        claimed = [(filename, part.claim()) for filename, part in parts]
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.keep:
+                oldest = next(iter(self._jobs.values()))
+                if oldest.finished is None:
+                    break
+                self._jobs.popitem(last=False)
+        threading.Thread(target=self._run, args=(job, claimed), name=f'import-{job.id[:8]}', daemon=True).start()
+        return job
+
+    def add(self, name, upload):
+        """Import one accepted Upload now and return its report entry
+
+        The caller waits while the pool renders its variants and thumbnails.
+        The entry's status is IMPORTED, DUPLICATE (with the `existing` file)
+        or FAILED (with the `error`).
+        """
+        job = ImportJob()
+        job_dir = os.path.join(self.staging_dir, f"job.{job.id}")
+        os.makedirs(job_dir, exist_ok=True)
+        try:
+            known = {entry['hash']: entry['filename'] for entry in self.gallery.entries()}
+            staged = []
+            self._stage(job, name, upload, known, {}, staged, job_dir)
+            self._commit(job, self._prepare(job, staged))
+            return job.files[0]
+        finally:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+    def get(self, import_id):
+        with self._lock:
+            return self._jobs.get(import_id)
+
+    def stats(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return {
+            'running': sum(job.finished is None for job in jobs),
+            'recent': len(jobs),
+            'max_bytes': self.max_bytes,
+            'max_files': self.max_files,
+        }
+
+    def _run(self, job, parts):
+        job_dir = os.path.join(self.staging_dir, f"job.{job.id}")
+        os.makedirs(job_dir, exist_ok=True)
+        try:
+            staged = self._receive(job, parts, job_dir)
+            job.state = 'processing'
+            staged = self._prepare(job, staged)
+            job.state = 'committing'
+            self._commit(job, staged)
+            job.state = 'done'
+        except Exception as e:
+            logger.exception("Template import %s failed", job.id)
+            job.state = 'failed'
+            job.error = str(e)
+            for entry in job.files:
+                if entry['status'] == PENDING:
+                    entry.update(status=FAILED, error='import aborted')
+        finally:
+            for _, path in parts:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            shutil.rmtree(job_dir, ignore_errors=True)
+            job.finished = time.time()
+
+    def _receive(self, job, parts, job_dir):
+        """Validate, hash and dedupe every image; returns [(report entry, staged path, digest)]"""
+        known = {entry['hash']: entry['filename'] for entry in self.gallery.entries()}
+        seen = {}
+        staged = []
+        for filename, path in parts:
+            if zipfile.is_zipfile(path):
+                with zipfile.ZipFile(path) as archive:
+                    for info in archive.infolist():
+                        name = info.filename
+                        base = os.path.basename(name.rstrip('/'))
+                        if info.is_dir() or name.startswith('__MACOSX/') or base.startswith('.'):
+                            continue
+                        if not base.lower().endswith(IMAGE_EXTENSIONS):
+                            job.add(name, SKIPPED, reason='not_image')
+                            continue
+                        self._receive_one(job, name, lambda: archive.open(info), info.file_size,
+                                          known, seen, staged, job_dir)
+            else:
+                self._receive_one(job, filename, lambda: open(path, 'rb'), os.path.getsize(path),
+                                  known, seen, staged, job_dir)
+        return staged
+
+    def _receive_one(self, job, name, open_source, size, known, seen, staged, job_dir):
+        if len(seen) >= self.max_files:
+            job.add(name, SKIPPED, reason='too_many_files')
+            return
+        upload = None
+        try:
+            upload = self.ingestor.open(size)
+            with open_source() as source:
+                shutil.copyfileobj(source, upload, CHUNK)
+            upload.finish()
+        except Rejected as e:
+            job.add(name, REJECTED, reason=e.reason, error=str(e))
+            return
+        except (zipfile.BadZipFile, OSError, EOFError) as e:
+            if upload is not None:
+                upload.close()
+            job.add(name, REJECTED, reason='unreadable', error=str(e))
+            return
+        self._stage(job, name, upload, known, seen, staged, job_dir)
+
+    def _stage(self, job, name, upload, known, seen, staged, job_dir):
+        """Move an accepted upload into `job_dir` unless its content is already known"""
+        digest = upload.digest
+        if digest in known or digest in seen:
+            upload.close()
+            job.add(name, DUPLICATE, existing=known.get(digest) or seen[digest])
+            return
+        filename = f"{uuid.uuid4()}_{secure_filename(os.path.basename(name)) or 'template'}"
+        upload.commit(os.path.join(job_dir, filename))
+        upload.close()
+        seen[digest] = filename
+        entry = job.add(name, PENDING, filename=filename, width=upload.width, height=upload.height)
+        staged.append((entry, upload.path, digest))
+
+    def _prepare(self, job, staged):
+        """Render variants and thumbnails over the process pool; returns what succeeded"""
+        if not staged:
+            return []
+        preprocessor = self.preprocessor
+        initargs = (preprocessor.cache_folder, preprocessor.fmt, preprocessor.quality,
+                    self.gallery.thumb_folder, self.gallery.widths)
+        ready = []
+        workers = min(self.workers or os.cpu_count() or 1, len(staged))
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=initargs
+        ) as pool:
+            futures = {pool.submit(_prepare, path, digest): (entry, path, digest) for entry, path, digest in staged}
+            for future in concurrent.futures.as_completed(futures):
+                entry, path, digest = futures.pop(future)
+                error = future.result()
+                if error is None:
+                    ready.append((entry, path, digest))
+                else:
+                    entry.update(status=FAILED, error=error)
+        return ready
+
+    def _commit(self, job, ready):
+        with self._commit_lock:
+            # Another import may have added the same image meanwhile
+            known = {entry['hash']: entry['filename'] for entry in self.gallery.entries()}
+            for entry, path, digest in ready:
+                if digest in known:
+                    entry.update(status=DUPLICATE, existing=known[digest])
+                    continue
+                os.replace(path, os.path.join(self.gallery.folder, entry['filename']))
+                entry.update(status=IMPORTED, path=f"/static/templates_gallery/{entry['filename']}")
+            self.gallery.invalidate()
+
+    def _remove_stale(self):
+        # Leftovers of imports interrupted by a restart; live ones are much younger
+        cutoff = time.time() - DAY
+        for name in os.listdir(self.staging_dir):
+            path = os.path.join(self.staging_dir, name)
+            try:
+                if os.stat(path).st_mtime >= cutoff:
+                    continue
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
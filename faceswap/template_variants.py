@@ -0,0 +1,102 @@
+"""Pre-render every template for every output size and aspect ratio
+
+Admin uploads render their variants in the import process pool (see
+TemplateImporter.add); this backfills a whole gallery,
+e.g. after changing PREPROCESS_FORMAT or adding templates by hand. Each
+template is decoded once and its variants cut from that, and templates are
+spread over a process pool because the work is CPU-bound image resampling
+that threads would serialize on.
+
+    python -m faceswap.template_variants               # missing variants only
+    python -m faceswap.template_variants --force --workers 8
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import time
+
+from faceswap.preprocess import Preprocessor
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+# One Preprocessor per worker process, built by _init_worker
+_worker = None
+
+
+def _init_worker(cache_folder, fmt, quality):
+    global _worker
+    _worker = Preprocessor(cache_folder, fmt=fmt, quality=quality)
+
+
+def _render(path, force):
+    start = time.perf_counter()
+    try:
+        written = _worker.render_template_variants(path, force=force)
+    except Exception as e:
+        return path, 0, time.perf_counter() - start, str(e)
+    return path, written, time.perf_counter() - start, None
+
+
+def find_templates(folder):
+    return [os.path.join(folder, name) for name in sorted(os.listdir(folder))
+            if name.lower().endswith(IMAGE_EXTENSIONS)]
+
+
+def backfill(paths, cache_folder, fmt='jpeg', quality=90, workers=None, force=False, on_done=None):
+    """Render the variants of every template in `paths` across `workers` processes
+
+    `on_done(path, written, seconds, error)` is called as each template
+    finishes. Returns a summary dict.
+    """
+    start = time.perf_counter()
+    summary = {'templates': len(paths), 'variants': 0, 'failed': [], 'workers': workers or os.cpu_count()}
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(cache_folder, fmt, quality)
+    ) as pool:
+        futures = [pool.submit(_render, path, force) for path in paths]
+        for future in concurrent.futures.as_completed(futures):
+            path, written, seconds, error = future.result()
+            summary['variants'] += written
+            if error is not None:
+                summary['failed'].append({'path': path, 'error': error})
+            if on_done is not None:
+                on_done(path, written, seconds, error)
+    summary['seconds'] = round(time.perf_counter() - start, 2)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('folder', nargs='?', default=os.path.join(BASE_DIR, 'static', 'templates_gallery'))
+    parser.add_argument('--cache', default=os.path.join(BASE_DIR, 'cache', 'inputs'))
+    parser.add_argument('--format', default=os.environ.get('PREPROCESS_FORMAT', 'jpeg'))
+    parser.add_argument('--quality', type=int, default=90)
+    parser.add_argument('--workers', type=int, help='processes (default: one per CPU)')
+    parser.add_argument('--force', action='store_true', help='re-render variants that already exist')
+    parser.add_argument('--json', action='store_true', help='print the summary as JSON')
+    args = parser.parse_args()
+
+    paths = find_templates(args.folder)
+    if not paths:
+        parser.exit(1, f"No templates found in {args.folder}\n")
+
+    def progress(path, written, seconds, error):
+        if not args.json:
+            status = f"failed: {error}" if error else f"{written} variants"
+            print(f"{os.path.basename(path)[:60]:<62}{status:>14}{seconds:>8.2f}s")
+
+    summary = backfill(paths, args.cache, args.format, args.quality, args.workers, args.force, progress)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+    print(f"\n{summary['variants']} variants for {summary['templates']} templates in {summary['seconds']}s "
+          f"on {summary['workers']} processes, {len(summary['failed'])} failed")
+    if summary['failed']:
+        parser.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+# Gunicorn settings for serving app.py
+#
+#   PROMETHEUS_MULTIPROC_DIR=/tmp/faceswap-metrics gunicorn wsgi:app
+#
+# Jobs live in the worker that accepted them, so scale with threads rather
+# than processes unless sessions are sticky. Each open event stream holds a
+# thread until its job finishes, so there is one per stream app.py allows
+# (MAX_EVENT_STREAMS, by default SWAP_WORKERS + MAX_QUEUE) plus headroom for
+# the gallery, static files and polling.
+import os
+import shutil
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+
+def default_threads(headroom=16):
+    streams = os.environ.get('MAX_EVENT_STREAMS')
+    if streams is None or int(streams) == 0:
+        queue = int(os.environ.get('MAX_QUEUE', 32)) or 32
+        streams = int(os.environ.get('SWAP_WORKERS', 4)) + queue
+    return int(streams) + headroom
+
+
+threads = int(os.environ.get('GUNICORN_THREADS', 0)) or default_threads()
+timeout = 120
+
+
+def on_starting(server):
+    # Metric files from a previous run would be summed into the new one
+    path = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -1,101 +1,145 @@
+import io
 import json
 import os
 import uuid
 import mimetypes
 import base64
-from google import genai
-from google.genai import types
+import sys
+import time
 
-# Constants
-FACE_SWAP_PROMPT = """Make the person's face from picture number 1 replace the face in picture number 2.
-You can change the clothes but only one thing: don't change the hairstyle or anything about the character from picture number 1.
-Keep the same face of the person from picture one, don't change anything about their skin or face.
-Change the position of the person to make the picture look natural and well composed.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from faceswap import metrics, object_store
+from faceswap.admission import parse_deadlines
+from faceswap.core import IMAGE_SIZES, MODEL, build_request, chunk_part, is_timeout
+from faceswap.gemini_client import GeminiClientManager
+from faceswap.image_io import decode_base64, encode_base64, load_image
+from faceswap.jobs import DEADLINE, Cancelled
 
-Picture 1 is the user's face photo.
-Picture 2 is the template/background image.
+# Module scope survives between warm invocations, so the pooled client does
+# too; the genai SDK is only imported by the first invocation that needs it
+gemini = GeminiClientManager.from_env()
 
-Create the final image with the face from picture 1 placed onto picture 2's scene/pose."""
+# Per-size deadlines, e.g. "1K=120,2K=180,4K=480"; see app.py
+SWAP_DEADLINES = parse_deadlines(os.environ.get('SWAP_DEADLINES', ''))
 
-IMAGE_SIZES = {"x1": "1K", "1k": "1K", "2k": "2K", "4k": "4K"}
+# Seconds kept back from the platform's own limit to send a proper 504
+DEADLINE_MARGIN = 2.0
 
-def generate_face_swap(user_image_path, template_image_path, image_size="2K", aspect_ratio=None):
-    """Generate face swap using Gemini API"""
+# Generated images go to OBJECT_STORE and the response carries their URLs;
+# without one they are sent inline, base64 in the body. A store that is set
+# but broken fails every request with the reason. See faceswap/object_store.py
+try:
+    store, store_error = object_store.from_env(), None
+except object_store.ConfigurationError as e:
+    store, store_error = None, e
+
+# Width of the inline preview sent with each URL, 0 for none; a request's `preview` field overrides it
+PREVIEW_WIDTH = int(os.environ.get('PREVIEW_WIDTH', 32))
+MAX_PREVIEW_WIDTH = 128
+
+
+def render_preview(data, width):
+    """Tiny JPEG the page can show while the full image loads, or None
+
+    Its width and height give the page the image's aspect ratio up front.
+    """
+    # PIL is only imported once an image comes back, keeping it off the cold start
+    from PIL import Image
+
+    from faceswap.gallery import render_thumbnail
+
+    try:
+        thumb = render_thumbnail(io.BytesIO(data), width, 'JPEG', quality=60)
+        with Image.open(io.BytesIO(thumb)) as img:
+            thumb_width, thumb_height = img.size
+    except OSError:
+        return None
+    return {
+        'data': 'data:image/jpeg;base64,' + encode_base64(thumb),
+        'width': thumb_width,
+        'height': thumb_height,
+    }
+
+
+def generate_face_swap(user_image, template_image, image_size="2K", aspect_ratio=None, timings=None, timeout=None,
+                       preview_width=0):
+    """Generate face swap using Gemini API
+
+    Both images may be file paths or raw bytes already held in memory.
+    Each generated image is put in the object store as soon as it arrives
+    and only its URL (plus a `preview_width` preview) is kept; without a
+    store it is kept base64-encoded instead.
+    Stage durations are appended to `timings` when a list is given.
+    Raises TimeoutError (or an httpx timeout) once `timeout` seconds pass.
+    """
+    deadline = time.monotonic() + timeout if timeout else None
+    started = None
     try:
-        client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
+        client = gemini.get()
 
         # Load both images
-        user_image_data = load_image_as_base64(user_image_path)
-        template_image_data = load_image_as_base64(template_image_path)
-
-        user_mime = get_mime_type(user_image_path)
-        template_mime = get_mime_type(template_image_path)
-
-        model = "gemini-3-pro-image-preview"
-
-        prompt = FACE_SWAP_PROMPT
-        if aspect_ratio:
-            prompt += f"\n\nGenerate the output image with aspect ratio {aspect_ratio}."
-
-        contents = [
-            types.Content(
-                role="user",
-                parts=[
-                    types.Part.from_text(text="Picture 1 (User's face):"),
-                    types.Part.from_bytes(data=base64.b64decode(user_image_data), mime_type=user_mime),
-                    types.Part.from_text(text="Picture 2 (Template/Background):"),
-                    types.Part.from_bytes(data=base64.b64decode(template_image_data), mime_type=template_mime),
-                    types.Part.from_text(text=prompt),
-                ],
-            ),
-        ]
-
-        generate_content_config = types.GenerateContentConfig(
-            response_modalities=["IMAGE", "TEXT"],
-            image_config=types.ImageConfig(image_size=image_size),
+        with metrics.stage('load_images', image_size, timings):
+            user_image_data, user_mime = load_image(user_image)
+            template_image_data, template_mime = load_image(template_image)
+
+        contents, generate_content_config = build_request(
+            (user_image_data, user_mime, template_image_data, template_mime),
+            image_size, aspect_ratio, gemini.request_options(timeout)
         )
 
         generated_files = []
         text_response = ""
+        first_chunk = True
 
-        for chunk in client.models.generate_content_stream(
-            model=model, contents=contents, config=generate_content_config,
-        ):
-            if (
-                chunk.candidates is None
-                or chunk.candidates[0].content is None
-                or chunk.candidates[0].content.parts is None
+        started = time.perf_counter()
+        with metrics.stage('model_stream', image_size, timings):
+            for chunk in client.models.generate_content_stream(
+                model=MODEL, contents=contents, config=generate_content_config,
             ):
-                continue
-
-            part = chunk.candidates[0].content.parts[0]
-            if part.inline_data and part.inline_data.data:
-                file_id = str(uuid.uuid4())
-                data_buffer = part.inline_data.data
-                file_extension = mimetypes.guess_extension(part.inline_data.mime_type) or '.png'
-                file_name = f"{file_id}{file_extension}"
-                generated_files.append({
-                    'filename': file_name,
-                    'data': base64.b64encode(data_buffer).decode('utf-8'),
-                    'mime_type': part.inline_data.mime_type
-                })
-            elif hasattr(part, 'text') and part.text:
-                text_response += part.text
+                if deadline is not None and time.monotonic() > deadline:
+                    raise TimeoutError
+                if first_chunk:
+                    first_chunk = False
+                    metrics.observe('first_chunk', time.perf_counter() - started, image_size, timings)
+
+                part = chunk_part(chunk)
+                if part is None:
+                    continue
+                if part.inline_data and part.inline_data.data:
+                    file_id = str(uuid.uuid4())
+                    data_buffer = part.inline_data.data
+                    file_extension = mimetypes.guess_extension(part.inline_data.mime_type) or '.png'
+                    file_name = f"{file_id}{file_extension}"
+                    image = {
+                        'filename': file_name,
+                        'mime_type': part.inline_data.mime_type,
+                        'bytes': len(data_buffer),
+                    }
+                    if store is None:
+                        with metrics.stage('encode', image_size, timings):
+                            image['data'] = encode_base64(data_buffer)
+                    else:
+                        with metrics.stage('store', image_size, timings):
+                            image['url'] = store.put(file_name, data_buffer, part.inline_data.mime_type)
+                    if preview_width and store is not None:
+                        with metrics.stage('preview', image_size, timings):
+                            image['preview'] = render_preview(data_buffer, preview_width)
+                    generated_files.append(image)
+                    del data_buffer
+                elif hasattr(part, 'text') and part.text:
+                    text_response += part.text
 
         return generated_files, text_response
+    except object_store.ConfigurationError:
+        raise
     except Exception as e:
+        if is_timeout(e):
+            metrics.CANCELLED.labels(DEADLINE, 'request_sent').inc()
+            if started is not None:
+                metrics.CANCELLED_MODEL_SECONDS.labels(DEADLINE).inc(time.perf_counter() - started)
+            raise
         return [], str(e)
 
-def load_image_as_base64(file_path):
-    """Load image file and return base64 encoded data"""
-    with open(file_path, "rb") as f:
-        return base64.b64encode(f.read()).decode('utf-8')
-
-def get_mime_type(file_path):
-    """Get MIME type from file path"""
-    mime_type, _ = mimetypes.guess_type(file_path)
-    return mime_type or 'image/png'
-
 def handler(event, context):
     """Netlify Function handler for face swap"""
     if event['httpMethod'] != 'POST':
@@ -104,18 +148,31 @@ def handler(event, context):
             'body': json.dumps({'error': 'Method not allowed'})
         }
 
+    if store_error is not None:
+        return {
+            'statusCode': 500,
+            'body': json.dumps({'error': f'Object store misconfigured: {store_error}'})
+        }
+
+    timings = []
     try:
         # Parse form data
-        body = event.get('body', '')
-        if event.get('isBase64Encoded'):
-            body = base64.b64decode(body).decode('utf-8')
-
-        # For simplicity, assume JSON body with base64 encoded images
-        data = json.loads(body)
+        with metrics.stage('parse', '', timings):
+            body = event.get('body', '')
+            if event.get('isBase64Encoded'):
+                # json.loads takes bytes directly, no need for a str copy of the body
+                body = base64.b64decode(body)
+
+            # For simplicity, assume JSON body with base64 encoded images
+            data = json.loads(body)
         user_photo_data = data.get('user_photo')
         template_id = data.get('template_id')
         image_size = data.get('image_size', 'x1')
         aspect_ratio = data.get('aspect_ratio', '')
+        try:
+            preview_width = max(0, min(int(data.get('preview', PREVIEW_WIDTH)), MAX_PREVIEW_WIDTH))
+        except (TypeError, ValueError):
+            preview_width = PREVIEW_WIDTH
 
         if not user_photo_data or not template_id:
             return {
@@ -123,11 +180,9 @@ def handler(event, context):
                 'body': json.dumps({'error': 'Missing required fields'})
             }
 
-        # Save user photo temporarily
-        user_filename = f"user_{uuid.uuid4()}.png"
-        user_path = f"/tmp/{user_filename}"
-        with open(user_path, "wb") as f:
-            f.write(base64.b64decode(user_photo_data))
+        # Keep the user photo in memory, it is only needed for this request
+        user_photo = decode_base64(user_photo_data)
+        del data, body, user_photo_data
 
         # Template path (assuming templates are stored in static/templates_gallery)
         template_path = f"static/templates_gallery/{template_id}"
@@ -137,30 +192,32 @@ def handler(event, context):
                 'body': json.dumps({'error': 'Template not found'})
             }
 
-        # Generate face swap
+        # Generate face swap, giving up before the platform kills the invocation
         size = IMAGE_SIZES.get(image_size, "2K")
+        timeout = SWAP_DEADLINES.get(size)
+        if hasattr(context, 'get_remaining_time_in_millis'):
+            remaining = context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN
+            timeout = min(timeout, remaining) if timeout else remaining
         files, text = generate_face_swap(
-            user_path, template_path, image_size=size,
-            aspect_ratio=aspect_ratio if aspect_ratio else None
+            user_photo, template_path, image_size=size,
+            aspect_ratio=aspect_ratio if aspect_ratio else None,
+            timings=timings, timeout=timeout, preview_width=preview_width
         )
 
-        # Clean up temp file
-        if os.path.exists(user_path):
-            os.remove(user_path)
-
         if files:
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json'},
-                'body': json.dumps({
+            with metrics.stage('serialize', size, timings):
+                body = json.dumps({
                     'success': True,
-                    'images': [{
-                        'filename': img['filename'],
-                        'data': img['data'],
-                        'mime_type': img['mime_type']
-                    } for img in files],
+                    'images': files,
                     'text': text
                 })
+            return {
+                'statusCode': 200,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Server-Timing': metrics.server_timing(timings)
+                },
+                'body': body
             }
         else:
             return {
@@ -168,7 +225,17 @@ def handler(event, context):
                 'body': json.dumps({'error': 'Generation failed'})
             }
 
+    except object_store.ConfigurationError as e:
+        return {
+            'statusCode': 500,
+            'body': json.dumps({'error': f'Object store misconfigured: {e}'})
+        }
     except Exception as e:
+        if is_timeout(e):
+            return {
+                'statusCode': 504,
+                'body': json.dumps({'error': str(Cancelled(DEADLINE))})
+            }
         return {
             'statusCode': 500,
             'body': json.dumps({'error': str(e)})
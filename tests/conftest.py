@@ -0,0 +1,24 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Import the app and the faceswap package from the checkout, however pytest is started
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Settings app.py reads at import: no sweeper thread, a scratch history database
+os.environ.setdefault('STORAGE_SWEEP_INTERVAL', '0')
+os.environ.setdefault('HISTORY_DB', os.path.join(tempfile.mkdtemp(prefix='faceswap-tests-'), 'history.sqlite3'))
+
+
+@pytest.fixture
+def flask_app():
+    import app
+    return app
+
+
+@pytest.fixture
+def client(flask_app):
+    return flask_app.app.test_client()
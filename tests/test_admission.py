@@ -0,0 +1,146 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+
+from faceswap import admission
+from faceswap.admission import AdmissionController, Overloaded, RetryPolicy, TokenBucket
+
+
+class FakeTime:
+    """Stands in for the time module: sleeping moves the clock on at once"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(admission, 'time', clock)
+    return clock
+
+
+def flaky(failures, exc=ConnectionError):
+    """A model call failing `failures` times before it succeeds; counts its calls"""
+    def call():
+        call.calls += 1
+        if call.calls <= failures:
+            raise exc('upstream unavailable')
+        return 'image'
+    call.calls = 0
+    return call
+
+
+def test_token_bucket_refills_at_its_rate(clock):
+    bucket = TokenBucket(rate=2, burst=3)
+    assert [bucket.try_acquire() for _ in range(3)] == [0, 0, 0]
+    assert bucket.try_acquire() == pytest.approx(0.5)
+    clock.sleep(0.5)
+    assert bucket.try_acquire() == 0
+    # Never more than the burst, however long it sat idle
+    clock.sleep(3600)
+    assert bucket.tokens == 3
+
+
+def test_each_client_has_its_own_bucket(clock):
+    controller = AdmissionController(client_rate=0.5, client_burst=2)
+    controller.admit('greedy')
+    controller.admit('greedy')
+    with pytest.raises(Overloaded) as shed:
+        controller.admit('greedy')
+    assert shed.value.reason == 'client' and shed.value.retry_after == 2
+    controller.admit('patient')
+    clock.sleep(2)
+    controller.admit('greedy')
+    stats = controller.stats()
+    assert stats['admitted'] == 4 and stats['shed'] == {'client': 1} and stats['clients'] == 2
+
+
+def test_full_queue_sheds_for_the_time_it_takes_to_drain(clock):
+    queued = [3]
+    controller = AdmissionController(rate=0.5, client_rate=0, max_queue=4, queue_length=lambda: queued[0])
+    controller.admit('client')
+    queued[0] = 4
+    with pytest.raises(Overloaded) as shed:
+        controller.admit('client')
+    assert shed.value.reason == 'queue' and shed.value.retry_after == 8
+
+
+def test_transient_errors_are_retried_with_backoff(clock):
+    delays = []
+    controller = AdmissionController(rate=0, retry=RetryPolicy(attempts=4, base_delay=1, max_delay=16))
+    call = flaky(2)
+    start = clock.now
+    assert controller.call(call, on_retry=lambda attempt, delay, exc: delays.append(delay)) == 'image'
+    assert call.calls == 3
+    assert 0.5 <= delays[0] <= 1 and 1 <= delays[1] <= 2
+    assert clock.now - start == pytest.approx(sum(delays))
+    assert controller.stats()['retries'] == 2
+
+
+def test_retries_stop_at_the_job_deadline(clock):
+    controller = AdmissionController(rate=0, retry=RetryPolicy(attempts=10, base_delay=1, max_delay=16))
+    call = flaky(100)
+    deadline = clock.now + 5
+    with pytest.raises(Overloaded) as shed:
+        controller.call(call, deadline=deadline)
+    assert shed.value.reason == 'upstream'
+    assert isinstance(shed.value.__cause__, ConnectionError)
+    # It gave up rather than sleep past the deadline
+    assert clock.now <= deadline and 2 <= call.calls < 10
+
+
+def test_retries_stop_after_the_last_attempt(clock):
+    controller = AdmissionController(rate=0, retry=RetryPolicy(attempts=3, deadline=3600))
+    call = flaky(100)
+    with pytest.raises(Overloaded):
+        controller.call(call)
+    assert call.calls == 3
+
+
+def test_other_errors_are_not_retried(clock):
+    controller = AdmissionController(rate=0)
+    call = flaky(1, ValueError)
+    with pytest.raises(ValueError):
+        controller.call(call)
+    assert call.calls == 1 and controller.stats()['retries'] == 0
+
+
+def test_quota_wait_past_the_deadline_is_shed(clock):
+    controller = AdmissionController(rate=0.1, burst=1)
+    assert controller.call(flaky(0)) == 'image'
+    start = clock.now
+    with pytest.raises(Overloaded) as shed:
+        controller.call(flaky(0), deadline=clock.now + 5)
+    assert shed.value.reason == 'quota' and clock.now == start
+    # Within the deadline it waits for the token instead
+    assert controller.call(flaky(0), deadline=clock.now + 20) == 'image'
+    assert clock.now == pytest.approx(start + 10)
+
+
+def test_swap_over_the_client_rate_gets_429_and_retry_after(client, flask_app, monkeypatch, clock):
+    controller = AdmissionController(client_rate=0.25, client_burst=1)
+    monkeypatch.setattr(flask_app, 'admission', controller)
+    monkeypatch.setenv('GEMINI_API_KEY', 'test')
+    controller.admit('127.0.0.1')
+
+    photo = io.BytesIO()
+    Image.new('RGB', (64, 64), 'white').save(photo, 'JPEG')
+    template_id = sorted(os.listdir(flask_app.app.config['TEMPLATES_FOLDER']))[0]
+    response = client.post('/swap', data={
+        'user_photo': (io.BytesIO(photo.getvalue()), 'me.jpg'), 'template_id': template_id, 'image_size': '1k'
+    })
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '4'
+    assert response.get_json()['retry_after'] == 4
@@ -0,0 +1,20 @@
+import threading
+
+from faceswap.jobs import EventLog
+
+
+def test_streams_past_the_limit_are_refused(flask_app, monkeypatch):
+    monkeypatch.setitem(flask_app.app.config, 'MAX_EVENT_STREAMS', 1)
+    monkeypatch.setattr(flask_app, 'event_streams', threading.BoundedSemaphore(1))
+    with flask_app.app.test_request_context('/jobs/x/events'):
+        first = flask_app.event_stream(EventLog(), 0, dict)
+        assert first.status_code == 200
+
+        body, status, headers = flask_app.event_stream(EventLog(), 0, dict)
+        assert status == 503 and headers['Retry-After'] == '2'
+
+        # A stream that ends frees its slot, even if it was never read
+        first.close()
+        again = flask_app.event_stream(EventLog(), 0, dict)
+        assert again.status_code == 200
+        again.close()
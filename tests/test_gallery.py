@@ -0,0 +1,55 @@
+import os
+
+from PIL import Image
+
+from faceswap.gallery import TemplateIndex
+from faceswap.result_cache import file_digest
+
+
+def template(path, color):
+    Image.new('RGB', (400, 300), color).save(path, 'JPEG')
+    return file_digest(str(path))
+
+
+def thumbnail_names(index, filename):
+    entry = index.get(filename)
+    return [url.rsplit('/', 1)[1] for url, _ in (item.rsplit(' ', 1) for item in entry['srcset'].split(', '))]
+
+
+def test_deleted_template_takes_its_thumbnails_along(tmp_path):
+    folder, thumbs = tmp_path / 'templates', tmp_path / 'thumbs'
+    folder.mkdir()
+    index = TemplateIndex(str(folder), str(thumbs), '/templates/thumbs')
+    digest = template(folder / 'beach.jpg', 'orange')
+    old = thumbnail_names(index, 'beach.jpg')
+    for name in old:
+        assert index.thumbnail(name) is not None
+    assert sorted(os.listdir(thumbs)) == sorted(old)
+
+    os.remove(folder / 'beach.jpg')
+    assert index.discard(digest) == len(old)
+    assert os.listdir(thumbs) == []
+    assert index.get('beach.jpg') is None
+
+    # A new template under the old name gets thumbnails of its own content
+    template(folder / 'beach.jpg', 'blue')
+    new = thumbnail_names(index, 'beach.jpg')
+    assert set(new).isdisjoint(old)
+    path, _ = index.thumbnail(new[0])
+    with Image.open(path) as img:
+        assert img.convert('RGB').getpixel((0, 0))[2] > 200
+    assert index.thumbnail(old[0]) is None
+
+
+def test_thumbnails_shared_by_an_identical_template_are_kept(tmp_path):
+    folder, thumbs = tmp_path / 'templates', tmp_path / 'thumbs'
+    folder.mkdir()
+    index = TemplateIndex(str(folder), str(thumbs), '/templates/thumbs')
+    digest = template(folder / 'a.jpg', 'orange')
+    (folder / 'b.jpg').write_bytes((folder / 'a.jpg').read_bytes())
+    name = thumbnail_names(index, 'a.jpg')[0]
+    index.thumbnail(name)
+
+    os.remove(folder / 'a.jpg')
+    assert index.discard(digest) == 0
+    assert os.listdir(thumbs) == [name]
@@ -0,0 +1,31 @@
+from faceswap.history import CACHED, DONE, HistoryStore
+
+
+def swap(store, session_id, job_id=None, files=None):
+    return store.record(session_id, 'photo', 'beach.jpg', 'template', '1K', '', 'v1', 'key',
+                        job_id=job_id, files=files)
+
+
+def test_cache_hit_replaces_the_generation_in_the_page(tmp_path):
+    store = HistoryStore(str(tmp_path / 'history.sqlite3'))
+    swap(store, 'me', job_id='job')
+    store.finish('job', DONE, files=['out.jpg'])
+    swap(store, 'someone else', files=['out.jpg'])
+    assert [item['status'] for item in store.page('me')[0]] == [DONE]
+
+    hit = swap(store, 'me', files=['out.jpg'])
+    items, cursor = store.page('me')
+    assert [(item['id'], item['status'], item['files']) for item in items] == [(hit, CACHED, ['out.jpg'])]
+    assert cursor is None
+    # Both requests are still on record for the file and the stats
+    assert len(store.lookup('out.jpg')) == 3
+
+
+def test_failed_generations_are_all_listed(tmp_path):
+    store = HistoryStore(str(tmp_path / 'history.sqlite3'))
+    for job_id in ('first', 'second'):
+        swap(store, 'me', job_id=job_id)
+        store.finish(job_id, 'failed', error='blocked')
+    items, cursor = store.page('me', limit=1)
+    assert len(items) == 1 and cursor is not None
+    assert len(store.page('me', cursor)[0]) == 1
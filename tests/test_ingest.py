@@ -0,0 +1,111 @@
+import hashlib
+import io
+import os
+import struct
+import zlib
+
+import pytest
+from PIL import Image
+
+from faceswap.ingest import Ingestor, Rejected
+
+
+def png_header(width, height):
+    """Start of a PNG claiming `width` x `height` pixels, up to where its pixel data would begin"""
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    chunk = b'IHDR' + ihdr
+    return (b'\x89PNG\r\n\x1a\n' + struct.pack('>I', len(ihdr)) + chunk + struct.pack('>I', zlib.crc32(chunk))
+            + struct.pack('>I', 1 << 20) + b'IDAT')
+
+
+def jpeg(size=(256, 256)):
+    out = io.BytesIO()
+    Image.effect_noise(size, 64).convert('RGB').save(out, 'JPEG', quality=90)
+    return out.getvalue()
+
+
+def feed(upload, data, chunk=4096):
+    for start in range(0, len(data), chunk):
+        upload.write(data[start:start + chunk])
+    return upload.finish()
+
+
+@pytest.fixture
+def staging(tmp_path):
+    folder = tmp_path / 'staging'
+    folder.mkdir()
+    return folder
+
+
+def test_photo_is_accepted_and_described(staging, tmp_path):
+    ingestor = Ingestor(str(staging))
+    data = jpeg()
+    upload = feed(ingestor.open(), data)
+    assert (upload.mime_type, upload.width, upload.height, upload.size) == ('image/jpeg', 256, 256, len(data))
+    assert upload.digest == hashlib.sha256(data).hexdigest()
+
+    upload.commit(str(tmp_path / 'photo.jpg'))
+    upload.close()
+    assert (tmp_path / 'photo.jpg').read_bytes() == data
+    assert os.listdir(staging) == []
+    assert ingestor.stats()['accepted'] == 1
+
+
+def test_wrong_magic_number_is_rejected_on_the_first_chunk(staging):
+    ingestor = Ingestor(str(staging))
+    upload = ingestor.open()
+    with pytest.raises(Rejected) as rejected:
+        upload.write(b'MZ\x90\x00' + b'\x00' * 4092)
+    assert (rejected.value.status, rejected.value.reason) == (415, 'not_image')
+    assert upload.closed and os.listdir(staging) == []
+
+
+def test_body_over_the_limit_is_rejected_mid_stream(staging):
+    ingestor = Ingestor(str(staging), max_bytes=64 * 1024)
+    upload = ingestor.open()
+    data = jpeg((1024, 1024))
+    assert len(data) > 64 * 1024
+    with pytest.raises(Rejected) as rejected:
+        feed(upload, data)
+    assert (rejected.value.status, rejected.value.reason) == (413, 'too_large')
+    assert upload.size <= 64 * 1024 + 4096
+    assert os.listdir(staging) == []
+
+
+def test_declared_length_over_the_limit_is_refused_before_staging(staging):
+    ingestor = Ingestor(str(staging), max_bytes=1024)
+    with pytest.raises(Rejected) as rejected:
+        ingestor.open(content_length=2048)
+    assert rejected.value.reason == 'too_large'
+    assert os.listdir(staging) == []
+
+
+@pytest.mark.parametrize('side', [8000, 20000])
+def test_header_with_too_many_pixels_is_rejected_before_the_pixels(staging, side):
+    ingestor = Ingestor(str(staging), max_pixels=40_000_000)
+    upload = ingestor.open()
+    # The header alone: the check must not wait for pixel data that never comes
+    with pytest.raises(Rejected) as rejected:
+        upload.write(png_header(side, side) + b'\x00' * 32 * 1024)
+    assert (rejected.value.status, rejected.value.reason) == (413, 'dimensions')
+    assert os.listdir(staging) == []
+
+
+def test_short_header_is_checked_when_the_body_ends(staging):
+    ingestor = Ingestor(str(staging), min_side=64)
+    upload = ingestor.open()
+    upload.write(png_header(32, 4000))
+    with pytest.raises(Rejected) as rejected:
+        upload.finish()
+    assert (rejected.value.status, rejected.value.reason) == (400, 'dimensions')
+    assert os.listdir(staging) == []
+
+
+def test_truncated_image_is_unreadable(staging):
+    ingestor = Ingestor(str(staging))
+    upload = ingestor.open()
+    with pytest.raises(Rejected) as rejected:
+        feed(upload, b'\xff\xd8\xff\xe0' + b'\x00' * 100)
+    assert rejected.value.reason == 'unreadable'
+    assert os.listdir(staging) == []
+    assert ingestor.stats()['rejected'] == {'unreadable': 1}
@@ -0,0 +1,81 @@
+import base64
+import importlib.util
+import json
+import os
+
+import pytest
+
+from benchmarks import fake_gemini
+from tests.conftest import ROOT
+
+OUTPUT_BYTES = 2 * 1024 * 1024
+# A stored image's entry: its URL, size and a preview of at most PREVIEW_WIDTH px
+MAX_RESPONSE_BYTES = 4096
+
+
+def load_function(monkeypatch, tmp_path, **env):
+    """A fresh copy of the generate function, run from a site in `tmp_path`"""
+    monkeypatch.setenv('GEMINI_API_KEY', 'test')
+    monkeypatch.delenv('OBJECT_STORE', raising=False)
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+    fake_gemini.install(image_size=OUTPUT_BYTES, image_format='jpeg', latency=0.0)
+    gallery = tmp_path / 'static' / 'templates_gallery'
+    gallery.mkdir(parents=True)
+    (gallery / 'tpl.jpg').write_bytes(fake_gemini.noise_jpeg(20_000))
+    monkeypatch.chdir(tmp_path)
+    spec = importlib.util.spec_from_file_location(
+        'generate_under_test', os.path.join(ROOT, 'netlify', 'functions', 'generate.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def invoke(module):
+    photo = base64.b64encode(fake_gemini.noise_jpeg(20_000)).decode('ascii')
+    body = json.dumps({'user_photo': photo, 'template_id': 'tpl.jpg', 'image_size': '2k'})
+    response = module.handler({'httpMethod': 'POST', 'body': body}, None)
+    return response['statusCode'], response['body']
+
+
+def test_stored_images_come_back_as_urls(monkeypatch, tmp_path):
+    store_dir = tmp_path / 'generated'
+    module = load_function(monkeypatch, tmp_path, OBJECT_STORE='local', OBJECT_STORE_DIR=str(store_dir))
+    status, body = invoke(module)
+
+    assert status == 200
+    assert len(body) < MAX_RESPONSE_BYTES
+    image, = json.loads(body)['images']
+    assert 'data' not in image
+    assert image['url'] == '/generated/' + image['filename']
+    assert (store_dir / image['filename']).stat().st_size == image['bytes'] > OUTPUT_BYTES // 2
+
+
+def test_images_are_inline_without_a_store(monkeypatch, tmp_path):
+    module = load_function(monkeypatch, tmp_path)
+    status, body = invoke(module)
+
+    assert status == 200
+    image, = json.loads(body)['images']
+    assert 'url' not in image
+    assert len(base64.b64decode(image['data'])) == image['bytes'] > OUTPUT_BYTES // 2
+    assert not (tmp_path / 'static' / 'generated').exists()
+
+
+@pytest.mark.parametrize('spec', ['nonsense', 'no_such_module:factory'])
+def test_misconfigured_store_is_reported(monkeypatch, tmp_path, spec):
+    module = load_function(monkeypatch, tmp_path, OBJECT_STORE=spec)
+    status, body = invoke(module)
+
+    assert status == 500
+    assert 'OBJECT_STORE' in json.loads(body)['error']
+
+
+def test_unwritable_store_is_reported(monkeypatch, tmp_path):
+    blocker = tmp_path / 'not-a-directory'
+    blocker.write_text('')
+    module = load_function(monkeypatch, tmp_path, OBJECT_STORE='local', OBJECT_STORE_DIR=str(blocker / 'generated'))
+    status, body = invoke(module)
+
+    assert status == 500
+    assert 'Cannot write generated images' in json.loads(body)['error']
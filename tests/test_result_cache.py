@@ -0,0 +1,130 @@
+import threading
+import time
+
+from faceswap.jobs import CLIENT, Cancelled
+from faceswap.result_cache import ResultCache
+
+WAITERS = 5
+
+
+class BlockingGeneration:
+    """A fake generation that holds every call until released
+
+    Calls return a result file written to `folder`, or raise the next of
+    `errors` (one per call) instead.
+    """
+
+    def __init__(self, folder, errors=()):
+        self.folder = folder
+        self.errors = list(errors)
+        self.release = threading.Event()
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, name):
+        with self._lock:
+            self.calls += 1
+            error = self.errors.pop(0) if self.errors else None
+        assert self.release.wait(5)
+        if error is not None:
+            raise error
+        (self.folder / name).write_bytes(b'image')
+        return [name], 'text'
+
+
+def start(target, count):
+    outcomes = []
+    lock = threading.Lock()
+
+    def run():
+        try:
+            outcome = target()
+        except Exception as e:
+            outcome = e
+        with lock:
+            outcomes.append(outcome)
+
+    threads = [threading.Thread(target=run) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, outcomes
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def join(threads):
+    for thread in threads:
+        thread.join(5)
+        assert not thread.is_alive()
+
+
+def test_concurrent_misses_share_one_generation(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    generate = BlockingGeneration(tmp_path)
+    threads, outcomes = start(lambda: cache.get_or_compute('key', generate, 'out.jpg'), WAITERS)
+    wait_for(lambda: cache.stats()['coalesced'] == WAITERS - 1)
+    generate.release.set()
+    join(threads)
+
+    assert generate.calls == 1
+    assert outcomes == [(['out.jpg'], 'text')] * WAITERS
+    assert cache.get('key') == (['out.jpg'], 'text')
+    stats = cache.stats()
+    assert stats['misses'] == 1 and stats['inflight'] == 0
+
+
+def test_failure_reaches_every_waiter_and_is_not_cached(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    error = RuntimeError('model refused')
+    generate = BlockingGeneration(tmp_path, errors=[error])
+    threads, outcomes = start(lambda: cache.get_or_compute('key', generate, 'out.jpg'), WAITERS)
+    wait_for(lambda: cache.stats()['coalesced'] == WAITERS - 1)
+    generate.release.set()
+    join(threads)
+
+    assert generate.calls == 1
+    assert outcomes == [error] * WAITERS
+    assert cache.get('key') is None and cache.stats()['inflight'] == 0
+    # The next request tries again
+    assert cache.get_or_compute('key', generate, 'out.jpg') == (['out.jpg'], 'text')
+    assert generate.calls == 2
+
+
+def test_waiters_start_over_when_the_owner_is_cancelled(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    generate = BlockingGeneration(tmp_path, errors=[Cancelled(CLIENT)])
+    owner, owner_outcome = start(lambda: cache.get_or_compute('key', generate, 'out.jpg'), 1)
+    wait_for(lambda: generate.calls == 1)
+
+    def shared_job():
+        # What run_swap does: the owner's cancellation is not the waiter's
+        while True:
+            try:
+                return cache.get_or_compute('key', generate, 'out.jpg')
+            except Cancelled:
+                pass
+
+    threads, outcomes = start(shared_job, WAITERS - 1)
+    wait_for(lambda: cache.stats()['coalesced'] == WAITERS - 1)
+    generate.release.set()
+    join(owner + threads)
+
+    assert isinstance(owner_outcome[0], Cancelled)
+    # One waiter took over the generation and the rest shared it
+    assert generate.calls == 2
+    assert outcomes == [(['out.jpg'], 'text')] * (WAITERS - 1)
+    assert cache.stats()['misses'] == 2
+
+
+def test_result_whose_files_are_gone_is_a_miss(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    (tmp_path / 'out.jpg').write_bytes(b'image')
+    cache.put('key', ['out.jpg'], 'text')
+    assert cache.get('key') == (['out.jpg'], 'text')
+    (tmp_path / 'out.jpg').unlink()
+    assert cache.get('key') is None
@@ -0,0 +1,100 @@
+import collections
+import itertools
+
+from faceswap.scheduler import FairScheduler, FifoScheduler
+
+
+class FakeJob:
+    """The parts of a Job a scheduler looks at"""
+
+    def __init__(self, lane, client='client'):
+        self.lane = lane
+        self.client = client
+        self.status = 'done'
+        self.started_at = self.finished_at = None
+
+    def __repr__(self):
+        return f'FakeJob({self.lane!r}, {self.client!r})'
+
+
+def run_one(scheduler):
+    # A worker starts the next job and finishes it straight away
+    job = scheduler.pop()
+    if job is not None:
+        scheduler.finished(job)
+    return job
+
+
+def test_busy_lanes_start_by_weight():
+    scheduler = FairScheduler(1, weights={'1K': 4, '4K': 1}, shares={})
+    for lane in ('1K', '4K'):
+        for _ in range(50):
+            scheduler.push(FakeJob(lane))
+    started = collections.Counter(run_one(scheduler).lane for _ in range(25))
+    assert started == {'1K': 20, '4K': 5}
+
+
+def test_a_lane_alone_gets_every_worker():
+    scheduler = FairScheduler(4, weights={'1K': 4, '4K': 1}, shares={})
+    for _ in range(6):
+        scheduler.push(FakeJob('4K'))
+    assert all(scheduler.pop() is not None for _ in range(4))
+    assert len(scheduler) == 2
+
+
+def test_capped_lane_leaves_workers_for_the_others():
+    scheduler = FairScheduler(4, shares={'4K': 0.5})
+    for _ in range(4):
+        scheduler.push(FakeJob('4K'))
+    running = [scheduler.pop(), scheduler.pop()]
+    assert scheduler.pop() is None
+    quick = FakeJob('1K')
+    scheduler.push(quick)
+    assert scheduler.pop() is quick
+    # Once a 4K job finishes the lane may start another
+    scheduler.finished(running[0])
+    assert scheduler.pop().lane == '4K'
+    assert scheduler.pop() is None
+
+
+def test_clients_take_turns_within_a_lane():
+    scheduler = FairScheduler(1)
+    heavy = [FakeJob('1K', 'heavy') for _ in range(3)]
+    for job in heavy:
+        scheduler.push(job)
+    light = FakeJob('1K', 'light')
+    scheduler.push(light)
+    assert scheduler.position(light) == 2
+    assert scheduler.position(heavy[2]) == 4
+    assert [run_one(scheduler) for _ in range(4)] == [heavy[0], light, heavy[1], heavy[2]]
+
+
+def test_idle_lane_does_not_catch_up_on_skipped_turns():
+    scheduler = FairScheduler(1, weights={'1K': 1, '4K': 1}, shares={})
+    for _ in range(20):
+        scheduler.push(FakeJob('1K'))
+        run_one(scheduler)
+    for lane in ('1K', '4K'):
+        for _ in range(4):
+            scheduler.push(FakeJob(lane))
+    # Level with 1K on its return, not 20 starts ahead of it
+    lanes = [run_one(scheduler).lane for _ in range(4)]
+    assert lanes.count('4K') == 2
+
+
+def test_move_changes_lane():
+    scheduler = FairScheduler(1, shares={})
+    job = FakeJob('SPECULATIVE')
+    scheduler.push(job)
+    assert scheduler.move(job, '1K')
+    assert job.lane == '1K' and scheduler.position(job) == 1 and len(scheduler) == 1
+    assert scheduler.pop() is job
+    assert not scheduler.move(job, '2K')
+
+
+def test_fifo_ignores_lanes_and_clients():
+    scheduler = FifoScheduler(1)
+    jobs = [FakeJob(lane, client) for lane, client in itertools.product(('4K', '1K'), ('a', 'b'))]
+    for job in jobs:
+        scheduler.push(job)
+    assert [run_one(scheduler) for _ in jobs] == jobs
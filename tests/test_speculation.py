@@ -0,0 +1,88 @@
+import threading
+import time
+
+from faceswap.jobs import ABANDONED, SPECULATION, Job, JobQueue
+from faceswap.scheduler import SPECULATIVE, FairScheduler, FifoScheduler
+from faceswap.speculation import ADOPTED, Speculator
+
+
+def speculative_job(queue, speculator, gate):
+    job = Job(gate.wait, (), {}, lane=SPECULATIVE, client='client')
+    speculator.start('session', 'key', job)
+    return queue.enqueue(job)
+
+
+def test_adopted_job_survives_sweep():
+    queue = JobQueue(workers=1, abandon_after=1, scheduler=FairScheduler(1))
+    speculator = Speculator(ttl=60, cancel=lambda job: queue.cancel(job, SPECULATION))
+    gate = threading.Event()
+    try:
+        job = speculative_job(queue, speculator, gate)
+        # Nobody has polled it for longer than abandon_after: the speculation keeps it alive
+        job.last_seen = time.monotonic() - 10
+        queue.sweep()
+        assert job.cancel_reason is None
+
+        speculation = speculator.claim('session', 'key')
+        assert speculation.outcome == ADOPTED and job.owner is None
+        queue.sweep()
+        assert job.cancel_reason is None
+
+        # Once adopted it is abandoned like any job nobody follows
+        job.last_seen = time.monotonic() - 10
+        queue.sweep()
+        assert job.cancel_reason == ABANDONED
+    finally:
+        gate.set()
+
+
+def test_other_settings_supersede_and_cancel():
+    queue = JobQueue(workers=1, scheduler=FairScheduler(1))
+    speculator = Speculator(budget=1, ttl=60, cancel=lambda job: queue.cancel(job, SPECULATION))
+    gate = threading.Event()
+    try:
+        job = speculative_job(queue, speculator, gate)
+        assert not speculator.allowed('session')
+        assert speculator.claim('session', 'other key') is None
+        assert job.cancel_reason == SPECULATION
+        stats = speculator.stats()
+        assert stats['superseded'] == 1 and stats['hit_rate'] == 0
+        assert not speculator.allowed('session')
+    finally:
+        gate.set()
+
+
+def test_adopted_job_gets_a_fresh_deadline(flask_app):
+    queue = JobQueue(workers=1, scheduler=FairScheduler(1))
+    speculator = Speculator(ttl=600)
+    gate = threading.Event()
+    try:
+        queue.enqueue(Job(gate.wait, (), {}, lane='1K'))
+        job = Job(gate.wait, (), {}, timeout=300, lane=SPECULATIVE, client='client')
+        speculator.start('session', 'key', job)
+        queue.enqueue(job)
+        # The user thought about it for a long while, re-posting to keep it alive
+        job.deadline = time.monotonic() + 5
+
+        flask_app.adopt_speculation(queue, speculator.claim('session', 'key').job, '4K')
+        assert job.lane == '4K'
+        assert job.remaining() > flask_app.app.config['SWAP_DEADLINES']['4K'] - 1
+    finally:
+        gate.set()
+
+
+def test_adopted_job_keeps_its_place_in_fifo_order():
+    queue = JobQueue(workers=1, scheduler=FifoScheduler(1))
+    gate = threading.Event()
+    try:
+        running = queue.enqueue(Job(gate.wait, (), {}, lane='1K'))
+        while running.status != 'running':
+            time.sleep(0.01)
+        before, job, after = (queue.enqueue(Job(gate.wait, (), {}, lane=lane))
+                              for lane in ('1K', SPECULATIVE, '2K'))
+        assert queue.position(job) == 2
+        assert queue.promote(job, '1K')
+        assert job.lane == '1K'
+        assert [queue.position(j) for j in (before, job, after)] == [1, 2, 3]
+    finally:
+        gate.set()
@@ -0,0 +1,48 @@
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+from tests.conftest import ROOT
+
+SDK = 'google.genai'
+
+# Each entry point is loaded, answers a request that needs no model, then
+# asks for the Gemini client as a generation's first step does
+SCRIPT = textwrap.dedent('''
+    import json, sys
+    sys.path.insert(0, {root!r})
+    from benchmarks.startup import first_response, load_function
+    entry = {entry!r}
+    if entry == 'generate':
+        module = load_function(entry)
+        gemini = module.gemini
+    else:
+        module = __import__({module!r})
+        gemini = sys.modules['app'].gemini
+    after_import = {sdk!r} in sys.modules
+    status, _ = first_response(entry, module)
+    after_request = {sdk!r} in sys.modules
+    gemini.get()
+    print(json.dumps([after_import, after_request, {sdk!r} in sys.modules, status]))
+''')
+
+
+@pytest.mark.parametrize('entry, module', [('wsgi', 'wsgi'), ('asgi', 'asgi_app'), ('generate', None)])
+def test_genai_sdk_waits_for_first_generation(entry, module, tmp_path):
+    if entry == 'asgi':
+        pytest.importorskip('quart')
+    env = dict(os.environ, GEMINI_API_KEY='test', STORAGE_SWEEP_INTERVAL='0', PYTHONDONTWRITEBYTECODE='1',
+               HISTORY_DB=str(tmp_path / 'history.sqlite3'))
+    env.pop('GEMINI_WARMUP', None)
+    script = SCRIPT.format(root=ROOT, entry=entry, module=module, sdk=SDK)
+    out = subprocess.check_output([sys.executable, '-c', script], cwd=ROOT, env=env, text=True)
+    after_import, after_request, after_generation, status = json.loads(out.strip().splitlines()[-1])
+
+    assert not after_import, f'{entry} imports {SDK} at startup'
+    assert not after_request, f'{entry} imports {SDK} for a request without the model'
+    assert after_generation
+    assert status < 500
@@ -0,0 +1,70 @@
+import io
+import uuid
+
+import pytest
+from PIL import Image, features
+
+from faceswap.static_files import ImmutableFiles
+
+
+@pytest.fixture
+def generated(flask_app, monkeypatch, tmp_path):
+    """A photo-like generated image served from a scratch folder: (name, bytes, ImmutableFiles)"""
+    folder = tmp_path / 'generated'
+    folder.mkdir()
+    files = ImmutableFiles(str(tmp_path / 'variants'), formats=('webp',))
+    monkeypatch.setitem(flask_app.app.config, 'UPLOAD_FOLDER', str(folder))
+    monkeypatch.setattr(flask_app, 'immutable_files', files)
+
+    img = Image.linear_gradient('L').resize((512, 512)).convert('RGB')
+    out = io.BytesIO()
+    img.save(out, 'JPEG', quality=95)
+    name = f'{uuid.uuid4()}.jpg'
+    (folder / name).write_bytes(out.getvalue())
+    return name, out.getvalue(), files
+
+
+def test_cached_copy_revalidates_with_304(client, generated):
+    name, data, _ = generated
+    response = client.get(f'/static/generated/{name}')
+    assert response.status_code == 200
+    assert response.data == data
+    assert 'immutable' in response.headers['Cache-Control']
+
+    response = client.get(f'/static/generated/{name}', headers={'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+    assert response.data == b''
+
+
+def test_range_request_gets_206(client, generated):
+    name, data, _ = generated
+    response = client.get(f'/static/generated/{name}', headers={'Range': 'bytes=0-99'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 0-99/{len(data)}'
+    assert response.data == data[:100]
+
+
+def test_unsatisfiable_range_gets_416(client, generated):
+    name, data, _ = generated
+    response = client.get(f'/static/generated/{name}', headers={'Range': f'bytes={len(data) + 10}-'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{len(data)}'
+
+
+@pytest.mark.skipif(not features.check('webp'), reason='Pillow built without WebP')
+def test_webp_only_for_clients_that_accept_it(client, generated):
+    name, data, files = generated
+    files.encode_variants('generated', files.resolve(
+        client.application.config['UPLOAD_FOLDER'], 'generated', name, [])[0])
+
+    response = client.get(f'/static/generated/{name}', headers={'Accept': 'image/webp,image/*;q=0.8'})
+    assert response.status_code == 200
+    assert response.mimetype == 'image/webp'
+    assert len(response.data) < len(data)
+    assert 'Accept' in response.headers['Vary']
+
+    for accept in ('image/*,*/*;q=0.8', None):
+        headers = {'Accept': accept} if accept else {}
+        response = client.get(f'/static/generated/{name}', headers=headers)
+        assert response.mimetype == 'image/jpeg'
+        assert response.data == data
@@ -0,0 +1,69 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+
+from faceswap.gallery import TemplateIndex
+from faceswap.ingest import Ingestor
+from faceswap.preprocess import Preprocessor
+from faceswap.template_import import DUPLICATE, IMPORTED, TemplateImporter
+
+
+def jpeg(color):
+    out = io.BytesIO()
+    Image.new('RGB', (800, 600), color).save(out, 'JPEG')
+    return out.getvalue()
+
+
+@pytest.fixture
+def importer(tmp_path):
+    for name in ('gallery', 'thumbs', 'variants', 'staging', 'uploads'):
+        (tmp_path / name).mkdir()
+    gallery = TemplateIndex(str(tmp_path / 'gallery'), str(tmp_path / 'thumbs'), '/templates/thumbs')
+    return TemplateImporter(gallery, str(tmp_path / 'staging'), Ingestor(str(tmp_path / 'staging')),
+                            Preprocessor(str(tmp_path / 'variants')), workers=1)
+
+
+def upload(tmp_path, data):
+    upload = Ingestor(str(tmp_path / 'uploads')).open()
+    upload.write(data)
+    return upload.finish()
+
+
+def test_single_upload_is_rendered_and_added(importer, tmp_path):
+    entry = importer.add('beach photo.jpg', upload(tmp_path, jpeg('orange')))
+    assert entry['status'] == IMPORTED
+    assert entry['filename'].endswith('_beach_photo.jpg')
+    assert os.listdir(tmp_path / 'gallery') == [entry['filename']]
+    assert importer.gallery.get(entry['filename'])['width'] == 800
+
+    # Rendered by the pool before the template shows up in the gallery
+    digest = importer.gallery.get(entry['filename'])['hash']
+    assert sorted(os.listdir(tmp_path / 'thumbs')) == sorted(
+        f"{digest[:32]}_{width}.{ext}" for width in importer.gallery.widths for ext in ('jpg', 'webp'))
+    assert os.listdir(tmp_path / 'variants')
+    assert os.listdir(tmp_path / 'staging') == [] and os.listdir(tmp_path / 'uploads') == []
+
+
+def test_same_content_twice_is_a_duplicate(importer, tmp_path):
+    first = importer.add('a.jpg', upload(tmp_path, jpeg('orange')))
+    second = importer.add('b.jpg', upload(tmp_path, jpeg('orange')))
+    assert second['status'] == DUPLICATE and second['existing'] == first['filename']
+    assert os.listdir(tmp_path / 'gallery') == [first['filename']]
+    assert os.listdir(tmp_path / 'uploads') == []
+
+
+def test_admin_upload_goes_through_the_importer(client, flask_app, importer, monkeypatch):
+    monkeypatch.setattr(flask_app, 'template_importer', importer)
+    with client.session_transaction() as session:
+        session['admin_logged_in'] = True
+    data = {'template': (io.BytesIO(jpeg('blue')), 'blue.jpg')}
+    response = client.post('/admin/upload', data=data)
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['success'] and not body['duplicate']
+    assert importer.gallery.get(body['filename']) is not None
+
+    response = client.post('/admin/upload', data={'template': (io.BytesIO(jpeg('blue')), 'again.jpg')})
+    assert response.get_json()['duplicate'] and response.get_json()['filename'] == body['filename']